@@ -0,0 +1,469 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2016 Vincent Legoll <vincent.legoll@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Backup of the images in glance being replaced by a new version.
+
+By default, the old image is kept in glance: it is renamed with a timestamp
+suffix, and marked with a glancing_backup_of property, holding the name of
+the image it was a version of. It can also be deactivated, so that no new
+VM is started from it, or tagged. Backups beyond a given count, or older
+than a given age, are deleted.
+
+Downloading the old image to a local directory, before deleting it from
+glance, is only done on request: into a deduplicating chunk store (see
+chunkstore.py), where versions expire like the backups kept in glance, or
+into a single file. The download is streamed through a fast compressor into
+the backup file, while the uncompressed data is hashed, and verified against
+the checksums recorded by glance. A manifest is written next to the backup
+file: image ID & properties, sizes and checksums. Only the images actually
+backed up are deleted.
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import gzip
+import json
+import time
+import argparse
+import calendar
+import subprocess
+
+try:
+    from shutil import which as find_executable
+except ImportError:
+    from distutils.spawn import find_executable
+
+import utils
+import glance
+import multihash
+import chunkstore
+import decompressor
+import openstack_out
+
+from utils import vprint, size_t
+
+# How to backup an image being replaced
+STRATEGIES = ('rename', 'deactivate', 'tag', 'store', 'download', 'none')
+
+_PROPERTY = 'glancing_backup_of'
+
+_TAG = 'glancing-backup'
+
+_SUFFIX = '_backup_'
+
+_TIME_FORMAT = '%Y%m%dT%H%M%SZ'
+
+# Backups of an image kept by default
+_KEEP = 3
+
+_DAY = 24 * 60 * 60
+
+# Fast compressors of local backups, by preference, the multi-threaded ones
+# first. The in-process gzip one is the fallback
+_COMPRESSORS = (
+    ('.zst', ['zstd', '-1', '-T0', '-q', '-c']),
+    ('.gz', ['pigz', '-1', '-c']),
+)
+
+_MANIFEST_EXT = '.manifest.json'
+
+class BackupError(Exception):
+    '''Class to allow catching exceptions from this module'''
+
+def get_strategy(strategy=None, backupdir=None):
+    '''Backup strategy: the one given, else the chunk store if given a
+    backup directory, else GLANCING_BACKUP_STRATEGY, default: rename
+    '''
+    if not strategy:
+        if backupdir:
+            strategy = 'store'
+        else:
+            strategy = os.environ.get('GLANCING_BACKUP_STRATEGY', 'rename')
+    if strategy not in STRATEGIES:
+        raise BackupError('unknown backup strategy: ' + strategy)
+    return strategy
+
+def backup_name(name, now=None):
+    '''Name of the backup of an image, made at time now'''
+    return name + _SUFFIX + time.strftime(_TIME_FORMAT, time.gmtime(now))
+
+def backup_time(name, bkname):
+    '''Time a backup of an image was made at, from its name, or None'''
+    prefix = name + _SUFFIX
+    if not bkname.startswith(prefix):
+        return None
+    try:
+        return calendar.timegm(time.strptime(bkname[len(prefix):],
+                                             _TIME_FORMAT))
+    except ValueError:
+        return None
+
+def backups(name):
+    '''[(time, ID)] of the backups of an image, oldest first'''
+    ret = []
+    for image in glance.glance_list(**{_PROPERTY: name}):
+        when = backup_time(name, image['name'])
+        if when is not None:
+            ret.append((when, image['id']))
+    return sorted(ret)
+
+def expired(bklist, keep=_KEEP, max_age=None, now=None):
+    '''IDs of the backups beyond the keep most recent ones, or older than
+    max_age seconds, from a backups() list
+    '''
+    if now is None:
+        now = time.time()
+    ret = []
+    if keep is not None:
+        ret += [imgid for _, imgid in bklist[:max(len(bklist) - keep, 0)]]
+    if max_age is not None:
+        ret += [imgid for when, imgid in bklist
+                if now - when > max_age and imgid not in ret]
+    return ret
+
+def prune(name, keep=_KEEP, max_age=None, now=None):
+    '''Delete the expired backups of an image'''
+    try:
+        ids = expired(backups(name), keep, max_age, now)
+    except glance.GlanceError as exc:
+        vprint(str(exc))
+        return False
+    ret = True
+    for imgid, error in sorted(glance.glance_delete_bulk(ids).items()):
+        if error is None:
+            vprint('%s: deleted expired backup: %s' % (name, imgid))
+        else:
+            vprint('%s: cannot delete expired backup: %s' % (name, error))
+            ret = False
+    return ret
+
+def keep_image(name, strategy, now=None):
+    '''Rename the images with that name out of the way, marked as backups,
+    and deactivate or tag them according to strategy
+    '''
+    bkname = backup_name(name, now)
+    for imgid in sorted(glance.glance_ids(name)):
+        vprint('%s: backing up %s as "%s"' % (name, imgid, bkname))
+        if not glance.glance_update(imgid, '--name', bkname, '--property',
+                                    '%s=%s' % (_PROPERTY, name)):
+            return False
+        if strategy == 'deactivate' and not glance.glance_deactivate(imgid):
+            return False
+        if strategy == 'tag' and not glance.glance_tag(imgid, _TAG):
+            return False
+    return True
+
+def get_compressor():
+    '''(extension, command line) of the compressor of local backups, the
+    command line is None for the in-process gzip compressor
+    '''
+    for ext, cmd in _COMPRESSORS:
+        path = find_executable(cmd[0])
+        if path:
+            return ext, [path] + cmd[1:]
+    return '.gz', None
+
+def glance_checksums(infos):
+    '''{algorithm: digest} recorded by glance, from image-show properties'''
+    ret = {}
+    if infos.get('checksum'):
+        ret['md5'] = infos['checksum']
+    algo = infos.get('os_hash_algo')
+    if algo and infos.get('os_hash_value'):
+        try:
+            multihash.hash2len(algo)
+            ret[algo] = infos['os_hash_value']
+        except KeyError:
+            vprint('unsupported glance hash algorithm: ' + algo)
+    return ret
+
+class BackupWriter(object):
+    '''Compress data written in chunks into a backup file, hashing the
+    uncompressed data on the way. The file only gets its final name, next to
+    its manifest, when committed.
+    '''
+
+    def __init__(self, fname, algos=('md5',), compressor=None):
+        self.ext, cmd = compressor or get_compressor()
+        self.fname = fname + self.ext
+        self.tmp_name = self.fname + '.part'
+        self.manifest_name = fname + _MANIFEST_EXT
+        self.mhash = multihash.multihash_hashlib(algos)
+        self.size = 0
+        self.proc = None
+        self.ok = None
+        self.fout = open(self.tmp_name, 'wb')
+        try:
+            if cmd is None:
+                self.zout = gzip.GzipFile(os.path.basename(fname), 'wb', 1,
+                                          self.fout)
+            else:
+                self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                             stdout=self.fout)
+                self.zout = self.proc.stdin
+        except OSError:
+            self.fout.close()
+            os.remove(self.tmp_name)
+            raise
+
+    def write(self, data):
+        self.mhash.update(data)
+        self.size += len(data)
+        self.zout.write(data)
+
+    def close(self):
+        '''End of data, return True if all of it was compressed'''
+        if self.ok is None:
+            try:
+                self.zout.close()
+                self.ok = True
+            except IOError:
+                self.ok = False
+            if self.proc is not None:
+                self.ok = self.proc.wait() == 0 and self.ok
+            self.fout.close()
+            if not self.ok:
+                vprint(self.fname + ': compression failed')
+        return self.ok
+
+    def abort(self):
+        '''Drop the backup file'''
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+        self.close()
+        os.remove(self.tmp_name)
+
+    def commit(self, manifest):
+        '''Put the backup file in place, with its manifest'''
+        manifest = dict(manifest, file=os.path.basename(self.fname),
+                        compression=self.ext,
+                        compressed_size=os.path.getsize(self.tmp_name))
+        with open(self.manifest_name + '.part', 'w') as fout:
+            json.dump(manifest, fout, indent=2, sort_keys=True)
+        os.rename(self.manifest_name + '.part', self.manifest_name)
+        os.rename(self.tmp_name, self.fname)
+
+def verify(fname, digests, expected):
+    '''Check computed {algorithm: digest} against the expected ones'''
+    for algo, digest in sorted(expected.items()):
+        if digests[algo] != digest.lower():
+            vprint('%s: %s: expected: %s' % (fname, algo, digest))
+            vprint('%s: %s: computed: %s' % (fname, algo, digests[algo]))
+            return False
+        vprint('%s: %s: OK' % (fname, algo))
+    if not expected:
+        vprint(fname + ': no checksum recorded by glance to verify')
+    return True
+
+def download_id(name, imgid, backupdir, compressor=None, now=None,
+                store=False, fname=None):
+    '''Download an image to a compressed, verified file in the backup
+    directory, named fname (default: the image name), or into its chunk
+    store
+    '''
+    infos = openstack_out.map_block(glance.glance_show(imgid) or '')
+    expected = glance_checksums(infos)
+    algos = sorted(set(expected) | set(['md5']))
+    try:
+        if store:
+            store = chunkstore.ChunkStore(backupdir)
+            writer = store.writer(name, algos, now)
+        else:
+            writer = BackupWriter(os.path.join(backupdir, fname or name),
+                                  algos, compressor)
+    except (IOError, OSError) as exc:
+        vprint('%s: cannot backup: %s' % (name, exc))
+        return False
+    vprint('%s: backing up %s to %s' % (name, imgid, writer.fname))
+    digests = None
+    if glance.glance_stream(imgid, writer) and writer.close():
+        digests = writer.mhash.hexdigests()
+    if digests is None or not verify(writer.fname, digests, expected):
+        writer.abort()
+        return False
+    manifest = {
+        'name': name,
+        'id': imgid,
+        'disk_format': infos.get('disk_format'),
+        'container_format': infos.get('container_format'),
+        'created': time.strftime(_TIME_FORMAT, time.gmtime(now)),
+        'size': writer.size,
+        'checksums': digests,
+        'verified': bool(expected),
+    }
+    try:
+        writer.commit(manifest)
+    except (IOError, OSError) as exc:
+        vprint('%s: cannot backup: %s' % (name, exc))
+        return False
+    return True
+
+def download_image(name, backupdir, compressor=None, now=None,
+                   store=False):
+    '''Download the images with that name to compressed, verified files in
+    the backup directory, or into its chunk store, prior to deleting them.
+    Return the IDs of the images backed up, None if any of them could not be
+    '''
+    if not os.path.exists(backupdir):
+        os.mkdir(backupdir)
+    elif not os.path.isdir(backupdir):
+        vprint(backupdir + ' exists but is not a directory, sorry '
+               'cannot backup old images...')
+        return None
+    ids = sorted(glance.glance_ids(name))
+    if not ids:
+        return None
+    for imgid in ids:
+        # Several images with that name: one file each
+        fname = '%s_%s' % (name, imgid) if len(ids) > 1 else name
+        if not download_id(name, imgid, backupdir, compressor, now, store,
+                           fname):
+            return None
+    return ids
+
+def store_version(name, imgid, backupdir, now=None):
+    '''Back up an image into the chunk store of the backup directory, as
+    the latest version of name, unless it already is
+    '''
+    store = chunkstore.ChunkStore(backupdir)
+    versions = store.versions(name)
+    if versions:
+        try:
+            latest = chunkstore.load_manifest(versions[-1][1])
+        except chunkstore.ChunkStoreError as exc:
+            vprint(str(exc))
+            latest = {}
+        if latest.get('id') == imgid:
+            vprint('%s: %s already backed up' % (name, imgid))
+            return True
+    return download_id(name, imgid, backupdir, now=now, store=True)
+
+def restore_latest(name, backupdir, outdir):
+    '''Restore the latest backup of an image kept in the backup directory,
+    from its chunk store or from a single file, into outdir. Return the
+    restored file name, None if there is no usable backup
+    '''
+    fname = os.path.join(outdir, name)
+    store = chunkstore.ChunkStore(backupdir)
+    versions = store.versions(name)
+    if versions:
+        try:
+            with open(fname, 'wb') as fout:
+                store.restore(versions[-1][1], fout)
+            return fname
+        except (IOError, OSError, chunkstore.ChunkStoreError) as exc:
+            vprint('%s: cannot restore: %s' % (versions[-1][1], exc))
+            if os.path.exists(fname):
+                os.remove(fname)
+    manifest_name = os.path.join(backupdir, name + _MANIFEST_EXT)
+    if not os.path.exists(manifest_name):
+        return None
+    try:
+        manifest = chunkstore.load_manifest(manifest_name)
+        decomp = decompressor.Decompressor(
+            os.path.join(backupdir, manifest['file']),
+            size=manifest.get('size'), outdir=outdir)
+        ret, fname = decomp.doit()
+    except (KeyError, chunkstore.ChunkStoreError,
+            decompressor.DecompressorError) as exc:
+        vprint('%s: cannot restore: %s' % (manifest_name, exc))
+        return None
+    return fname if ret else None
+
+def prune_store(name, backupdir, keep=_KEEP, max_age=None, now=None):
+    '''Forget the expired versions of an image in the chunk store, and
+    remove the chunks no other version uses
+    '''
+    store = chunkstore.ChunkStore(backupdir)
+    try:
+        for fname in expired(store.versions(name), keep, max_age, now):
+            vprint('%s: forgetting expired backup: %s' % (name, fname))
+            store.remove_version(fname)
+        removed, freed = store.gc()
+    except (IOError, OSError, chunkstore.ChunkStoreError) as exc:
+        vprint('%s: %s' % (name, exc))
+        return False
+    vprint('%s: removed %d unused chunks, %s' % (name, removed, size_t(freed)))
+    return True
+
+def backup_image(name, strategy='rename', backupdir=None, keep=_KEEP,
+                 max_age=None, now=None):
+    '''Get the images with that name out of the way of their replacement,
+    backing them up according to strategy. Failing to delete expired backups
+    is not an error.
+    '''
+    quiet = not utils.get_verbose()
+    if strategy == 'none':
+        return glance.glance_delete(name, quiet=quiet)
+    if strategy in ('download', 'store'):
+        # Only the images backed up are deleted
+        ids = download_image(name, backupdir, now=now,
+                             store=(strategy == 'store'))
+        if ids is None:
+            return False
+        if strategy == 'store':
+            prune_store(name, backupdir, keep, max_age, now)
+        return glance.glance_delete_ids(ids, quiet=quiet)
+    if not keep_image(name, strategy, now):
+        return False
+    prune(name, keep, max_age, now)
+    return True
+
+def main(sys_argv=sys.argv[1:]):
+    '''List the backups of images, deleting the expired ones on request'''
+    parser = argparse.ArgumentParser(
+        description='List & prune the backups of images kept in glance')
+
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Display additional information')
+
+    parser.add_argument('-P', '--prune', action='store_true',
+                        help='Delete expired backups')
+
+    parser.add_argument('-K', '--keep', type=int, default=_KEEP,
+                        help='Number of backups to keep (default: %d)' % _KEEP)
+
+    parser.add_argument('-A', '--max-age', type=float, default=None,
+                        metavar='DAYS', help='Maximum age of backups to keep')
+
+    parser.add_argument(dest='names', nargs='+', metavar='NAME',
+                        help='image names')
+
+    args = parser.parse_args(sys_argv)
+    if args.verbose:
+        utils.set_verbose(True)
+
+    max_age = args.max_age * _DAY if args.max_age is not None else None
+    ret = True
+    for name in args.names:
+        if args.prune:
+            ret = prune(name, args.keep, max_age) and ret
+        try:
+            for when, imgid in backups(name):
+                print(name, imgid, time.strftime(_TIME_FORMAT,
+                                                 time.gmtime(when)))
+        except glance.GlanceError as exc:
+            vprint(str(exc))
+            ret = False
+    return ret
+
+if __name__ == '__main__': # pragma: no cover
+    main()
@@ -0,0 +1,430 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2016 Vincent Legoll <vincent.legoll@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Deduplicating store of image backups: images are split into chunks at
+content-defined boundaries, each chunk is stored once, compressed, under its
+SHA-256, and each backed up image version is a manifest listing its chunks.
+Successive versions of an image share most of their chunks, so keeping many
+of them costs little more than keeping one.
+
+Chunk boundaries are only looked for between 4KB blocks, where the CRC32 of
+the block before matches a mask: disk images change by whole blocks, and
+hashing blocks, instead of rolling a hash over every byte, runs at the speed
+of zlib.
+
+Layout of the store directory:
+
+    chunks/<2 first hex digits>/<SHA-256>
+    manifests/<image name>/<UTC timestamp>[-<sequence number>].json
+    .writer-<random>.lock
+
+Restoring an image concatenates its chunks, verified on the way. Chunks not
+referenced by any manifest are removed by gc(), except the ones of the
+backups being written: each writer holds a lock file, that it touches as it
+goes.
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import zlib
+import errno
+import hashlib
+import argparse
+import calendar
+import tempfile
+
+import utils
+import multihash
+
+from utils import vprint, size_t
+
+_BLOCK_SIZE = 4 * 1024
+
+_MIN_CHUNK = 256 * 1024
+
+_MAX_CHUNK = 4 * 1024 * 1024
+
+# A boundary after 1 block in 256, past the minimum chunk size
+_MASK = 0xff
+
+_TIME_FORMAT = '%Y%m%dT%H%M%SZ'
+
+# Unreferenced chunks more recent than that may belong to a backup being
+# written, and are kept by gc()
+_GC_GRACE = 60 * 60
+
+# Writers not heard of for that long are dead, their lock files removed
+_LOCK_TIMEOUT = 60 * 60
+
+_LOCK_PREFIX = '.writer-'
+_LOCK_SUFFIX = '.lock'
+
+class ChunkStoreError(Exception):
+    '''Class to allow catching exceptions from this module'''
+
+class Chunker(object):
+    '''Split data written in pieces of any size into content-defined chunks,
+    passed to callback as they are complete
+    '''
+
+    def __init__(self, callback, min_size=_MIN_CHUNK, max_size=_MAX_CHUNK,
+                 mask=_MASK):
+        self.callback = callback
+        self.min_size = min_size
+        self.max_size = max_size
+        self.mask = mask
+        self.blocks = []
+        self.size = 0
+        self.tail = b''
+
+    def _cut(self):
+        if self.blocks:
+            self.callback(b''.join(self.blocks))
+        self.blocks = []
+        self.size = 0
+
+    def write(self, data):
+        data = self.tail + data
+        end = len(data) - len(data) % _BLOCK_SIZE
+        for pos in range(0, end, _BLOCK_SIZE):
+            block = data[pos:pos + _BLOCK_SIZE]
+            self.blocks.append(block)
+            self.size += _BLOCK_SIZE
+            if self.size >= self.max_size or (
+                    self.size >= self.min_size and
+                    zlib.crc32(block) & self.mask == 0):
+                self._cut()
+        self.tail = data[end:]
+
+    def flush(self):
+        '''End of data: pass the last chunk'''
+        if self.tail:
+            self.blocks.append(self.tail)
+            self.tail = b''
+        self._cut()
+
+def version_key(fname):
+    '''(time, sequence number) of an image version, from its manifest file
+    name, None if it is not one
+    '''
+    stamp, _, seq = os.path.splitext(os.path.basename(fname))[0].partition('-')
+    try:
+        return (calendar.timegm(time.strptime(stamp, _TIME_FORMAT)),
+                int(seq or 0))
+    except ValueError:
+        return None
+
+def version_time(fname):
+    '''Time an image version was backed up at, from its manifest file name'''
+    key = version_key(fname)
+    return key[0] if key is not None else None
+
+def load_manifest(fname):
+    try:
+        with open(fname) as fin:
+            return json.load(fin)
+    except (IOError, ValueError) as exc:
+        raise ChunkStoreError('%s: cannot load manifest: %s' % (fname, exc))
+
+class ChunkStore(object):
+    '''Store of image versions in a directory, as chunks & manifests'''
+
+    def __init__(self, root):
+        self.root = root
+        self.chunks_dir = os.path.join(root, 'chunks')
+        self.manifests_dir = os.path.join(root, 'manifests')
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunks_dir, digest[:2], digest)
+
+    def put(self, data):
+        '''Store a chunk, unless already there, return its digest and
+        whether it was added
+        '''
+        digest = hashlib.sha256(data).hexdigest()
+        fname = self.chunk_path(digest)
+        if os.path.exists(fname):
+            # Protect it from a concurrent gc()
+            os.utime(fname, None)
+            return digest, False
+        utils.write_atomic(fname, zlib.compress(data, 1))
+        return digest, True
+
+    def get(self, digest):
+        '''Data of a chunk, verified'''
+        try:
+            with open(self.chunk_path(digest), 'rb') as fin:
+                data = zlib.decompress(fin.read())
+        except (IOError, zlib.error) as exc:
+            raise ChunkStoreError('chunk %s: %s' % (digest, exc))
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ChunkStoreError('chunk %s: corrupted' % digest)
+        return data
+
+    def names(self):
+        '''Names of the images with versions in the store'''
+        if not os.path.isdir(self.manifests_dir):
+            return []
+        return sorted(os.listdir(self.manifests_dir))
+
+    def versions(self, name):
+        '''[(time, manifest file name)] of the versions of an image, oldest
+        first
+        '''
+        dirname = os.path.join(self.manifests_dir, name)
+        if not os.path.isdir(dirname):
+            return []
+        ret = []
+        for fname in os.listdir(dirname):
+            key = version_key(fname)
+            if key is not None and fname.endswith('.json'):
+                ret.append((key, os.path.join(dirname, fname)))
+        return [(key[0], fname) for key, fname in sorted(ret)]
+
+    def add_version(self, manifest, now=None):
+        '''Record an image version, return its manifest file name. Versions
+        backed up in the same second get a sequence number
+        '''
+        base = os.path.join(self.manifests_dir, manifest['name'],
+                            time.strftime(_TIME_FORMAT, time.gmtime(now)))
+        data = json.dumps(manifest, indent=2, sort_keys=True)
+        seq = 0
+        while True:
+            fname = base + ('-%d' % seq if seq else '') + '.json'
+            try:
+                utils.write_atomic(fname, data, 'w', overwrite=False)
+                return fname
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+            seq += 1
+
+    def remove_version(self, fname):
+        '''Forget an image version, its chunks are left to gc()'''
+        os.remove(fname)
+        dirname = os.path.dirname(fname)
+        if not os.listdir(dirname):
+            os.rmdir(dirname)
+
+    def restore(self, fname, fout):
+        '''Write an image version to a file object, verifying its chunks, and
+        its checksums at the end
+        '''
+        manifest = load_manifest(fname)
+        mhash = multihash.multihash_hashlib(manifest['checksums'])
+        for digest, size in manifest['chunks']:
+            data = self.get(digest)
+            if len(data) != size:
+                raise ChunkStoreError('chunk %s: wrong size' % digest)
+            mhash.update(data)
+            fout.write(data)
+        for algo, digest in sorted(mhash.hexdigests().items()):
+            if digest != manifest['checksums'][algo]:
+                raise ChunkStoreError('%s: %s mismatch' % (fname, algo))
+        return True
+
+    def writer(self, name, algos=('md5',), now=None):
+        return StoreWriter(self, name, algos, now)
+
+    def lock(self):
+        '''Create a writer lock file, holding its creation time, return its
+        name
+        '''
+        utils.makedirs(self.root)
+        fdesc, fname = tempfile.mkstemp(dir=self.root, prefix=_LOCK_PREFIX,
+                                        suffix=_LOCK_SUFFIX)
+        with os.fdopen(fdesc, 'w') as fout:
+            # Same clock as the chunks modification times
+            fout.write(repr(os.fstat(fout.fileno()).st_mtime))
+        return fname
+
+    def writing_since(self, now=None):
+        '''Oldest creation time of the lock files of live writers, None if
+        there are none. The lock files of dead ones are removed
+        '''
+        if now is None:
+            now = time.time()
+        ret = None
+        if not os.path.isdir(self.root):
+            return ret
+        for fname in os.listdir(self.root):
+            if not (fname.startswith(_LOCK_PREFIX) and
+                    fname.endswith(_LOCK_SUFFIX)):
+                continue
+            path = os.path.join(self.root, fname)
+            try:
+                if now - os.path.getmtime(path) >= _LOCK_TIMEOUT:
+                    vprint('%s: removing stale writer lock' % path)
+                    os.remove(path)
+                    continue
+                with open(path) as fin:
+                    started = float(fin.read())
+            except (IOError, OSError, ValueError):
+                # Released concurrently, or being created
+                continue
+            if ret is None or started < ret:
+                ret = started
+        return ret
+
+    def referenced(self):
+        '''Digests of the chunks referenced by the manifests'''
+        ret = set()
+        for name in self.names():
+            for _, fname in self.versions(name):
+                ret.update(digest for digest, _ in
+                           load_manifest(fname)['chunks'])
+        return ret
+
+    def gc(self, grace=_GC_GRACE, now=None):
+        '''Remove the chunks, and leftover temporary files, no manifest
+        refers to, unless more recent than grace seconds, or than the start
+        of a live writer. Return the number of files & bytes removed
+        '''
+        if now is None:
+            now = time.time()
+        since = self.writing_since(now)
+        keep = self.referenced()
+        removed, freed = 0, 0
+        if not os.path.isdir(self.chunks_dir):
+            return removed, freed
+        for subdir in os.listdir(self.chunks_dir):
+            dirname = os.path.join(self.chunks_dir, subdir)
+            for fname in os.listdir(dirname):
+                if fname in keep:
+                    continue
+                path = os.path.join(dirname, fname)
+                stat = os.stat(path)
+                if now - stat.st_mtime < grace:
+                    continue
+                if since is not None and stat.st_mtime >= since:
+                    continue
+                os.remove(path)
+                removed += 1
+                freed += stat.st_size
+        return removed, freed
+
+class StoreWriter(object):
+    '''Chunk data written in pieces into a store, hashing it on the way. The
+    image version is only recorded by commit(), as backed up at now. Same
+    interface as backup.BackupWriter
+    '''
+
+    def __init__(self, store, name, algos=('md5',), now=None):
+        self.store = store
+        self.name = name
+        self.now = now
+        self.fname = os.path.join(store.manifests_dir, name)
+        self.mhash = multihash.multihash_hashlib(algos)
+        self.size = 0
+        self.stored = 0
+        self.chunks = []
+        self.chunker = Chunker(self._put)
+        # Keeps gc() away from the chunks, until committed or aborted
+        self.lock_name = store.lock()
+
+    def _put(self, data):
+        digest, added = self.store.put(data)
+        self.chunks.append([digest, len(data)])
+        if added:
+            self.stored += len(data)
+        # Still alive
+        os.utime(self.lock_name, None)
+
+    def _unlock(self):
+        if self.lock_name is not None:
+            os.remove(self.lock_name)
+            self.lock_name = None
+
+    def write(self, data):
+        self.mhash.update(data)
+        self.size += len(data)
+        self.chunker.write(data)
+
+    def close(self):
+        '''End of data, return True if all of it was stored'''
+        try:
+            self.chunker.flush()
+        except (IOError, OSError) as exc:
+            vprint('%s: %s' % (self.fname, exc))
+            return False
+        return True
+
+    def abort(self):
+        '''Drop the image version, its chunks are left to gc()'''
+        self._unlock()
+
+    def commit(self, manifest):
+        '''Record the image version, with its chunks'''
+        try:
+            self.fname = self.store.add_version(dict(manifest,
+                                                     chunks=self.chunks),
+                                                self.now)
+        finally:
+            self._unlock()
+        vprint('%s: %s stored, %s new' % (self.fname, size_t(self.size),
+                                         size_t(self.stored)))
+
+def main(sys_argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description='Manage a deduplicating store of image backups')
+
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Display additional information')
+
+    parser.add_argument(dest='root', metavar='DIRECTORY',
+                        help='store directory, GLANCING_BACKUP_DIR for '
+                        'glancing.py backups')
+
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-r', '--restore', nargs=2,
+                       metavar=('MANIFEST', 'FILE'),
+                       help='restore the image version of a manifest')
+    group.add_argument('-g', '--gc', action='store_true',
+                       help='remove the chunks of forgotten image versions')
+
+    args = parser.parse_args(sys_argv)
+    if args.verbose:
+        utils.set_verbose(True)
+
+    store = ChunkStore(args.root)
+    try:
+        if args.restore:
+            manifest, fname = args.restore
+            with open(fname, 'wb') as fout:
+                return store.restore(manifest, fout)
+        if args.gc:
+            removed, freed = store.gc()
+            vprint('removed %d chunks, %s' % (removed, size_t(freed)))
+            return True
+        for name in store.names():
+            for _, fname in store.versions(name):
+                manifest = load_manifest(fname)
+                print(fname, manifest.get('id'), manifest['size'],
+                      len(manifest['chunks']))
+    except (IOError, OSError, ChunkStoreError) as exc:
+        vprint(str(exc))
+        return False
+    return True
+
+if __name__ == '__main__': # pragma: no cover
+    main()
@@ -22,12 +22,45 @@ bnary data files
 '''
 
 import os
+import re
 import sys
 import bz2
+import zlib
 import gzip
+import tarfile
+import fnmatch
+import json
+import struct
+import argparse
+import hashlib
 import zipfile
+import tempfile
+import functools
+import itertools
+import subprocess
+import multiprocessing
+
+try:
+    from shutil import which as find_executable
+except ImportError:
+    from distutils.spawn import find_executable
+
+# Optional modules, else only the external decoders can be used
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 import utils
+import zindex
 from utils import vprint
 
 class DecompressorError(Exception):
@@ -41,21 +74,716 @@ def zip_opener(fname, _):
         vprint('Archive contains more than one file: ' + fname)
     return zipf.open(zipf.namelist()[0])
 
+def xz_opener(fname, mode):
+    '''Open a .xz or .lzma file and return a file-like object for it'''
+    if lzma is None:
+        raise DecompressorError('No lzma module to open: ' + fname)
+    return lzma.open(fname, mode)
+
+def zstd_opener(fname, mode):
+    '''Open a .zst file and return a file-like object for it'''
+    if zstandard is None:
+        raise DecompressorError('No zstandard module to open: ' + fname)
+    return zstandard.open(fname, mode)
+
+# Tar bundles of disk images, e.g. OVA appliances: tarfile handles their
+# compression, if any
+_TAR_EXTS = ('.tar', '.ova', '.tgz', '.tar.gz', '.tbz2', '.tar.bz2', '.tar.xz')
+
+def bundle_ext(fname):
+    '''Return the tar bundle extension of a file name, or None'''
+    for ext in sorted(_TAR_EXTS, key=len, reverse=True):
+        if fname.endswith(ext):
+            return ext
+    return None
+
+# Names of the disk image members of compressed bundles, looked for first
+# not to read the whole bundle twice, to find the largest member
+_DISK_PATTERNS = ('*.vmdk', '*.qcow2', '*.img', '*.raw', '*.vhd', '*.vhdx',
+                  '*.vdi')
+
+def select_member(members, pattern=None):
+    '''Pick the disk image among the members of a tar bundle: the first
+    regular file whose name matches pattern, or one of a tuple of patterns,
+    else the largest one
+    '''
+    if pattern is not None:
+        patterns = pattern if isinstance(pattern, tuple) else (pattern,)
+        for member in members:
+            if member.isfile() and any(
+                    fnmatch.fnmatch(member.name, pat) or
+                    fnmatch.fnmatch(os.path.basename(member.name), pat)
+                    for pat in patterns):
+                return member
+        return None
+    files = [member for member in members if member.isfile()]
+    if not files:
+        return None
+    return max(files, key=lambda member: member.size)
+
+class TarMember(object):
+    '''File-like object for a member of a tar bundle, the bundle is closed
+    with it
+    '''
+
+    def __init__(self, tarf, member):
+        self.tarf = tarf
+        self.name = member.name
+        self.size = member.size
+        self.fileobj = tarf.extractfile(member)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self.fileobj.read()
+        return self.fileobj.read(size)
+
+    def close(self):
+        self.fileobj.close()
+        self.tarf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+def tar_open(source, pattern=None):
+    '''Open the disk image member of a tar bundle, see select_member(),
+    without extracting anything. source is a file name or a file-like
+    object. The bundle is read in a single forward pass, and only up to the
+    member, except for a bundle file without pattern: an uncompressed one
+    has all its member headers read first, to find the largest one, a
+    compressed one is searched for a member named like a disk image, and
+    only read again for the largest one if there is none.
+    '''
+    if hasattr(source, 'read'):
+        if pattern is None:
+            raise DecompressorError('Streamed tar bundle: a member name '
+                                    'pattern is needed')
+        return tar_member(tarfile.open(fileobj=source, mode='r|*'), pattern)
+    if pattern is not None:
+        return tar_member(tarfile.open(source, 'r|*'), pattern)
+    if detect_format(source) != '.tar':
+        try:
+            return tar_member(tarfile.open(source, 'r|*'), _DISK_PATTERNS)
+        except DecompressorError:
+            vprint('No disk image name in tar bundle, reading it again')
+    return tar_member(tarfile.open(source, 'r:*'))
+
+def tar_member(tarf, pattern=None):
+    '''Open the member of an open tar bundle picked by select_member(),
+    the bundle is closed with it
+    '''
+    try:
+        if pattern is None:
+            member = select_member(tarf.getmembers())
+        else:
+            member = select_member(tarf, pattern)
+        if member is None:
+            raise DecompressorError('No %s member in tar bundle' %
+                                    (pattern or 'file',))
+        vprint('Tar bundle member: %s (%s)' %
+               (member.name, utils.size_t(member.size)))
+        return TarMember(tarf, member)
+    except:
+        tarf.close()
+        raise
+
+def tar_opener(fname, _, member=None):
+    '''Open a tar bundle and return a file-like object for its disk image
+    member
+    '''
+    vprint('Opening tar bundle: ' + fname)
+    return tar_open(fname, member)
+
 _EXT_MAP = {
     '.gz': gzip.open,
     '.bz2': bz2.BZ2File,
     '.zip': zip_opener,
+    '.xz': xz_opener,
+    '.lzma': xz_opener,
+    '.zst': zstd_opener,
 }
+_EXT_MAP.update((ext, tar_opener) for ext in _TAR_EXTS)
 
 def get_ext_map():
     return _EXT_MAP
 
+# First bytes of each file format, in the order they're checked
+_MAGICS = (
+    (b'\x1f\x8b', '.gz'),
+    (b'BZh', '.bz2'),
+    (b'PK\x03\x04', '.zip'),
+    (b'\xfd7zXZ\x00', '.xz'),
+    (b'\x28\xb5\x2f\xfd', '.zst'),
+    (b'QFI\xfb', 'qcow2'),
+)
+
+# Tar headers have theirs at an offset
+_TAR_MAGIC = b'ustar'
+_TAR_MAGIC_OFFSET = 257
+
+# Raw disk images: boot sector signature (MBR partition table, FAT & NTFS
+# filesystems...), GPT header in the second sector
+_RAW_MAGICS = (
+    (510, b'\x55\xaa'),
+    (512, b'EFI PART'),
+)
+
+_MAGIC_SIZE = 520
+
+def lzma_alone(data):
+    '''Tell if data starts with a "lzma_alone" header. The format has no
+    magic: check the header fields the way xz does, a properties byte, a
+    dictionary size of 2^n or 2^n + 2^(n-1) bytes, and an uncompressed size
+    either unknown or below 256GB
+    '''
+    if len(data) < 13:
+        return False
+    props, dict_size, size = struct.unpack('<BIQ', data[:13])
+    if props >= 9 * 5 * 5:
+        return False
+    if size != 2 ** 64 - 1 and size >= 2 ** 38:
+        return False
+    if dict_size == 0 or dict_size > 3 * 2 ** 30:
+        return False
+    bits = dict_size.bit_length() - 1
+    return dict_size in (1 << bits, (3 << bits) >> 1)
+
+def detect_magic(data):
+    '''Return the format of data from its first bytes: a compressed file
+    extension, '.tar' for bundles, 'qcow2', 'raw' for a known raw disk image
+    signature, or 'unknown'. None if there is not enough data.
+    '''
+    if not data:
+        return None
+    for magic, fmt in _MAGICS:
+        if data.startswith(magic):
+            return fmt
+    if lzma_alone(data):
+        return '.lzma'
+    if data[_TAR_MAGIC_OFFSET:_TAR_MAGIC_OFFSET + len(_TAR_MAGIC)] == _TAR_MAGIC:
+        return '.tar'
+    for offset, magic in _RAW_MAGICS:
+        if data[offset:offset + len(magic)] == magic:
+            return 'raw'
+    # Blank first sector, as in unpartitioned filesystem images
+    if not data[:_MAGIC_SIZE].strip(b'\0'):
+        return 'raw'
+    return 'unknown'
+
+def detect_format(fname):
+    '''Return the format of a file from its first bytes, see detect_magic()
+    '''
+    try:
+        with open(fname, 'rb') as fin:
+            return detect_magic(fin.read(_MAGIC_SIZE))
+    except IOError:
+        return None
+
+def is_compressed(fmt):
+    '''Tell if a format from detect_magic() needs decompression'''
+    return fmt in _EXT_MAP
+
+def is_uncompressed(fmt):
+    '''Tell if a format from detect_magic() is positively not compressed:
+    unknown data may still be compressed with a format without magic
+    '''
+    return fmt in ('raw', 'qcow2')
+
+# Compression names found in metadata, that are not file extensions
+_COMPRESSION_ALIASES = {
+    'gzip': '.gz',
+    'bzip2': '.bz2',
+    'zstd': '.zst',
+}
+
+def compression_ext(compression):
+    '''Return the file extension for a compression name from metadata, or
+    None for uncompressed data
+    '''
+    if not compression or compression.lower() == 'none':
+        return None
+    name = compression.lower().lstrip('.')
+    return _COMPRESSION_ALIASES.get(name, '.' + name)
+
+_STREAM_MAP = {
+    '.gz': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    '.bz2': bz2.BZ2Decompressor,
+}
+if lzma is not None:
+    _STREAM_MAP['.xz'] = _STREAM_MAP['.lzma'] = lzma.LZMADecompressor
+
+_LZMAError = lzma.LZMAError if lzma is not None else IOError
+
+class StreamDecompressor(object):
+    '''Incremental decompression of data coming in chunks, for example
+    from the network, handling concatenated multi-stream files.
+    Zip archives cannot be handled that way, their directory is at the end.
+    '''
+
+    def __init__(self, ext):
+        if ext not in _STREAM_MAP:
+            raise DecompressorError('Cannot stream decompress: ' + str(ext))
+        self.factory = _STREAM_MAP[ext]
+        self.dec = self.factory()
+
+    def decompress(self, data):
+        '''Return the uncompressed data available after feeding data'''
+        ret = []
+        while data:
+            try:
+                ret.append(self.dec.decompress(data))
+            except (IOError, EOFError, zlib.error, _LZMAError) as exc:
+                raise DecompressorError('Corrupted stream: ' + str(exc))
+            # End of a stream: the next one starts in unused_data
+            data = self.dec.unused_data
+            if data:
+                self.dec = self.factory()
+        return b''.join(ret)
+
+    def finished(self):
+        '''Tell if the current stream reached its end'''
+        if hasattr(self.dec, 'eof'):
+            return self.dec.eof
+        if hasattr(self.dec, 'copy'):
+            # Python 2 zlib: past its end, a stream leaves fed data unused
+            probe = self.dec.copy()
+            try:
+                probe.decompress(b'\0')
+            except zlib.error:
+                return False
+            return probe.unused_data == b'\0'
+        # Python 2 BZ2Decompressor raises EOFError past its end
+        try:
+            self.dec.decompress(b'')
+        except EOFError:
+            return True
+        return False
+
+    def flush(self):
+        '''Return remaining data, fail on truncated input'''
+        if not self.finished():
+            raise DecompressorError('Truncated compressed stream')
+        return self.dec.flush() if hasattr(self.dec, 'flush') else b''
+
+class DecompressingReader(object):
+    '''Read decompressed data from a compressed file, given by name or as a
+    file-like object, in a single pass. Use as a context manager, and either
+    iterate over decompressed blocks, or call read() / readinto().
+
+    on_input and on_output are called back with each block of compressed
+    data read, and of uncompressed data produced: for example to compute
+    message digests of both at once.
+
+    The format is detected from the first bytes, the ext label is only used
+    when there is not enough data to decide. Uncompressed data goes through
+    unchanged. A file-like source is closed with the reader if close_source
+    is True, a named one always is.
+    '''
+
+    def __init__(self, source, ext=None, block_size=64 * 1024,
+                 on_input=None, on_output=None, close_source=None):
+        if block_size < 1:
+            raise IOError('Wrong block_size')
+        self.close_source = close_source
+        if not hasattr(source, 'read'):
+            source = open(source, 'rb')
+            self.close_source = True
+        self.fin = source
+        self.block_size = block_size
+        self.on_input = on_input
+        self.on_output = on_output
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.buf = b''
+        self.eof = False
+        try:
+            self.first = self.fin.read(block_size)
+            self.detected = detect_magic(self.first)
+            self.ext = ext
+            if is_compressed(self.detected):
+                self.ext = self.detected
+            elif is_uncompressed(self.detected):
+                self.ext = None
+            if self.ext in _TAR_EXTS:
+                # Bundles go through as is, see tar_open()
+                self.ext = None
+            self.stream = None
+            if self.ext is not None:
+                self.stream = StreamDecompressor(self.ext)
+        except:
+            self.close()
+            raise
+
+    def _next_block(self):
+        '''Return the next non-empty block of decompressed data, or None'''
+        while not self.eof:
+            if self.first is not None:
+                data, self.first = self.first, None
+            else:
+                data = self.fin.read(self.block_size)
+            if data:
+                self.bytes_in += len(data)
+                if self.on_input is not None:
+                    self.on_input(data)
+                out = data if self.stream is None else self.stream.decompress(data)
+            else:
+                self.eof = True
+                out = b'' if self.stream is None else self.stream.flush()
+            if out:
+                self.bytes_out += len(out)
+                if self.on_output is not None:
+                    self.on_output(out)
+                return out
+        return None
+
+    def __iter__(self):
+        if self.buf:
+            data, self.buf = self.buf, b''
+            yield data
+        for block in iter(self._next_block, None):
+            yield block
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.buf + b''.join(iter(self._next_block, None))
+            self.buf = b''
+            return data
+        while len(self.buf) < size:
+            block = self._next_block()
+            if block is None:
+                break
+            self.buf += block
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def peek(self, size):
+        '''Return up to size bytes of decompressed data, without consuming
+        them
+        '''
+        data = self.read(size)
+        self.buf = data + self.buf
+        return data
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if self.close_source:
+            self.fin.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+def detect_bundle(source):
+    '''Tell if a file, compressed or not, is a tar bundle'''
+    try:
+        with DecompressingReader(source) as reader:
+            return detect_magic(reader.peek(_MAGIC_SIZE)) == '.tar'
+    except (IOError, DecompressorError):
+        return False
+
+# External decoders, by order of preference, much faster than the python
+# modules, as they are multi-threaded: "-dc" decompresses to stdout. zstd
+# decoding is single-threaded, but still needs no python module
+_NATIVE_DECODERS = {
+    '.gz': (['pigz', '-dc'],),
+    '.bz2': (['lbzip2', '-dc'], ['pbzip2', '-dc']),
+    '.xz': (['xz', '-T0', '-dc'],),
+    '.lzma': (['xz', '--format=lzma', '-dc'],),
+    '.zst': (['zstd', '-q', '-dc'],),
+}
+
+_NATIVE_FOUND = None
+
+def get_native_decoders(refresh=False):
+    '''Return the command lines of the best external decoders available,
+    by file extension. They are looked up in PATH only once.
+    '''
+    global _NATIVE_FOUND
+    if _NATIVE_FOUND is None or refresh:
+        _NATIVE_FOUND = {}
+        for ext, cmds in _NATIVE_DECODERS.items():
+            for cmd in cmds:
+                path = find_executable(cmd[0])
+                if path:
+                    _NATIVE_FOUND[ext] = [path] + cmd[1:]
+                    break
+        for ext, cmd in sorted(_NATIVE_FOUND.items()):
+            vprint('native decoder for %s: %s' % (ext, cmd[0]))
+    return _NATIVE_FOUND
+
+# Start of a stream: bzip2 header followed by the magic of either a block or
+# the end of stream, gzip member header with sensible flags, XFL & OS bytes
+_STREAM_START_RE = {
+    '.bz2': re.compile(b'BZh[1-9](?:1AY&SY|\x17rE8P\x90)'),
+    '.gz': re.compile(b'\x1f\x8b\x08[\x00-\x1f][\x00-\xff]{4}'
+                      b'[\x00\x02\x04][\x00-\x0d\xff]'),
+}
+
+# Above that uncompressed size, a stream is not decompressed in a worker
+# process: its whole output is held in memory until written
+_MAX_STREAM_SIZE = 16 * 1024 * 1024
+
+# Bound of the worker output held in memory, waiting to be written
+_MAX_PENDING_SIZE = 256 * 1024 * 1024
+
+# Reads of compressed data by workers, small enough that the output of a
+# single one cannot exceed _MAX_STREAM_SIZE by much
+_STREAM_READ_SIZE = 64 * 1024
+
+_SCAN_BLOCK_SIZE = 1024 * 1024
+
+# Reads from external decoders' output
+_PIPE_BLOCK_SIZE = 1024 * 1024
+
+def find_streams(fname, ext):
+    '''Return the [start, end) byte ranges of the streams found in a
+    multi-stream compressed file. Some may be false positives, from
+    compressed data looking like a stream header.
+    '''
+    regex = _STREAM_START_RE[ext]
+    overlap = 16
+    starts = []
+    offset = 0
+    tail = b''
+    with open(fname, 'rb') as fin:
+        while True:
+            block = fin.read(_SCAN_BLOCK_SIZE)
+            if not block:
+                break
+            data = tail + block
+            base = offset - len(tail)
+            for match in regex.finditer(data):
+                if not starts or base + match.start() > starts[-1]:
+                    starts.append(base + match.start())
+            offset += len(block)
+            tail = data[-overlap:]
+    if not starts or starts[0] != 0:
+        return []
+    return list(zip(starts, starts[1:] + [offset]))
+
+def decompress_stream(job):
+    '''Decompress a single stream from a byte range of a file.
+    Return its data, or None if the range is not exactly one stream, or if
+    it decompresses to more than _MAX_STREAM_SIZE.
+    '''
+    fname, ext, start, end = job
+    dec = StreamDecompressor(ext)
+    out = []
+    size = 0
+    try:
+        with open(fname, 'rb') as fin:
+            fin.seek(start)
+            left = end - start
+            while left > 0:
+                data = fin.read(min(left, _STREAM_READ_SIZE))
+                if not data:
+                    return None
+                left -= len(data)
+                block = dec.dec.decompress(data)
+                size += len(block)
+                if size > _MAX_STREAM_SIZE or dec.dec.unused_data:
+                    return None
+                out.append(block)
+    except (IOError, EOFError, zlib.error):
+        return None
+    if not dec.finished():
+        return None
+    return b''.join(out)
+
+def write_streams(fname, ext, chunks, write, processes=None):
+    '''Decompress the streams of a file in a pool of processes, writing
+    their output in order. Stretches of data that the workers cannot handle,
+    because of false stream boundaries or a too large output, are
+    decompressed serially.
+    '''
+    processes = processes or multiprocessing.cpu_count()
+    pool = None
+    imap = getattr(itertools, 'imap', map)
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        imap = pool.imap
+    try:
+        serial = None
+        # Bound the output held in memory, waiting to be written
+        window = max(processes, _MAX_PENDING_SIZE // _MAX_STREAM_SIZE)
+        for first in range(0, len(chunks), window):
+            todo = chunks[first:first + window]
+            jobs = [(fname, ext, start, end) for start, end in todo]
+            for (start, end), data in zip(todo, imap(decompress_stream, jobs)):
+                if serial is None and data is not None:
+                    write(data)
+                    continue
+                if serial is None:
+                    serial = StreamDecompressor(ext)
+                with open(fname, 'rb') as fin:
+                    fin.seek(start)
+                    left = end - start
+                    while left > 0:
+                        block = fin.read(min(left, _SCAN_BLOCK_SIZE))
+                        if not block:
+                            break
+                        left -= len(block)
+                        write(serial.decompress(block))
+                if serial.finished():
+                    write(serial.flush())
+                    serial = None
+        if serial is not None:
+            write(serial.flush())
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+def gzip_isize(fname):
+    '''Uncompressed size modulo 2**32 of the last stream of a .gz file,
+    from its trailer
+    '''
+    with open(fname, 'rb') as fin:
+        fin.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', fin.read(4))[0]
+
+def gzip_stream_isizes(fname, chunks):
+    '''Uncompressed sizes modulo 2**32 of the streams of a .gz file, from
+    the trailers ending their byte ranges
+    '''
+    sizes = []
+    with open(fname, 'rb') as fin:
+        for _, end in chunks:
+            fin.seek(end - 4)
+            sizes.append(struct.unpack('<I', fin.read(4))[0])
+    return sizes
+
+def zip_size(fname):
+    '''Uncompressed size of the first file of a .zip archive, the one
+    that is extracted, from its central directory
+    '''
+    zipf = zipfile.ZipFile(fname, 'r')
+    try:
+        return zipf.infolist()[0].file_size
+    finally:
+        zipf.close()
+
+def _xz_varint(data, pos):
+    '''Decode the xz multibyte integer at pos, return it & the next pos'''
+    value = 0
+    for shift in range(0, 63, 7):
+        byte = ord(data[pos:pos + 1])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+    raise ValueError('Bad xz multibyte integer')
+
+def xz_size(fname):
+    '''Uncompressed size of an .xz file, from the indexes of its streams,
+    walked backwards from the end of file
+    '''
+    total = 0
+    with open(fname, 'rb') as fin:
+        fin.seek(0, os.SEEK_END)
+        end = fin.tell()
+        if not end:
+            raise ValueError('Empty xz file')
+        while end > 0:
+            fin.seek(end - 4)
+            if fin.read(4) == b'\0' * 4:
+                # Stream padding
+                end -= 4
+                continue
+            fin.seek(end - 12)
+            footer = fin.read(12)
+            if footer[10:] != b'YZ':
+                raise ValueError('Bad xz stream footer')
+            index_size = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+            fin.seek(end - 12 - index_size)
+            index = fin.read(index_size)
+            if index[:1] != b'\0':
+                raise ValueError('Bad xz index')
+            records, pos = _xz_varint(index, 1)
+            blocks_size = 0
+            for _ in range(records):
+                unpadded, pos = _xz_varint(index, pos)
+                size, pos = _xz_varint(index, pos)
+                blocks_size += (unpadded + 3) & ~3
+                total += size
+            end -= 12 + blocks_size + index_size + 12
+            if end < 0:
+                raise ValueError('Bad xz index')
+            fin.seek(end)
+            if fin.read(6) != b'\xfd7zXZ\x00':
+                raise ValueError('Bad xz stream header')
+    return total
+
+# Uncompressed size readers, from archive trailers or indexes. A .gz file
+# can only tell the size modulo 2**32 of its last stream: a lower bound
+_SIZE_HINTS = {
+    '.gz': gzip_isize,
+    '.zip': zip_size,
+    '.xz': xz_size,
+}
+
+def size_hint(fname, ext):
+    '''Uncompressed size of a file, without decompressing it: exact for
+    .zip & .xz files, a lower bound for .gz ones. None if not available.
+    '''
+    if ext not in _SIZE_HINTS:
+        return None
+    try:
+        return _SIZE_HINTS[ext](fname)
+    except (IOError, OSError, ValueError, TypeError, IndexError,
+            struct.error, zipfile.BadZipfile):
+        return None
+
+def size_is_exact(ext):
+    '''Whether the size hint of a file format is its exact size'''
+    return ext in _SIZE_HINTS and ext != '.gz'
+
+def size_consistent(ext, hint, size):
+    '''Whether a size hint agrees with an expected uncompressed size'''
+    if hint is None or size is None:
+        return True
+    if ext == '.gz':
+        # Multi-stream files only record the size of their last stream
+        return hint <= size
+    return hint == size
+
+# Size of the head & tail blocks hashed to fingerprint a file
+_FINGERPRINT_BLOCK_SIZE = 64 * 1024
+
+def fingerprint(filename):
+    '''Cheap identity of a file: its size, modification time, and a hash
+    of its first and last blocks
+    '''
+    stat = os.stat(filename)
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as fin:
+        md5.update(fin.read(_FINGERPRINT_BLOCK_SIZE))
+        if stat.st_size > _FINGERPRINT_BLOCK_SIZE:
+            fin.seek(max(_FINGERPRINT_BLOCK_SIZE,
+                         stat.st_size - _FINGERPRINT_BLOCK_SIZE))
+            md5.update(fin.read())
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'head_tail_md5': md5.hexdigest(),
+    }
+
 class Decompressor(object):
     '''A class to handle differently-compressed file formats in an
     uniform way.
     '''
 
-    def __init__(self, filename, ext=None, block_size=4096):
+    def __init__(self, filename, ext=None, block_size=4096, processes=None,
+                 native=True, sparse=True, size=None, preallocate=False,
+                 reuse=False, outdir=None, member=None, checkpoint=None):
 
         if not os.path.exists(filename):
             raise DecompressorError('File does not exist: ' + filename)
@@ -63,6 +791,13 @@ class Decompressor(object):
         self.fin_name = filename
         self.block_size = block_size
         self.fout_name, sext = os.path.splitext(filename)
+        # Tar bundles: the output is their disk image member
+        bext = bundle_ext(filename)
+        if bext is not None:
+            self.fout_name, sext = filename[:-len(bext)], bext
+        if outdir is not None:
+            self.fout_name = os.path.join(outdir,
+                                          os.path.basename(self.fout_name))
 
         if ext is not None and sext and sext != ext:
             raise DecompressorError('Extension mismatch: ' + sext + ' != ' + ext)
@@ -78,20 +813,347 @@ class Decompressor(object):
                                         'decompression algorithm given: ' +
                                         filename)
             self.fout_name += '_uncompressed'
-        if os.path.exists(self.fout_name):
+        if os.path.exists(self.fout_name) and not reuse:
             raise DecompressorError('File exists: ' + self.fout_name)
-        self.opener = _EXT_MAP[sext or ext]
+        # The output is written under a temporary name, and renamed once
+        # complete: a leftover of it is a partial output from a failed run
+        self.tmp_name = self.fout_name + '.part'
+        # In reuse mode, the input fingerprint & output size are recorded
+        # there, to skip decompression when the output is already there
+        self.reuse = reuse
+        self.fingerprint_name = self.fout_name + '.fingerprint'
+        # With checkpoint, restart points at least that many bytes apart
+        # are recorded in an index, see zindex.py: a failed run resumes
+        # from the last one, instead of restarting from scratch
+        self.checkpoint = checkpoint
+        self.index_name = self.fout_name + '.zindex'
+        self.ext = sext or ext
+        # Trust the content over the label
+        self.detected = detect_format(filename)
+        if (is_compressed(self.detected) and self.detected != self.ext and
+                self.ext not in _TAR_EXTS):
+            vprint('%s: labelled %s, but looks like %s' %
+                   (filename, self.ext, self.detected))
+            self.ext = self.detected
+        self.opener = _EXT_MAP[self.ext]
+        if self.ext in _TAR_EXTS:
+            self.opener = functools.partial(tar_opener, member=member)
+        # Uncompressed size, from the archive trailer or index
+        self.hint = size_hint(filename, self.ext)
+        self.processes = processes
+        self.native = native
+        # Output file: holes for all-zero blocks, expected uncompressed size
+        # and disk space preallocation for the non-zero data
+        self.sparse = sparse
+        self.size = size
+        self.preallocate = preallocate
+        # Number of bytes actually written, holes excluded
+        self.written = None
+        # How the data was decompressed: external decoder name, 'parallel',
+        # 'serial', 'none' when the file is not compressed after all, or
+        # 'reused' when the output of a previous run is kept
+        self.method = None
+
+    def needed(self):
+        '''Disk space needed for the output file, as far as known upfront:
+        sparse outputs can take less
+        '''
+        if self.size is not None:
+            return max(self.size, self.hint or 0)
+        return self.hint
+
+    def admit(self):
+        '''Whether the output file fits in the space left on its disk'''
+        needed = self.needed()
+        if not needed:
+            return True
+        outdir = os.path.dirname(os.path.abspath(self.fout_name))
+        try:
+            free = utils.free_space(outdir)
+        except OSError:
+            return True
+        if needed > free:
+            vprint('%s: needs %s, only %s free in: %s' %
+                   (self.fin_name, utils.size_t(needed), utils.size_t(free),
+                    outdir))
+            return False
+        return True
+
+    def reusable(self):
+        '''Whether the output file of a previous run can be kept as is: its
+        size is the expected one, and the input did not change since
+        '''
+        try:
+            with open(self.fingerprint_name) as fin:
+                recorded = json.load(fin)
+            out_size = os.path.getsize(self.fout_name)
+            if self.size is not None and out_size != self.size:
+                return False
+            return (recorded.get('output_size') == out_size and
+                    recorded.get('input') == fingerprint(self.fin_name))
+        except (IOError, OSError, ValueError, AttributeError):
+            return False
+
+    def parallel_chunks(self):
+        '''Byte ranges of the streams to decompress in parallel, or None'''
+        if self.ext not in _STREAM_START_RE:
+            return None
+        try:
+            chunks = find_streams(self.fin_name, self.ext)
+        except IOError:
+            return None
+        if len(chunks) < 2:
+            return None
+        if max(end - start for start, end in chunks) > _MAX_STREAM_SIZE:
+            return None
+        # Workers give up on larger streams anyway, but only after
+        # decompressing them
+        if (self.ext == '.gz' and
+                max(gzip_stream_isizes(self.fin_name, chunks)) >
+                _MAX_STREAM_SIZE):
+            return None
+        return chunks
 
     def doit(self, delete=False):
+        '''Decompress the file's data, in parallel for multi-stream files,
+        or else in self.block_size chunks. An uncompressed file is returned
+        as is, and never deleted.
+        '''
+        if is_uncompressed(self.detected) and self.ext not in _TAR_EXTS:
+            # Nothing to do, the input file is the output
+            vprint('%s: not compressed: %s' % (self.fin_name, self.detected))
+            self.method = 'none'
+            self.fout_name = self.fin_name
+            return True, self.fout_name
+        if self.reuse and os.path.exists(self.fout_name):
+            if self.reusable():
+                vprint('%s: reusing output: %s' %
+                       (self.fin_name, self.fout_name))
+                self.method = 'reused'
+                if delete:
+                    os.remove(self.fin_name)
+                return True, self.fout_name
+            vprint('%s: stale output, decompressing again: %s' %
+                   (self.fin_name, self.fout_name))
+        if os.path.exists(self.tmp_name) and not self.checkpoint:
+            vprint('%s: restarting partial output: %s' %
+                   (self.fin_name, self.tmp_name))
+        if os.path.exists(self.index_name) and not self.checkpoint:
+            os.remove(self.index_name)
+        if os.path.exists(self.fingerprint_name):
+            os.remove(self.fingerprint_name)
+        if not size_consistent(self.ext, self.hint, self.size):
+            vprint('%s: expected size %d, but archive says: %d' %
+                   (self.fin_name, self.size, self.hint))
+            return False, self.fout_name
+        if not self.admit():
+            return False, self.fout_name
+        if self.ext in _TAR_EXTS:
+            self.method = 'tar'
+            ret = self.doit_serial()
+        elif self.checkpoint and zindex.supported(self.ext):
+            self.method = 'checkpointed'
+            ret = self.doit_checkpointed()
+        else:
+            ret = self.doit_any()
+        vprint('%s: decompression method: %s' % (self.fin_name, self.method))
+        if ret:
+            os.rename(self.tmp_name, self.fout_name)
+            if self.reuse:
+                self.record()
+        if ret and self.written is not None:
+            vprint('%s: written: %s, holes: %s' %
+                   (self.fout_name, utils.size_t(self.written),
+                    utils.size_t(os.path.getsize(self.fout_name) -
+                                 self.written)))
+        if ret and delete:
+            os.remove(self.fin_name)
+        return ret, self.fout_name
+
+    def doit_any(self):
+        '''Decompress with an external decoder if any, else in parallel for
+        multi-stream files, or else serially
+        '''
+        ret = False
+        cmd = get_native_decoders().get(self.ext) if self.native else None
+        if cmd:
+            ret = self.doit_native(cmd)
+            if not ret:
+                vprint('%s: falling back to in-process decompression' %
+                       self.fin_name)
+        if not ret:
+            chunks = self.parallel_chunks()
+            if chunks:
+                self.method = 'parallel'
+                ret = self.doit_parallel(chunks)
+            else:
+                self.method = 'serial'
+                ret = self.doit_serial()
+        return ret
+
+    def resume_point(self, fprint):
+        '''Last restart point recorded by a previous partial run for the
+        same input, and the valid size of its index, or None
+        '''
+        if not os.path.exists(self.tmp_name):
+            return None
+        index = zindex.load_index(self.index_name)
+        if index is None:
+            return None
+        header, points, valid = index
+        if header.get('input') != fprint or header.get('ext') != self.ext:
+            return None
+        return points[-1], valid
+
+    def doit_checkpointed(self):
+        '''Decompress the file's data, recording restart points in an
+        index, or resuming from the last one of a previous partial run. The
+        partial output & index are kept on failure.
+        '''
+        fprint = fingerprint(self.fin_name)
+        resume = self.resume_point(fprint)
+        if resume is None and os.path.exists(self.tmp_name):
+            vprint('%s: cannot resume, restarting partial output: %s' %
+                   (self.fin_name, self.tmp_name))
+        try:
+            with open(self.tmp_name, 'r+b' if resume else 'wb') as fout:
+                if resume:
+                    point, valid = resume
+                    vprint('%s: resuming at: %s' %
+                           (self.fin_name, utils.size_t(point['out'])))
+                    fidx = zindex.reopen_index(self.index_name, valid)
+                    fout.truncate(point['out'])
+                    fout.seek(point['out'])
+                else:
+                    point = None
+                    fidx = zindex.create_index(self.index_name, self.ext,
+                                               fprint)
+                with fidx:
+                    dec = zindex.IndexedDecompressor(self.ext,
+                                                     self.checkpoint, point)
+                    writer = self.output(fout)
+                    def feed(data):
+                        writer.write(dec.decompress(data))
+                        if dec.points:
+                            # The output must be there before its points
+                            fout.flush()
+                            os.fsync(fout.fileno())
+                            zindex.append_points(fidx, dec.points)
+                            del dec.points[:]
+                    with open(self.fin_name, 'rb') as fin:
+                        fin.seek(dec.in_off)
+                        utils.block_read_filedesc(fin, feed, _PIPE_BLOCK_SIZE)
+                    writer.write(dec.flush())
+                    self.finish(writer)
+        except (IOError, OSError, zindex.ZIndexError) as exc:
+            vprint('%s: %s' % (self.fin_name, exc))
+            return False
+        return True
+
+    def read_at(self, offset, size):
+        '''Read uncompressed data at offset, from the compressed file, with
+        the index of a checkpointed decompression
+        '''
+        index = zindex.load_index(self.index_name)
+        if index is None:
+            raise DecompressorError('No index: ' + self.index_name)
+        try:
+            return zindex.read_at(self.fin_name, index, offset, size)
+        except zindex.ZIndexError as exc:
+            raise DecompressorError(str(exc))
+
+    def remove_sidecars(self):
+        '''Remove the files kept for a rerun: input fingerprint, restart
+        points index & partial output
+        '''
+        for fname in (self.fingerprint_name, self.index_name, self.tmp_name):
+            if os.path.exists(fname):
+                os.remove(fname)
+
+    def record(self):
+        '''Record the input fingerprint & output size, for reuse'''
+        with open(self.fingerprint_name, 'w') as fout:
+            json.dump({
+                'input': fingerprint(self.fin_name),
+                'output_size': os.path.getsize(self.fout_name),
+            }, fout)
+
+    def doit_native(self, cmd):
+        '''Decompress the file with an external decoder, writing to the
+        output file through a pipe
+        '''
+        self.method = os.path.basename(cmd[0])
+        vprint('%s: decompressing with: %s' % (self.fin_name, ' '.join(cmd)))
+        try:
+            with open(self.tmp_name, 'wb') as fout:
+                with tempfile.TemporaryFile() as ferr:
+                    proc = subprocess.Popen(cmd + [self.fin_name],
+                                            stdout=subprocess.PIPE,
+                                            stderr=ferr)
+                    writer = self.output(fout)
+                    try:
+                        utils.block_read_filedesc(proc.stdout, writer.write,
+                                                  _PIPE_BLOCK_SIZE)
+                    finally:
+                        proc.stdout.close()
+                        proc.wait()
+                    ferr.seek(0)
+                    err = ferr.read()
+                self.finish(writer)
+            ret = proc.returncode == 0
+        except (IOError, OSError) as exc:
+            err = str(exc)
+            ret = False
+        if not ret:
+            utils.vprint_lines('%s: %s failed: %s' %
+                               (self.fin_name, self.method, err))
+            if os.path.exists(self.tmp_name):
+                os.remove(self.tmp_name)
+        return ret
+
+    def output(self, fout):
+        '''Return the writer for the output file'''
+        return utils.SparseWriter(fout, size=self.size,
+                                  preallocate=self.preallocate,
+                                  sparse=self.sparse)
+
+    def finish(self, writer):
+        '''Done writing the output file'''
+        writer.finish()
+        self.written = writer.written
+
+    def doit_parallel(self, chunks):
+        '''Decompress the streams of the file in a pool of processes'''
+        vprint('%s: decompressing %d streams with %d processes' %
+               (self.fin_name, len(chunks),
+                self.processes or multiprocessing.cpu_count()))
+        ret = True
+        try:
+            with open(self.tmp_name, 'wb') as fout:
+                writer = self.output(fout)
+                write_streams(self.fin_name, self.ext, chunks, writer.write,
+                              self.processes)
+                self.finish(writer)
+        except (IOError, OSError, DecompressorError) as exc:
+            vprint('%s: %s' % (self.fin_name, exc))
+            ret = False
+        if not ret and os.path.exists(self.tmp_name):
+            vprint('Error happened: deleting output file')
+            os.remove(self.tmp_name)
+        return ret
+
+    def doit_serial(self):
         '''Decompress the file's data, in self.block_size chunks'''
         ret = True
         try:
             with self.opener(self.fin_name, 'rb') as fin:
                 delout = False
                 try:
-                    with open(self.fout_name, 'wb') as fout:
+                    with open(self.tmp_name, 'wb') as fout:
                         try:
-                            utils.block_read_filedesc(fin, fout.write, self.block_size)
+                            writer = self.output(fout)
+                            utils.block_read_filedesc(fin, writer.write, self.block_size)
+                            self.finish(writer)
                         except IOError as exc:
                             delout = True
                             ret = False
@@ -99,23 +1161,39 @@ class Decompressor(object):
                                 raise exc
                     if delout:
                         vprint('Error happened: deleting output file')
-                        os.remove(self.fout_name)
+                        os.remove(self.tmp_name)
                 except IOError:
                     ret = False
         except Exception:
             ret = False
+        return ret
 
-        if ret and delete:
-            os.remove(self.fin_name)
-        return ret, self.fout_name
-
-def main(args=sys.argv[1:]):
+def main(sys_argv=sys.argv[1:]):
     '''Decompress all files given as CLI arguments'''
+    parser = argparse.ArgumentParser(
+        description='Decompress files, next to them')
+
+    parser.add_argument('-r', '--reuse', action='store_true',
+                        help='Keep the output of a previous run, if its '
+                             'input did not change since')
+
+    parser.add_argument('-C', '--checkpoint', type=int, default=None,
+                        metavar='BYTES',
+                        help='Record restart points at least that many '
+                             'uncompressed bytes apart, to resume a failed '
+                             'run from the last one')
+
+    parser.add_argument(dest='files', metavar='FILE', nargs='*',
+                        help='compressed file')
+
+    args = parser.parse_args(sys_argv)
+
     utils.set_verbose(True)
     vprint('verbose mode')
-    for fname in args:
+    for fname in args.files:
         vprint('Decompressing archive: ' + fname)
-        decomp = Decompressor(fname)
+        decomp = Decompressor(fname, reuse=args.reuse,
+                              checkpoint=args.checkpoint)
         decomp.doit()
     return True
 
@@ -0,0 +1,178 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2016 Vincent Legoll <vincent.legoll@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Delta download of a new VM image version, zsync-style: blocks that are
+already present in a previous version of the image, available locally,
+are reused, and only the remaining ranges are downloaded.
+
+The block map of the new version (its size, block size and the weak &
+strong checksums of each block) is published by the glancing mirror, see
+mirror.py
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import zlib
+import hashlib
+import tempfile
+import functools
+
+try:
+    from urllib2 import urlopen, Request, URLError, HTTPError
+except ImportError: # pragma: no cover
+    from urllib.request import urlopen, Request
+    from urllib.error import URLError, HTTPError
+
+import utils
+from utils import vprint, size_t
+
+_DEFAULT_BLOCK_SIZE = 64 * 1024
+
+# Download missing blocks separated by less than that many present blocks
+# with a single request
+_MAX_GAP = 4
+
+class DeltaError(Exception):
+    '''Class to allow catching exceptions from this module'''
+
+def weak_sum(block):
+    return zlib.adler32(block) & 0xffffffff
+
+def strong_sum(block):
+    return hashlib.md5(block).hexdigest()
+
+def block_map(filename, block_size=_DEFAULT_BLOCK_SIZE):
+    '''Compute the block map of a file'''
+    blocks = []
+    def add_block(block):
+        blocks.append([weak_sum(block), strong_sum(block)])
+    utils.block_read_filename(filename, add_block, block_size)
+    return {
+        'size': os.path.getsize(filename),
+        'block_size': block_size,
+        'blocks': blocks,
+    }
+
+def index_file(filename, block_size):
+    '''Index the blocks of a local file by weak checksum'''
+    index = {}
+    offset = 0
+    with open(filename, 'rb') as fin:
+        for block in iter(functools.partial(fin.read, block_size), b''):
+            index.setdefault(weak_sum(block), []).append(offset)
+            offset += len(block)
+    return index
+
+def find_block(fin, index, weak, strong, length):
+    '''Look for a block in the indexed local file, return its data'''
+    for offset in index.get(weak, ()):
+        fin.seek(offset)
+        block = fin.read(length)
+        if len(block) == length and strong_sum(block) == strong:
+            return block
+    return None
+
+def missing_ranges(missing, nblocks):
+    '''Coalesce the indexes of missing blocks into [first, last) ranges'''
+    ranges = []
+    for idx in missing:
+        if ranges and idx - ranges[-1][1] <= _MAX_GAP:
+            ranges[-1][1] = idx + 1
+        else:
+            ranges.append([idx, idx + 1])
+    return [(first, min(last, nblocks)) for first, last in ranges]
+
+def get_range(url, start, end):
+    '''Open the [start, end) byte range of a remote resource'''
+    req = Request(url, headers={'Range': 'bytes=%d-%d' % (start, end - 1)})
+    url_f = urlopen(req)
+    if url_f.getcode() != 206:
+        raise DeltaError('Range requests not supported by: ' + url)
+    return url_f
+
+def rebuild(url, bmap, base_file, fout):
+    '''Write the new version described by bmap into fout, with the blocks
+       from base_file, or downloaded from url.
+       Return the numbers of reused & downloaded bytes.
+    '''
+    size = bmap['size']
+    bsize = bmap['block_size']
+    blocks = bmap['blocks']
+    index = index_file(base_file, bsize)
+    missing = []
+    reused = 0
+    with open(base_file, 'rb') as fin:
+        for idx, (weak, strong) in enumerate(blocks):
+            length = min(bsize, size - idx * bsize)
+            block = find_block(fin, index, weak, strong, length)
+            if block is None:
+                missing.append(idx)
+                continue
+            fout.seek(idx * bsize)
+            fout.write(block)
+            reused += length
+    fetched = 0
+    for first, last in missing_ranges(missing, len(blocks)):
+        start, end = first * bsize, min(last * bsize, size)
+        url_f = get_range(url, start, end)
+        fout.seek(start)
+        for idx in range(first, last):
+            length = min(bsize, size - idx * bsize)
+            block = url_f.read(length)
+            if strong_sum(block) != blocks[idx][1]:
+                raise DeltaError('Block #%d checksum mismatch from: %s' %
+                                 (idx, url))
+            fout.write(block)
+        fetched += end - start
+    fout.truncate(size)
+    return reused, fetched
+
+def get_delta(url, bmap_url, base_file):
+    '''Retrieve url content into a temporary file, reusing blocks from
+       base_file. Return temporary file name, or None on failure, in which
+       case a full download is needed.
+    '''
+    try:
+        bmap = json.loads(urlopen(bmap_url).read().decode('utf-8'))
+    except (URLError, HTTPError, ValueError) as exc:
+        vprint('cannot get block map from: %s: %s' % (bmap_url, exc))
+        return None
+    with tempfile.NamedTemporaryFile(delete=False) as fout:
+        try:
+            reused, fetched = rebuild(url, bmap, base_file, fout)
+        except (DeltaError, URLError, HTTPError, IOError) as exc:
+            vprint('delta download failed: %s' % exc)
+            fout.close()
+            os.remove(fout.name)
+            return None
+    vprint('%s: reused %s from %s, downloaded %s' %
+           (fout.name, size_t(reused), base_file, size_t(fetched)))
+    return fout.name
+
+def main(args=sys.argv[1:]):
+    '''Output the block map of all files given as CLI arguments'''
+    for fname in args:
+        print(json.dumps(block_map(fname)))
+    return True
+
+if __name__ == '__main__': # pragma: no cover
+    main()
@@ -20,22 +20,113 @@ from __future__ import print_function
 
 import os
 import sys
+import time
+import tempfile
 import argparse
+import threading
+import subprocess
+
+from multiprocessing.pool import ThreadPool
 
 import utils
+import glance_api
 import openstack_out
 
 from utils import vprint, vprint_lines
 
 _GLANCE_CMD = ['glance']
 
+_BLOCK_SIZE = 1024 * 1024
+
+# Seconds before the image index is rebuilt, to see changes made by others
+_INDEX_TTL = 300
+
+# Images per listing request
+_PAGE_SIZE = 100
+
+# Images deleted at a time
+_DELETE_PARALLEL = 4
+
+class GlanceError(Exception):
+    '''Class to allow catching exceptions from this module'''
+
+def use_api():
+    '''Tell if glance is accessed through its REST API, in-process, instead
+    of running the glance command line client: selected by setting the
+    GLANCING_GLANCE_BACKEND environment variable to "api" (default: "cli")
+    '''
+    return os.environ.get('GLANCING_GLANCE_BACKEND', 'cli') == 'api'
+
+def api_call(err_msg, quiet, func, *args, **kwargs):
+    '''Run a glance_api call, return None if it fails, like glance_run()'''
+    try:
+        return func(*args, **kwargs)
+    except glance_api.GlanceApiError as exc:
+        if not quiet:
+            vprint(err_msg)
+            vprint_lines('error=' + str(exc))
+    return None
+
 # Check glance availability early
 # Warning: glance --version outputs to stderr
 def glance_ok():
+    if use_api():
+        return api_call('cannot access glance API', False,
+                        glance_api.client().get_token) is not None
     return glance_run('--version', stderr=True, quiet=True) is not None
 
+def glance_project_id():
+    '''ID of the project authenticated to through the API, None if unknown'''
+    client = glance_api.client()
+    if api_call('cannot access glance API', False, client.get_token) is None:
+        return None
+    return client.project_id
+
+def api_fields(name, diskformat):
+    '''Properties of an image to create through the API'''
+    fields = {'container_format': 'bare'}
+    if diskformat is not None:
+        fields['disk_format'] = diskformat
+    if name is not None:
+        fields['name'] = name
+    return fields
+
+def api_import_id(base, md5, name, diskformat):
+    client = glance_api.client()
+    err_msg = 'failed to import image into glance: %s from %s' % (name, base)
+    image = api_call(err_msg, False, client.create,
+                     **api_fields(name, diskformat))
+    if image is None:
+        return False
+    imgid = image['id']
+    upload = api_call(err_msg, False, client.upload, imgid)
+    ok = upload is not None
+    if ok:
+        try:
+            utils.block_read_filename(base, upload.write, _BLOCK_SIZE)
+        except (IOError, OSError) as exc:
+            vprint('%s: %s' % (err_msg, exc))
+            upload.abort()
+            ok = False
+        else:
+            ok = upload.commit()
+    if ok and md5 is not None:
+        # The API does not take the checksum to verify, check it afterwards
+        image = api_call(err_msg, False, client.show, imgid)
+        ok = image is not None and image.get('checksum') == md5
+        if not ok:
+            vprint('%s: checksum mismatch, expected: %s' % (err_msg, md5))
+    if not ok:
+        api_call('failed to delete image from glance: ' + imgid, True,
+                 client.delete, imgid)
+        return False
+    _INDEX.add(imgid, name)
+    return imgid
+
 # Import VM image into glance
 def glance_import_id(base, md5=None, name=None, diskformat=None):
+    if use_api():
+        return api_import_id(base, md5, name, diskformat)
     g_args = None
     args = ['--container-format', 'bare', '--file', base]
     if diskformat is not None:
@@ -49,6 +140,32 @@ def glance_import_id(base, md5=None, name=None, diskformat=None):
     err_msg = 'failed to import image into glance: %s from %s' % (name, base)
     out = glance_run('image-create', glance_args=g_args, subcmd_args=args,
                      err_msg=err_msg)
+    imgid = get_id(out)
+    if imgid:
+        _INDEX.add(imgid, name)
+    return imgid
+
+# Create an image without data, to be uploaded afterwards
+def glance_create_id(name=None, diskformat=None):
+    err_msg = 'failed to create image in glance: %s' % name
+    if use_api():
+        image = api_call(err_msg, False, glance_api.client().create,
+                         **api_fields(name, diskformat))
+        imgid = image['id'] if image else False
+    else:
+        args = ['--container-format', 'bare']
+        if diskformat is not None:
+            args += ['--disk-format', diskformat]
+        if name is not None:
+            args += ['--name', name]
+        out = glance_run('image-create', glance_args=None, subcmd_args=args,
+                         err_msg=err_msg)
+        imgid = get_id(out)
+    if imgid:
+        _INDEX.add(imgid, name)
+    return imgid
+
+def get_id(out):
     if out:
         _, block, _, _ = openstack_out.parse_block(out)
         for property_name, value in block:
@@ -66,7 +183,7 @@ def glance_exists(name):
         raise TypeError
     return len(glance_ids([name])) > 0
 
-def glance_run(glance_cmd=None, glance_args=None, subcmd_args=None, **kwargs):
+def glance_cmdline(glance_cmd=None, glance_args=None, subcmd_args=None):
     cmd = list(_GLANCE_CMD)
     if glance_args is not None:
         cmd.extend(glance_args)
@@ -78,6 +195,10 @@ def glance_run(glance_cmd=None, glance_args=None, subcmd_args=None, **kwargs):
         cmd += [glance_cmd]
     if subcmd_args is not None:
         cmd.extend(subcmd_args)
+    return cmd
+
+def glance_run(glance_cmd=None, glance_args=None, subcmd_args=None, **kwargs):
+    cmd = glance_cmdline(glance_cmd, glance_args, subcmd_args)
     status, _, out, err = utils.run(cmd, out=True, err=True)
     if not status:
         if (not kwargs.get('quiet')) is True:
@@ -95,19 +216,239 @@ def glance_run(glance_cmd=None, glance_args=None, subcmd_args=None, **kwargs):
         return err
     return out
 
+def api_filters(args):
+    '''API listing filters from glance image-list CLI arguments'''
+    ret = {}
+    args = list(args)
+    while len(args) > 1:
+        opt, value = args.pop(0), args.pop(0)
+        if opt == '--property-filter':
+            key, _, value = value.partition('=')
+        else:
+            key = opt.lstrip('-').replace('-', '_')
+        ret[key] = value
+    return ret
+
+# Listing filters that have their own glance image-list CLI option
+_CLI_FILTERS = ('owner', 'visibility', 'member_status', 'tag')
+
+def cli_filters(filters, page_size):
+    '''glance image-list CLI arguments for API listing filters'''
+    ret = ['--page-size', str(page_size)]
+    for key, value in sorted(filters.items()):
+        if key in _CLI_FILTERS:
+            ret += ['--' + key.replace('_', '-'), value]
+        else:
+            ret += ['--property-filter', '%s=%s' % (key, value)]
+    return ret
+
+def glance_list(page_size=_PAGE_SIZE, **filters):
+    '''Generate the images matching the filters, applied by glance: name,
+    owner, status, or any image property, like mpid. They are listed by
+    pages of page_size images, through the API as dicts of their properties,
+    or else as dicts of their id & name only.
+    Raise GlanceError if glance cannot be listed
+    '''
+    if use_api():
+        try:
+            for image in glance_api.client().images(limit=page_size,
+                                                    **filters):
+                yield image
+        except glance_api.GlanceApiError as exc:
+            raise GlanceError('failed to list images: ' + str(exc))
+        return
+    imglist = glance_run('image-list', glance_args=None,
+                         subcmd_args=cli_filters(filters, page_size))
+    if imglist is None:
+        raise GlanceError('failed to run "image-list"')
+    _, block, _, _ = openstack_out.parse_block(imglist)
+    for image_id, image_name in block:
+        yield {'id': image_id, 'name': image_name}
+
+def image_by_id(imgid):
+    '''(id, name) of the image with that ID, None if there is none'''
+    if use_api():
+        try:
+            image = glance_api.client().show(imgid)
+        except glance_api.GlanceApiError as exc:
+            if exc.status == 404:
+                return None
+            raise GlanceError('failed to get image %s: %s' % (imgid, exc))
+    else:
+        out = glance_run('image-show', glance_args=None, subcmd_args=[imgid],
+                         quiet=True)
+        if out is None:
+            return None
+        image = openstack_out.map_block(out)
+    return image['id'], image.get('name') or ''
+
+class ImageIndex(object):
+    '''Index of the images in glance, by ID & name. The images with a given
+    name are listed by glance on first lookup, and kept: only looking up all
+    images needs a full listing. The index is kept up to date by the image
+    creations, renamings and deletions done by this module, and forgotten
+    after GLANCING_INDEX_TTL seconds (default: 300), or on request, to see
+    the changes made by others.
+    '''
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.invalidate()
+
+    def get_ttl(self):
+        if self.ttl is not None:
+            return self.ttl
+        return float(os.environ.get('GLANCING_INDEX_TTL', _INDEX_TTL))
+
+    def invalidate(self):
+        with self.lock:
+            # Images seen, by ID & name
+            self.names, self.ids = {}, {}
+            # Names & IDs looked up, unless all images have been listed
+            self.known = set()
+            self.complete = False
+            self.built = time.time()
+
+    def refresh(self):
+        '''Rebuild from a full listing.
+        Raise GlanceError if glance cannot be listed
+        '''
+        with self.lock:
+            self.invalidate()
+            for image in glance_list():
+                self._add(image['id'], image.get('name') or '')
+            self.complete = True
+
+    def _add(self, image_id, image_name):
+        self.names[image_id] = image_name
+        self.ids.setdefault(image_name, set()).add(image_id)
+
+    def _remove(self, image_id):
+        image_name = self.names.pop(image_id, None)
+        ids = self.ids.get(image_name, set())
+        ids.discard(image_id)
+        if not ids:
+            self.ids.pop(image_name, None)
+
+    def _fetch(self, name):
+        if not name:
+            # Cannot filter on an empty name
+            self.refresh()
+        elif utils.is_uuid(name):
+            image = image_by_id(name)
+            if image is not None:
+                self._add(*image)
+        else:
+            for image in glance_list(name=name):
+                self._add(image['id'], image.get('name') or '')
+        self.known.add(name)
+
+    def add(self, image_id, image_name):
+        with self.lock:
+            self._remove(image_id)
+            self._add(image_id, image_name or '')
+
+    def remove(self, image_id):
+        with self.lock:
+            self._remove(image_id)
+            self.known.add(image_id)
+
+    def lookup(self, names=None):
+        '''IDs of the images with one of the given names or IDs, or of all
+        images if names is None.
+        Raise GlanceError if glance cannot be listed
+        '''
+        with self.lock:
+            if time.time() - self.built >= self.get_ttl():
+                self.invalidate()
+            if names is None:
+                if not self.complete:
+                    self.refresh()
+                return set(self.names)
+            names = [name for name in names if isinstance(name, (str, unicode))]
+            ret = set()
+            for name in names:
+                if not (self.complete or name in self.known):
+                    self._fetch(name)
+                ret |= self.ids.get(name, set())
+                if name in self.names:
+                    ret.add(name)
+            return ret
+
+_INDEX = ImageIndex()
+
+def glance_refresh(full=False):
+    '''Forget the images known, to see the changes made to glance by others,
+    and list them all if full. Return False if glance cannot be listed
+    '''
+    try:
+        if full:
+            _INDEX.refresh()
+        else:
+            _INDEX.invalidate()
+    except GlanceError as exc:
+        vprint(str(exc))
+        return False
+    return True
+
 def glance_ids(names=None, *args):
+    '''IDs of the images with one of the given names or IDs, or of all images
+    if names is None. More glance image-list arguments filter the listing
+    '''
     ret = set()
     # Single name ?
     if names is not None and isinstance(names, (str, unicode)):
         names = [names]
-    imglist = glance_run('image-list', glance_args=None, subcmd_args=args)
-    if imglist:
-        _, block, _, _ = openstack_out.parse_block(imglist)
-        for image_id, image_name in block:
+    if names is not None and not utils.is_iter(names):
+        return ret
+    try:
+        if not args:
+            return _INDEX.lookup(names)
+        # Filtered listings are not indexed
+        filters = api_filters(args)
+        if (names is not None and len(names) == 1 and names[0] and
+                isinstance(names[0], (str, unicode)) and
+                not utils.is_uuid(names[0])):
+            filters['name'] = names[0]
+        for image in glance_list(**filters):
             # Filtering or not ?
-            if (names is None or (utils.is_iter(names) and
-                                  (image_name in names or image_id in names))):
-                ret.add(image_id)
+            if (names is None or image.get('name') in names or
+                    image['id'] in names):
+                ret.add(image['id'])
+    except GlanceError as exc:
+        vprint(str(exc))
+    return ret
+
+# Image properties kept in inventory records
+_INVENTORY_FIELDS = ('id', 'name', 'checksum', 'os_hash_algo', 'os_hash_value',
+                     'version', 'mpid', 'status')
+
+def inventory_record(image):
+    return dict((key, image[key]) for key in _INVENTORY_FIELDS if key in image)
+
+def glance_inventory(owner=None, page_size=_PAGE_SIZE, **filters):
+    '''Records of the images matching the filters, owned by owner if given:
+    dicts of their id, name, checksum, multihash (os_hash_algo &
+    os_hash_value), version, mpid & status, when set. Got through the API in
+    a single listing, by pages of page_size images, while the CLI only lists
+    IDs & names: each image is then shown.
+    Return None if glance cannot be listed
+    '''
+    if owner is not None:
+        filters['owner'] = owner
+    ret = []
+    try:
+        for image in glance_list(page_size, **filters):
+            if not use_api():
+                out = glance_show(image['id'])
+                if not out:
+                    continue
+                image = openstack_out.map_block(out)
+            ret.append(inventory_record(image))
+    except GlanceError as exc:
+        vprint(str(exc))
+        return None
     return ret
 
 def glance_id(name):
@@ -121,28 +462,72 @@ def glance_id(name):
     # Non-existent image
     return None
 
-def glance_delete_all(names, quiet=False):
+def glance_delete_all(names, quiet=False, parallel=_DELETE_PARALLEL):
     ret = False
     all_images_ids = glance_ids(names)
     if all_images_ids:
-        ret = glance_delete_ids(all_images_ids, quiet=quiet)
+        ret = glance_delete_ids(all_images_ids, quiet=quiet, parallel=parallel)
     return ret
 
-def glance_delete_ids(ids, quiet=False):
-    ret = True
-    for image_id in ids:
-        if len(image_id) > 0:
-            ret &= glance_delete(image_id, quiet=quiet)
-        else:
+def delete_id(imgid):
+    '''Delete an image given by ID, return None, or the error message'''
+    if not imgid:
+        return 'empty image ID'
+    error = None
+    if use_api():
+        try:
+            glance_api.client().delete(imgid)
+        except glance_api.GlanceApiError as exc:
+            error = str(exc)
+    else:
+        cmd = glance_cmdline('image-delete', subcmd_args=[imgid])
+        status, _, _, err = utils.run(cmd, out=True, err=True)
+        if not status:
+            error = (err or '').strip() or 'failed to run "image-delete"'
+    if error is None:
+        _INDEX.remove(imgid)
+    return error
+
+def glance_delete_bulk(ids, parallel=_DELETE_PARALLEL):
+    '''Delete images given by ID, without looking them up, up to parallel
+    ones at a time. Return {ID: None if deleted, or the error message}
+    '''
+    ids = sorted(set(ids))
+    if parallel > 1 and len(ids) > 1:
+        pool = ThreadPool(min(parallel, len(ids)))
+        try:
+            errors = pool.map(delete_id, ids)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        errors = [delete_id(imgid) for imgid in ids]
+    if any(errors):
+        # Maybe deleted by someone else
+        _INDEX.invalidate()
+    return dict(zip(ids, errors))
+
+def glance_delete_ids(ids, quiet=False, parallel=_DELETE_PARALLEL):
+    results = glance_delete_bulk(ids, parallel)
+    for image_id, error in sorted(results.items()):
+        if not image_id:
             vprint('Error: attempting to delete image with empty ID')
-            ret = False
-    return ret
+        elif error is not None and not quiet:
+            vprint('failed to delete image from glance: %s: %s' %
+                   (image_id, error))
+    deleted = sum(error is None for error in results.values())
+    if len(results) > 1:
+        vprint('Deleted %d out of %d images' % (deleted, len(results)))
+    return deleted == len(results)
 
 def glance_show(name, quiet=False):
     imgid = glance_id(name)
     if imgid is None:
         return False
     err_msg = 'failed to get infos from glance for image: ' + str(imgid)
+    if use_api():
+        image = api_call(err_msg, quiet, glance_api.client().show, imgid)
+        return None if image is None else format_image(image)
     out = glance_run('image-show', glance_args=None, subcmd_args=[imgid],
                      err_msg=err_msg, quiet=quiet)
     return out
@@ -152,32 +537,202 @@ def glance_delete(name, quiet=False):
     if imgid is None:
         return False
     err_msg = 'failed to delete image from glance: ' + str(imgid)
-    out = glance_run('image-delete', glance_args=None, subcmd_args=[imgid],
-                     err_msg=err_msg, quiet=quiet)
-    return out is not None
+    if use_api():
+        ret = bool(api_call(err_msg, quiet, glance_api.client().delete,
+                            imgid))
+    else:
+        out = glance_run('image-delete', glance_args=None, subcmd_args=[imgid],
+                         err_msg=err_msg, quiet=quiet)
+        ret = out is not None
+    if ret:
+        _INDEX.remove(imgid)
+    else:
+        # Maybe already deleted by someone else
+        _INDEX.invalidate()
+    return ret
 
 def glance_download(name, fn_local):
     imgid = glance_id(name)
     if imgid is None:
         return False
     err_msg = 'failed to download image from glance: ' + str(imgid)
+    if use_api():
+        with open(fn_local, 'wb') as fout:
+            ok = bool(api_call(err_msg, False, glance_api.client().download,
+                               imgid, fout))
+        if not ok:
+            os.remove(fn_local)
+        return ok
     out = glance_run('image-download', glance_args=None,
                      subcmd_args=['--file', fn_local, imgid], err_msg=err_msg)
     return out is not None
 
+def glance_stream(vmid, fout, block_size=_BLOCK_SIZE):
+    '''Write the data of an image to a file object, in chunks, as it is
+    downloaded
+    '''
+    imgid = glance_id(vmid)
+    if imgid is None:
+        return False
+    err_msg = 'failed to download image from glance: ' + str(imgid)
+    if use_api():
+        try:
+            return bool(api_call(err_msg, False, glance_api.client().download,
+                                 imgid, fout, block_size))
+        except IOError as exc:
+            vprint('%s: %s' % (err_msg, exc))
+            return False
+    cmd = glance_cmdline('image-download', subcmd_args=[imgid])
+    with tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err)
+        try:
+            for data in iter(lambda: proc.stdout.read(block_size), b''):
+                fout.write(data)
+        except IOError as exc:
+            vprint('%s: %s' % (err_msg, exc))
+            proc.kill()
+            proc.wait()
+            return False
+        if proc.wait() != 0:
+            vprint(err_msg)
+            err.seek(0)
+            vprint_lines('stderr=' + err.read())
+            return False
+    return True
+
 def glance_rename(vmid, name):
     return glance_update(vmid, '--name', name)
 
+def glance_action(vmid, glance_cmd, api_method, *args):
+    '''Run an image-<glance_cmd> CLI command, or API client method, on an
+    image
+    '''
+    imgid = glance_id(vmid)
+    if imgid is None:
+        return False
+    err_msg = 'failed to %s image in glance: %s' % (glance_cmd, imgid)
+    if use_api():
+        return bool(api_call(err_msg, False,
+                             getattr(glance_api.client(), api_method),
+                             imgid, *args))
+    out = glance_run('image-' + glance_cmd, glance_args=None,
+                     subcmd_args=[imgid] + list(args), err_msg=err_msg)
+    return out is not None
+
+def glance_deactivate(vmid):
+    '''Make image data unavailable, until reactivated by an administrator'''
+    return glance_action(vmid, 'deactivate', 'deactivate')
+
+def glance_tag(vmid, tag):
+    return glance_action(vmid, 'tag-update', 'add_tag', tag)
+
 def glance_update(vmid, *args):
     imgid = glance_id(vmid)
     if imgid is None:
         return False
     err_msg = 'failed to update image from glance: ' + str(imgid)
+    if use_api():
+        client = glance_api.client()
+        image = api_call(err_msg, False, client.show, imgid)
+        changes = image and api_changes(image, args)
+        if not changes:
+            return changes is not None
+        ret = api_call(err_msg, False, client.update, imgid,
+                       changes) is not None
+    else:
+        out = glance_run('image-update', glance_args=None,
+                         subcmd_args=list(args) + [imgid], err_msg=err_msg)
+        ret = out is not None
+    if not ret:
+        _INDEX.invalidate()
+    elif '--name' in args[:-1]:
+        _INDEX.add(imgid, args[list(args).index('--name') + 1])
+    return ret
+
+def format_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return ', '.join(value)
+    return unicode(value)
+
+def format_image(image):
+    '''Format image properties from the API like glance image-show does'''
+    rows = [[key, format_value(value)] for key, value in sorted(image.items())]
+    return openstack_out.format_block(['Property', 'Value'], rows)
+
+def api_changes(image, args):
+    '''JSON patch operations for glance image-update CLI arguments, None if
+    some are not supported
+    '''
+    ret = []
     args = list(args)
-    args.append(imgid)
-    out = glance_run('image-update', glance_args=None, subcmd_args=args,
-                     err_msg=err_msg)
-    return out is not None
+    while args:
+        opt = args.pop(0)
+        if opt == '--remove-property' and args:
+            key = args.pop(0)
+            if key in image:
+                ret.append({'op': 'remove', 'path': '/' + key})
+            continue
+        if opt == '--property' and args:
+            key, _, value = args.pop(0).partition('=')
+        elif opt in ('--name', '--disk-format', '--container-format',
+                     '--visibility') and args:
+            key, value = opt[2:].replace('-', '_'), args.pop(0)
+        elif opt in ('--min-disk', '--min-ram') and args:
+            key, value = opt[2:].replace('-', '_'), int(args.pop(0))
+        else:
+            vprint('glance image-update argument not supported: ' + opt)
+            return None
+        ret.append({'op': 'replace' if key in image else 'add',
+                    'path': '/' + key, 'value': value})
+    return ret
+
+def glance_upload(imgid):
+    '''Upload of image data, in chunks, through the configured backend'''
+    if use_api():
+        return glance_api.client().upload(imgid)
+    return GlanceCliUpload(imgid)
+
+class GlanceCliUpload(object):
+    '''Upload image data, written in chunks, to an image created with
+    glance_create_id(). The data is fed to the standard input of a glance
+    image-upload process, the upload completes when commit() is called.
+    '''
+
+    def __init__(self, imgid):
+        self.imgid = imgid
+        self.out = tempfile.TemporaryFile()
+        self.err = tempfile.TemporaryFile()
+        cmd = glance_cmdline('image-upload', subcmd_args=[imgid])
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                     stdout=self.out, stderr=self.err)
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def commit(self):
+        '''End of data: wait for the upload to complete'''
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        ret = self.proc.wait() == 0
+        if not ret:
+            vprint('failed to upload image data into glance: ' + self.imgid)
+            self.err.seek(0)
+            vprint_lines('stderr=' + self.err.read())
+        self.out.close()
+        self.err.close()
+        return ret
+
+    def abort(self):
+        '''Interrupt the upload before the end of data'''
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        self.out.close()
+        self.err.close()
 
 # Handle CLI options
 def do_argparse(sys_argv):
@@ -192,6 +747,10 @@ def do_argparse(sys_argv):
                        nargs='+', help='delete all images with the same '
                        'name as the specified VM')
 
+    parser.add_argument('-j', '--parallel', type=int, default=_DELETE_PARALLEL,
+                        metavar='N', help='delete up to N images at a time '
+                        '(default: %d)' % _DELETE_PARALLEL)
+
     args = parser.parse_args(sys_argv)
 
     if args.verbose:
@@ -204,10 +763,10 @@ def main(sys_argv=sys.argv[1:]):
     args = do_argparse(sys_argv)
     if args.delete:
         vprint('Trying to delete: "%s"' % str(args.delete))
-        return glance_delete_all(args.delete)
+        return glance_delete_all(args.delete, parallel=args.parallel)
     else:
         vprint('Listing image IDs:')
-        all_images_ids = glance_ids()
+        all_images_ids = glance_refresh(full=True) and glance_ids()
         if all_images_ids:
             for img_id in all_images_ids:
                 print(img_id)
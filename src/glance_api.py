@@ -0,0 +1,436 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2016 Vincent Legoll <vincent.legoll@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+In-process client for the OpenStack Image service v2 REST API, used by
+glance.py instead of spawning the glance command line client for each
+operation: the keystone token is requested once, and renewed when it expires
+or is refused, and requests go through persistent HTTP connections.
+
+It is configured by the usual OS_* environment variables (OS_AUTH_URL,
+OS_USERNAME, OS_PASSWORD, OS_PROJECT_NAME or OS_TENANT_NAME, ...), keystone v3
+or v2.0 being selected by OS_IDENTITY_API_VERSION or the OS_AUTH_URL suffix.
+OS_IMAGE_URL overrides the image endpoint from the service catalog, and with
+OS_TOKEN, skips authentication altogether.
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import socket
+import hashlib
+import calendar
+import argparse
+import threading
+
+try:
+    import httplib
+    from urllib import urlencode
+    from urlparse import urlsplit
+except ImportError: # pragma: no cover
+    import http.client as httplib
+    from urllib.parse import urlencode, urlsplit
+
+import utils
+
+from utils import vprint
+
+_TIMEOUT = 60
+
+_BLOCK_SIZE = 1024 * 1024
+
+# Renew tokens that long before they expire
+_EXPIRY_MARGIN = 60
+
+_PATCH_TYPE = 'application/openstack-images-v2.1-json-patch'
+
+class GlanceApiError(Exception):
+    '''Class to allow catching exceptions from this module'''
+
+    def __init__(self, msg, status=None):
+        super(GlanceApiError, self).__init__(msg)
+        self.status = status
+
+def parse_time(stamp):
+    '''Seconds since the epoch of an ISO 8601 UTC time stamp, as found in
+    keystone tokens
+    '''
+    stamp = stamp.rstrip('Z').split('.')[0]
+    if stamp.endswith('+00:00'):
+        stamp = stamp[:-6]
+    return calendar.timegm(time.strptime(stamp, '%Y-%m-%dT%H:%M:%S'))
+
+def identity_version(environ, auth_url):
+    version = environ.get('OS_IDENTITY_API_VERSION')
+    if version:
+        return version.split('.')[0]
+    if auth_url.rstrip('/').endswith('/v2.0'):
+        return '2'
+    return '3'
+
+class Client(object):
+    '''Authenticated glance v2 API requests, usable from several threads: the
+    token is shared, each thread has its own connections
+    '''
+
+    def __init__(self, environ=None):
+        self.env = dict(os.environ if environ is None else environ)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.endpoint = self.env.get('OS_IMAGE_URL')
+        self.token = None
+        self.expires = None
+        self.project_id = (self.env.get('OS_PROJECT_ID') or
+                           self.env.get('OS_TENANT_ID'))
+        self.auths = 0
+        if self.endpoint and self.env.get('OS_TOKEN'):
+            self.token = self.env['OS_TOKEN']
+
+    # Connections
+
+    def ssl_context(self):
+        import ssl
+        params = self.env.get('OS_PARAMS', '').split()
+        if '--insecure' in params:
+            return ssl._create_unverified_context()
+        return ssl.create_default_context(cafile=self.env.get('OS_CACERT'))
+
+    def new_connection(self, scheme, netloc):
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=_TIMEOUT,
+                                           context=self.ssl_context())
+        return httplib.HTTPConnection(netloc, timeout=_TIMEOUT)
+
+    def connection(self, scheme, netloc):
+        '''Persistent connection of the current thread to a server, and
+        whether it was just opened
+        '''
+        pool = self.local.__dict__.setdefault('pool', {})
+        conn = pool.get((scheme, netloc))
+        if conn is not None:
+            return conn, False
+        conn = pool[(scheme, netloc)] = self.new_connection(scheme, netloc)
+        return conn, True
+
+    def drop_connection(self, scheme, netloc):
+        pool = self.local.__dict__.get('pool', {})
+        conn = pool.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        '''Close the connections of the current thread'''
+        for key in list(self.local.__dict__.get('pool', {})):
+            self.drop_connection(*key)
+
+    def raw_request(self, method, url, body=None, headers=None, stream=False):
+        '''Return the status, headers & body of the response, or the
+        response itself to be read by the caller if streaming
+        '''
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        headers = dict(headers or {})
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+            headers.setdefault('Content-Type', 'application/json')
+        while True:
+            conn, fresh = self.connection(parts.scheme, parts.netloc)
+            try:
+                conn.request(method, path, body, headers)
+                resp = conn.getresponse()
+                if stream:
+                    return resp
+                data = resp.read()
+                break
+            except (httplib.HTTPException, socket.error) as exc:
+                self.drop_connection(parts.scheme, parts.netloc)
+                # A persistent connection may have been closed by the server
+                # since last used: retry once with a new one
+                if fresh:
+                    raise GlanceApiError('%s %s: %s' % (method, url, exc))
+        resp_headers = dict((key.lower(), val)
+                            for key, val in resp.getheaders())
+        if resp.will_close:
+            self.drop_connection(parts.scheme, parts.netloc)
+        return resp.status, resp_headers, data
+
+    # Authentication
+
+    def get_token(self, renew=False):
+        with self.lock:
+            if (renew or self.token is None or (self.expires is not None and
+                    time.time() > self.expires - _EXPIRY_MARGIN)):
+                self.authenticate()
+            return self.token
+
+    def authenticate(self):
+        auth_url = self.env.get('OS_AUTH_URL')
+        if not auth_url:
+            raise GlanceApiError('Cannot authenticate: OS_AUTH_URL not set')
+        auth_url = auth_url.rstrip('/')
+        if identity_version(self.env, auth_url) == '2':
+            token, expires, catalog = self.auth_v2(auth_url)
+        else:
+            token, expires, catalog = self.auth_v3(auth_url)
+        endpoint = self.env.get('OS_IMAGE_URL') or catalog
+        if not endpoint:
+            raise GlanceApiError('No image service endpoint in catalog')
+        self.token = token
+        self.expires = parse_time(expires) if expires else None
+        self.endpoint = endpoint.rstrip('/')
+        self.auths += 1
+
+    def auth_request(self, url, body):
+        status, headers, data = self.raw_request('POST', url, body)
+        if status >= 300:
+            raise GlanceApiError('Authentication failed: %d %s' %
+                                 (status, data[:200]), status)
+        return headers, json.loads(data.decode('utf-8'))
+
+    def select_endpoint(self, catalog, key_url, key_region, interface=None):
+        region = self.env.get('OS_REGION_NAME')
+        for service in catalog:
+            if service.get('type') != 'image':
+                continue
+            for endpoint in service.get('endpoints', []):
+                if interface and endpoint.get('interface') != interface:
+                    continue
+                if region and endpoint.get(key_region) != region:
+                    continue
+                return endpoint.get(key_url)
+        return None
+
+    def auth_v3(self, auth_url):
+        if not auth_url.endswith('/v3'):
+            auth_url += '/v3'
+        env = self.env.get
+        user = {'password': env('OS_PASSWORD', '')}
+        if env('OS_USER_ID'):
+            user['id'] = env('OS_USER_ID')
+        else:
+            user['name'] = env('OS_USERNAME', '')
+            user['domain'] = {'name': env('OS_USER_DOMAIN_NAME', 'Default')}
+        project_id = env('OS_PROJECT_ID') or env('OS_TENANT_ID')
+        if project_id:
+            project = {'id': project_id}
+        else:
+            project = {
+                'name': env('OS_PROJECT_NAME') or env('OS_TENANT_NAME', ''),
+                'domain': {'name': env('OS_PROJECT_DOMAIN_NAME', 'Default')},
+            }
+        body = {'auth': {
+            'identity': {'methods': ['password'], 'password': {'user': user}},
+            'scope': {'project': project},
+        }}
+        headers, data = self.auth_request(auth_url + '/auth/tokens', body)
+        token = data.get('token', {})
+        self.project_id = token.get('project', {}).get('id', project_id)
+        endpoint = self.select_endpoint(token.get('catalog', []), 'url',
+                                        'region_id',
+                                        env('OS_INTERFACE', 'public'))
+        return headers.get('x-subject-token'), token.get('expires_at'), endpoint
+
+    def auth_v2(self, auth_url):
+        env = self.env.get
+        auth = {'passwordCredentials': {'username': env('OS_USERNAME', ''),
+                                        'password': env('OS_PASSWORD', '')}}
+        if env('OS_TENANT_ID'):
+            auth['tenantId'] = env('OS_TENANT_ID')
+        else:
+            auth['tenantName'] = env('OS_TENANT_NAME', '')
+        _, data = self.auth_request(auth_url + '/tokens', {'auth': auth})
+        access = data.get('access', {})
+        token = access.get('token', {})
+        self.project_id = token.get('tenant', {}).get('id', self.project_id)
+        endpoint = self.select_endpoint(access.get('serviceCatalog', []),
+                                        'publicURL', 'region')
+        return token.get('id'), token.get('expires'), endpoint
+
+    # Image API requests
+
+    def url(self, path):
+        self.get_token()
+        return self.endpoint + path
+
+    def request(self, method, path, body=None, headers=None, stream=False):
+        '''Authenticated request to the image API, renewing the token once
+        if refused
+        '''
+        headers = dict(headers or {})
+        for renew in (False, True):
+            headers['X-Auth-Token'] = self.get_token(renew)
+            ret = self.raw_request(method, self.endpoint + path, body, headers,
+                                   stream)
+            status = ret.status if stream else ret[0]
+            if status != 401 or not self.env.get('OS_AUTH_URL'):
+                break
+            if stream:
+                ret.read()
+        if status >= 300:
+            data = ret.read() if stream else ret[2]
+            raise GlanceApiError('%s %s: %d %s' % (method, path, status,
+                                                  data[:200]), status)
+        return ret
+
+    def request_json(self, method, path, body=None, headers=None):
+        _, _, data = self.request(method, path, body, headers)
+        return json.loads(data.decode('utf-8')) if data else None
+
+    def images(self, **filters):
+        '''Generate the images matching filters, following pagination'''
+        path = '/v2/images'
+        if filters:
+            path += '?' + urlencode(sorted(filters.items()))
+        while path:
+            data = self.request_json('GET', path)
+            for image in data.get('images', []):
+                yield image
+            path = data.get('next')
+
+    def show(self, imgid):
+        return self.request_json('GET', '/v2/images/' + imgid)
+
+    def create(self, **fields):
+        return self.request_json('POST', '/v2/images', fields)
+
+    def update(self, imgid, changes):
+        '''Apply a list of JSON patch operations to an image'''
+        return self.request_json('PATCH', '/v2/images/' + imgid, changes,
+                                 {'Content-Type': _PATCH_TYPE})
+
+    def delete(self, imgid):
+        self.request('DELETE', '/v2/images/' + imgid)
+        return True
+
+    def deactivate(self, imgid):
+        self.request('POST', '/v2/images/%s/actions/deactivate' % imgid)
+        return True
+
+    def add_tag(self, imgid, tag):
+        self.request('PUT', '/v2/images/%s/tags/%s' % (imgid, tag))
+        return True
+
+    def download(self, imgid, fout, block_size=_BLOCK_SIZE):
+        '''Write image data to a file object, verified against the checksum
+        sent along, if any
+        '''
+        resp = self.request('GET', '/v2/images/%s/file' % imgid, stream=True)
+        md5 = hashlib.md5()
+        for data in iter(lambda: resp.read(block_size), b''):
+            md5.update(data)
+            fout.write(data)
+        expected = resp.getheader('Content-MD5')
+        if expected and expected != md5.hexdigest():
+            raise GlanceApiError('Downloaded image %s: checksum mismatch' %
+                                 imgid)
+        return True
+
+    def upload(self, imgid):
+        return ImageUpload(self, imgid)
+
+class ImageUpload(object):
+    '''Upload image data, written in chunks, to an image created without
+    data. The data is sent as the chunk-encoded body of a request on its own
+    connection, the upload completes when commit() is called. Same interface
+    as glance.GlanceCliUpload
+    '''
+
+    def __init__(self, client, imgid):
+        self.imgid = imgid
+        self.conn = None
+        self.error = None
+        try:
+            parts = urlsplit(client.url('/v2/images/%s/file' % imgid))
+            self.conn = client.new_connection(parts.scheme, parts.netloc)
+            self.conn.putrequest('PUT', parts.path)
+            self.conn.putheader('X-Auth-Token', client.get_token())
+            self.conn.putheader('Content-Type', 'application/octet-stream')
+            self.conn.putheader('Transfer-Encoding', 'chunked')
+            self.conn.endheaders()
+        except (GlanceApiError, httplib.HTTPException, socket.error) as exc:
+            # Reported by commit(), like the errors of the CLI client
+            self.error = str(exc)
+            self.abort()
+
+    def write(self, data):
+        if data and self.conn is not None:
+            self.conn.send(('%x\r\n' % len(data)).encode('ascii') + data +
+                           b'\r\n')
+
+    def commit(self):
+        '''End of data: wait for the upload to complete'''
+        ret, data = False, self.error
+        try:
+            if self.conn is not None:
+                self.conn.send(b'0\r\n\r\n')
+                resp = self.conn.getresponse()
+                data = resp.read()
+                ret = resp.status < 300
+        except (httplib.HTTPException, socket.error) as exc:
+            ret, data = False, str(exc)
+        if not ret:
+            vprint('failed to upload image data into glance: ' + self.imgid)
+            utils.vprint_lines('error=' + str(data[:200]))
+        self.abort()
+        return ret
+
+    def abort(self):
+        '''Interrupt the upload before the end of data'''
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+_CLIENT = None
+
+def client():
+    '''Client shared by the whole process, configured from the environment'''
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = Client()
+    return _CLIENT
+
+def reset():
+    '''Forget the shared client, for example after changing the environment'''
+    global _CLIENT
+    if _CLIENT is not None:
+        _CLIENT.close()
+    _CLIENT = None
+
+def main(sys_argv=sys.argv[1:]):
+    '''Check the API is reachable with the current environment, and list the
+    images, by ID & name
+    '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='display additional information')
+    args = parser.parse_args(sys_argv)
+    if args.verbose:
+        utils.set_verbose(True)
+    try:
+        for image in client().images():
+            print(image['id'], image.get('name') or '')
+    except GlanceApiError as exc:
+        vprint(str(exc))
+        return False
+    return True
+
+if __name__ == '__main__': # pragma: no cover
+    main()
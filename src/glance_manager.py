@@ -26,12 +26,24 @@ IdGC / France-Grilles sites.
 
 import os
 import sys
+import shutil
 import argparse
+import tempfile
+import xml.etree.ElementTree as et
+
+try:
+    from urllib2 import urlopen, URLError
+except ImportError: # pragma: no cover
+    from urllib.request import urlopen
+    from urllib.error import URLError
 
 import utils
 import glance
+import backup
+import mirror
 import glancing
 import metadata
+import decompressor
 import openstack_out
 
 from utils import vprint
@@ -55,6 +67,27 @@ def do_argparse(sys_argv):
     parser.add_argument('-u', '--url', default=_DEFAULT_SL_MP_URL,
                         help='Market place base URL (default should be OK)')
 
+    parser.add_argument('-m', '--mirror', default=None,
+                        help='Base URL of a glancing caching mirror, to '
+                             'download metadata & images through')
+
+    parser.add_argument('-e', '--endorser', default=None,
+                        help='Only get the marketplace catalogue entries '
+                             'endorsed by this e-mail address')
+
+    parser.add_argument('-r', '--reuse', action='store_true',
+                        help='Keep the uncompressed images left by a '
+                             'previous run, see glancing.py')
+
+    parser.add_argument('-C', '--checkpoint', type=int, default=None,
+                        metavar='BYTES',
+                        help='Record restart points while decompressing '
+                             'images, see glancing.py')
+
+    parser.add_argument('--no-bulk', dest='bulk', action='store_false',
+                        help='Retrieve image metadata one by one, instead of '
+                             'getting the whole marketplace catalogue at once')
+
     args = parser.parse_args(sys_argv)
 
     if args.verbose:
@@ -100,11 +133,14 @@ def get_glance_images():
     global _GLANCE_IMAGES
     if _GLANCE_IMAGES is None:
         _GLANCE_IMAGES = {}
-        add_args = []
+        owner = None
         tenant_msg = 'Using %s environment variable to filter image list'
         if 'OS_TENANT_ID' in os.environ:
             vprint(tenant_msg % 'OS_TENANT_ID')
-            add_args = ['--owner', os.environ['OS_TENANT_ID']]
+            owner = os.environ['OS_TENANT_ID']
+        elif glance.use_api():
+            # Known from authentication
+            owner = glance.glance_project_id()
         elif 'OS_TENANT_NAME' in os.environ:
             vprint(tenant_msg % 'OS_TENANT_NAME')
             cmd = ['keystone', 'tenant-get', os.environ['OS_TENANT_NAME']]
@@ -113,22 +149,19 @@ def get_glance_images():
                 _, block, _, _ = openstack_out.parse_block(out)
                 for prop, val in block:
                     if prop == 'id':
-                        add_args = ['--owner', val]
+                        owner = val
                         break
             else:
                 vprint('Failed to run : %s' % ' '.join(cmd))
                 vprint('OUT: ' + str(out))
                 vprint('ERR: ' + str(err))
-        for imgid in glance.glance_ids(None, *add_args):
-            img = glance.glance_show(imgid)
-            if img:
-                vmmap = openstack_out.map_block(img)
-                if 'mpid' in vmmap:
-                    vprint(("Found 'mpid' property (%(mpid)s) already set on " +
-                            "image: %(id)s (%(name)s)") % vmmap)
-                    _GLANCE_IMAGES[vmmap['mpid']] = vmmap
-                _GLANCE_IMAGES[vmmap['checksum']] = vmmap
-                _GLANCE_IMAGES[vmmap['name']] = vmmap
+        for vmmap in glance.glance_inventory(owner) or []:
+            if 'mpid' in vmmap:
+                vprint(("Found 'mpid' property (%(mpid)s) already set on " +
+                        "image: %(id)s (%(name)s)") % vmmap)
+                _GLANCE_IMAGES[vmmap['mpid']] = vmmap
+            _GLANCE_IMAGES[vmmap['checksum']] = vmmap
+            _GLANCE_IMAGES[vmmap['name']] = vmmap
     return _GLANCE_IMAGES
 
 def get_meta_file(mpid, metadata_url_base):
@@ -145,8 +178,37 @@ def get_meta_file(mpid, metadata_url_base):
     os.rename(fn_meta, fn_meta + '.xml')
     return fn_meta + '.xml'
 
-def needs_upgrade(mpid, old, new, meta_file):
+def get_meta_files(mpids, metadata_url_base, endorser=None):
+    '''Retrieve metadata of all the given images from the StratusLab
+       marketplace catalogue, with a single request.
+       Return {mpid: (meta_file, metadata)} for the images found, the others
+       have to be retrieved one by one, with get_meta_file()
+    '''
+    url_cat = metadata_url_base.rstrip('/')
+    if endorser:
+        url_cat += '/-/' + endorser
+    url_cat += '?media=xml'
+    vprint('Getting marketplace catalogue from: ' + url_cat)
+    try:
+        url_f = urlopen(url_cat)
+        catalog = metadata.MetaStratusLabXmlCatalog(url_f)
+        entries = catalog.get_all_metadata(set(mpids))
+    except (URLError, IOError, et.ParseError) as exc:
+        vprint('Cannot use marketplace catalogue, falling back to one '
+               'request per image: ' + str(exc))
+        return {}
+    ret = {}
+    for mpid, (data, xml) in entries.items():
+        with tempfile.NamedTemporaryFile(suffix='.xml', delete=False) as fout:
+            fout.write(xml)
+        ret[mpid] = (fout.name, data)
+    vprint('Found %d out of %d images in marketplace catalogue' %
+           (len(ret), len(mpids)))
+    return ret
+
+def needs_upgrade(mpid, old, new, meta_file, mirror_base=None, options=()):
     '''Handle an image already put in glance in a previous run
+       options are passed on to glancing.py
     '''
     old_md5 = old['checksum']
     old_name = old['name']
@@ -163,22 +225,60 @@ def needs_upgrade(mpid, old, new, meta_file):
         vprint("md5 differ")
         if new_ver > old_ver:
             vprint("New image version")
+            # Delta download from the previous version: into the backup
+            # store with it, before it is renamed out of the way
+            delta = False
+            if mirror_base:
+                compressed = decompressor.compression_ext(
+                    new.get('compression')) is not None
+                reason = glancing.delta_unsupported(mirror_base, compressed)
+                if reason is not None:
+                    vprint(reason)
+                elif backup.store_version(old_name, old['id'],
+                                          glancing.get_backup_dir()):
+                    delta = True
+                else:
+                    vprint('Warning: Cannot back up previous version, no '
+                           'delta download')
             if not glance.glance_rename(old_name, old_name + '_old'):
                 vprint('Warning: Cannot rename old image, will need manual '
                        'intervention')
             vprint("Previous image renamed to: " + old_name + '_old')
-            upload_image(mpid, new_name, meta_file)
+            base = None
+            basedir = None
+            if delta:
+                # Latest backup of the previous version, if any
+                basedir = tempfile.mkdtemp(prefix='glancing-base-',
+                                           dir=glancing.get_scratch_dir())
+                base = backup.restore_latest(old_name,
+                                             glancing.get_backup_dir(),
+                                             basedir)
+            try:
+                upload_image(mpid, new_name, meta_file, mirror_base, base,
+                             options)
+            finally:
+                if basedir is not None:
+                    shutil.rmtree(basedir)
             update_properties(mpid, old, new)
         elif new_ver < old_ver:
             vprint("NO-OP: downgraded image")
         else:
             vprint("NO-OP: corrupted image (same version, md5 differ)")
 
-def upload_image(mpid, name, meta_file):
+def upload_image(mpid, name, meta_file, mirror_base=None, delta_base=None,
+                 options=()):
     '''Upload new image into glance registry, using metadata file content
+       Only the blocks differing from delta_base are downloaded, if given.
+       options are passed on to glancing.py
     '''
     vprint("Uploading new image: %s (%s)" % (mpid, name))
-    ret = glancing.main(['-v', '-n', name, meta_file])
+    glancing_args = ['-v'] + list(options) + ['-n', name, meta_file]
+    if mirror_base:
+        glancing_args[0:0] = ['-m', mirror_base]
+    if delta_base:
+        vprint("Using previous version as delta base: " + delta_base)
+        glancing_args[0:0] = ['-B', delta_base]
+    ret = glancing.main(glancing_args)
     # Invalidate glance image cache
     # TODO: maybe just add the new one
     global _GLANCE_IMAGES
@@ -223,23 +323,28 @@ def update_properties(mpid, old, new):
         vprint("NO-OP: All properties have the right values")
     return True
 
-def handle_vm(mpid, url):
+def handle_vm(mpid, url, mirror_base=None, record=None, options=()):
     '''Handle one image given by its SL marketplace ID
+       record is the (meta_file, metadata) pair from get_meta_files(), if any
+       options are passed on to glancing.py
     '''
     vprint('Handle image with marketplace ID : %s' % mpid)
 
-    meta_file = get_meta_file(mpid, url)
-    if meta_file is None:
-        return
+    if record is not None:
+        meta_file, new = record
+    else:
+        meta_file = get_meta_file(mpid, url)
+        if meta_file is None:
+            return
+        new = metadata.MetaStratusLabXml(meta_file).get_metadata()
 
     # TODO: delete meta_file to avoid filling /tmp
-
-    new = metadata.MetaStratusLabXml(meta_file).get_metadata()
     vmmap = get_glance_images()
 
     if mpid in vmmap:
         vprint("Image is already in glance")
-        needs_upgrade(mpid, vmmap[mpid], new, meta_file)
+        needs_upgrade(mpid, vmmap[mpid], new, meta_file, mirror_base,
+                      options)
         # TODO: check other image properties, they should match perfectly
     else:
         vprint("No image with the same marketplace ID found in glance")
@@ -325,7 +430,8 @@ def handle_vm(mpid, url):
 
             vprint("Previous image renamed to: " + old_name + '_old')
 
-        ret = upload_image(mpid, new_name, meta_file)
+        ret = upload_image(mpid, new_name, meta_file, mirror_base,
+                           options=options)
         if ret:
             ret = set_properties(mpid, new)
         return ret
@@ -343,10 +449,20 @@ def main(sys_argv=sys.argv[1:]):
             vprint('Cannot access image list file: ' + img_list_file)
             return False
     vmlist = get_vmlist(args.vmlist)
+    url = mirror.mirror_url(args.mirror, args.url)
+    # glancing.py options
+    options = []
+    if args.reuse:
+        options.append('-r')
+    if args.checkpoint:
+        options.extend(['-C', str(args.checkpoint)])
+    records = {}
+    if args.bulk:
+        records = get_meta_files(vmlist, url, args.endorser)
     for vmid in vmlist:
         vmid = vmid.strip()
         if vmid:
-            handle_vm(vmid, args.url)
+            handle_vm(vmid, url, args.mirror, records.get(vmid), options)
     return True
 
 if __name__ == '__main__': # pragma: no cover
@@ -25,11 +25,17 @@ import os
 import re
 import sys
 #import base64
+import hashlib
+import tarfile
 import binascii
+import calendar
 import tempfile
+import functools
 import textwrap
 import argparse
 
+from email.utils import parsedate
+
 try:
     from urllib2 import urlopen, URLError, HTTPError
     from urlparse import urlsplit
@@ -40,12 +46,17 @@ except ImportError:
 
 import utils
 import glance
+import delta
+import backup
 import multihash
+import mirror
 import decompressor
 import metadata as md
 
 from utils import vprint, size_t
 
+_PIPELINE_BLOCK_SIZE = 64 * 1024
+
 # Handle CLI options
 def do_argparse(sys_argv):
     desc_help = textwrap.dedent('''
@@ -81,7 +92,61 @@ def do_argparse(sys_argv):
                         help='Image list from CERN, as a JSON file')
 
     parser.add_argument('-b', '--backup-dir', dest='backupdir',
-                        help='Backup already existing images in this directory')
+                        help=('Backup already existing images in this '
+                              'directory, implies "--backup store"'))
+
+    parser.add_argument('--backup', dest='backup', default=None,
+                        choices=backup.STRATEGIES,
+                        help=('How to backup already existing images: keep '
+                              'them in glance renamed with a timestamp, also '
+                              'deactivated or tagged, download them into the '
+                              'deduplicating chunk store of the backup '
+                              'directory, or to a single file there, or not '
+                              'at all. Default: GLANCING_BACKUP_STRATEGY, or '
+                              'rename'))
+
+    parser.add_argument('--backup-keep', dest='backupkeep', type=int,
+                        default=backup._KEEP, metavar='NUMBER',
+                        help=('Number of backups kept in glance, or in the '
+                              'chunk store, for an image (default: %d)' %
+                              backup._KEEP))
+
+    parser.add_argument('--backup-max-age', dest='backupmaxage', type=float,
+                        default=None, metavar='DAYS',
+                        help=('Delete backups kept in glance, or in the '
+                              'chunk store, older than that'))
+
+    parser.add_argument('-r', '--reuse', action='store_true',
+                        help=('Keep the uncompressed image left by a '
+                              'previous run, instead of decompressing again, '
+                              'if the compressed image did not change since'))
+
+    parser.add_argument('-C', '--checkpoint', type=int, default=None,
+                        metavar='BYTES',
+                        help=('Record restart points at least that many '
+                              'uncompressed bytes apart while decompressing '
+                              'gzip & bzip2 images, so that a failed run '
+                              'resumes from the last one'))
+
+    parser.add_argument('-m', '--mirror', dest='mirror', default=None,
+                        help=('Base URL of a glancing caching mirror, to '
+                              'download metadata & images through'))
+
+    parser.add_argument('-B', '--delta-base', dest='deltabase', default=None,
+                        help=('Previous version of the image, only download '
+                              'the blocks that changed since then. Needs a '
+                              'mirror (-m), and an uncompressed image'))
+
+    parser.add_argument('-p', '--pipeline', action='store_true',
+                        help=('Stream the image through decompression, '
+                              'checksums verification and glance upload in '
+                              'a single pass, without temporary files. The '
+                              'image only replaces the old one if verified'))
+
+    parser.add_argument('-M', '--member', default=None,
+                        help=('Name pattern of the disk image in tar / OVA '
+                              'bundles (default: the largest member, needs '
+                              'a pattern with -p)'))
 
     digests_help = ('''>>>
         A colon-separated list of message digests of the image.
@@ -131,9 +196,9 @@ def do_argparse(sys_argv):
 
     return args
 
-def get_url(url):
-    '''Retrieve content from URL into a temporary file.
-       Return temporary file name.
+def get_url(url, fname=None):
+    '''Retrieve content from URL into a temporary file, or into fname, see
+       get_url_into(). Return file name.
     '''
     if not url or not isinstance(url, (str, unicode)):
         return None
@@ -153,13 +218,11 @@ def get_url(url):
             #       metadata mode
             if not os.path.exists(url):
                 return None
-            else:
-                url_f = open(url, 'r')
-                if not url_f:
-                    vprint(str(exc))
-                    return None
+            return get_local(url)
         else:
             raise exc
+    if fname is not None:
+        return get_url_into(url_f, fname)
     with tempfile.NamedTemporaryFile(bufsize=4096, delete=False) as fout:
         try:
             utils.block_read_filedesc(url_f, fout.write, 4096)
@@ -169,6 +232,252 @@ def get_url(url):
             return None
     return fout.name
 
+def download_name(url):
+    '''Stable local file name for the content of URL, for a rerun to find
+       the files left by a previous one, see --reuse & --checkpoint
+    '''
+    digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return os.path.join(tempfile.gettempdir(), 'glancing-' + digest)
+
+def remote_mtime(url_f):
+    '''Modification time of the content of an opened URL, or None'''
+    date = url_f.info().get('Last-Modified')
+    parsed = parsedate(date) if date else None
+    return calendar.timegm(parsed) if parsed else None
+
+def get_url_into(url_f, fname):
+    '''Retrieve the content of an opened URL into fname, unless already
+       there from a previous run: same size & modification time as the
+       remote file, which the local copy is given, for its fingerprint not
+       to change as long as the remote content does not.
+       Return file name.
+    '''
+    mtime = remote_mtime(url_f)
+    length = url_f.info().get('Content-Length')
+    try:
+        stat = os.stat(fname)
+    except OSError:
+        stat = None
+    if (stat is not None and mtime is not None and length is not None and
+            stat.st_mtime == mtime and stat.st_size == int(length)):
+        vprint(fname + ': unchanged since downloaded')
+        url_f.close()
+        return fname
+    tmp_name = fname + '.part'
+    try:
+        with open(tmp_name, 'wb') as fout:
+            utils.block_read_filedesc(url_f, fout.write, 4096)
+        if mtime is not None:
+            os.utime(tmp_name, (mtime, mtime))
+        os.rename(tmp_name, fname)
+    except (IOError, OSError):
+        vprint('cannot write file: ' + tmp_name)
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        return None
+    return fname
+
+def get_local(path):
+    '''Copy local file content into a temporary file, as cheaply as the
+       filesystem allows. Return temporary file name.
+    '''
+    # Next to the source, on the same filesystem, to be able to reflink
+    try:
+        fout = tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or '.',
+                                           delete=False)
+    except (IOError, OSError):
+        fout = tempfile.NamedTemporaryFile(delete=False)
+    with fout:
+        try:
+            with open(path, 'rb') as fin:
+                how = utils.copy_filedesc(fin.fileno(), fout.fileno())
+        except (IOError, OSError):
+            vprint('cannot write temp file: ' + fout.name)
+            os.remove(fout.name)
+            return None
+    vprint('%s: copied from %s (%s)' % (fout.name, path, how))
+    return fout.name
+
+def get_backup_dir(backupdir=None):
+    '''Directory where images being replaced are backed up'''
+    if backupdir:
+        return backupdir
+    return os.environ.get('GLANCING_BACKUP_DIR', '/tmp/glancing')
+
+def get_scratch_dir():
+    '''Directory where to decompress images that do not fit next to their
+       download, if any
+    '''
+    return os.environ.get('GLANCING_SCRATCH_DIR')
+
+def delta_unsupported(mirror_base, compressed):
+    '''Why an image cannot be downloaded as a delta, None if it can'''
+    if not mirror_base:
+        return 'delta download needs a mirror publishing block maps'
+    if compressed:
+        return 'delta download of compressed images is not supported'
+    return None
+
+def get_delta(url, base_file, mirror_base, compressed):
+    '''Retrieve URL content into a temporary file, only downloading the
+       blocks that are not already in base_file.
+       Return temporary file name, or None if a full download is needed.
+    '''
+    reason = delta_unsupported(mirror_base, compressed)
+    if reason is not None:
+        vprint(reason)
+    elif not os.path.isfile(base_file):
+        vprint('delta download base not found: ' + base_file)
+    else:
+        return delta.get_delta(mirror.mirror_url(mirror_base, url),
+                               mirror.blockmap_url(mirror_base, url),
+                               base_file)
+    return None
+
+def rerunnable(args):
+    '''Whether a run leaves files for the next one to reuse, or resume'''
+    return args.reuse or args.checkpoint is not None
+
+# Backup image in glance, getting it out of the way of its new version
+def backup_image(name, args):
+    maxage = args.backupmaxage
+    if maxage is not None:
+        maxage *= 24 * 60 * 60
+    try:
+        strategy = backup.get_strategy(args.backup, args.backupdir)
+    except backup.BackupError as exc:
+        vprint(str(exc))
+        return False
+    return backup.backup_image(name, strategy, get_backup_dir(args.backupdir),
+                               args.backupkeep, maxage)
+
+def open_image(source, mirror_base=None):
+    '''Open a local file or URL for reading'''
+    if os.path.exists(source):
+        return open(source, 'rb')
+    return urlopen(mirror.mirror_url(mirror_base, source))
+
+def sniff_compression(source, detected, chext):
+    '''Reconcile the compression label of an image with its format detected
+       from content. Return the decompressor extension to use, or None.
+    '''
+    if decompressor.is_compressed(detected):
+        if detected != chext:
+            vprint('%s: compressed as %s, labelled: %s' %
+                   (source, detected, chext))
+        return detected
+    if decompressor.is_uncompressed(detected) and chext is not None:
+        vprint('%s: not compressed (%s), labelled: %s' %
+               (source, detected, chext))
+        return None
+    return chext
+
+def sniff_disk_format(source, detected, metadata):
+    '''Fix the disk format of a qcow2 image announced as raw'''
+    if detected == 'qcow2' and metadata['format'] == 'raw':
+        vprint(source + ': qcow2 image, labelled raw')
+        metadata['format'] = 'qcow2'
+
+def import_pipeline(source, name, metadata, args):
+    '''Stream the image from source through decompression, message digests
+       computation and glance upload, in a single pass without temporary
+       files. The uploaded image only replaces an existing one with the same
+       name after its size and checksums are verified, else it is deleted.
+    '''
+    mhash = multihash.multihash_hashlib(metadata['checksums'])
+    chext = decompressor.compression_ext(metadata.get('compression'))
+    reader = None
+    try:
+        reader = decompressor.DecompressingReader(
+            open_image(source, args.mirror), chext, _PIPELINE_BLOCK_SIZE,
+            close_source=True)
+        src = reader
+        head = reader.peek(_PIPELINE_BLOCK_SIZE)
+        if decompressor.detect_magic(head) == '.tar':
+            vprint(source + ': tar bundle')
+            src = decompressor.tar_open(reader, args.member)
+    except (IOError, URLError, tarfile.TarError,
+            decompressor.DecompressorError) as exc:
+        vprint('%s: %s' % (source, exc))
+        if reader is not None:
+            reader.close()
+        return False
+    vprint('%s: detected format: %s' % (source, reader.detected))
+    # The reader decompresses according to the detected format
+    if reader.ext != chext and src is reader:
+        vprint('%s: decompressing as: %s, labelled: %s' %
+               (source, reader.ext, chext))
+    sniff_disk_format(source, reader.detected, metadata)
+
+    upload = None
+    if not args.dryrun:
+        imgid = glance.glance_create_id(name + '.glancing-upload',
+                                        metadata['format'])
+        if not imgid:
+            reader.close()
+            return False
+        upload = glance.glance_upload(imgid)
+
+    vprint('%s: streaming image' % source)
+    # Of the image, not of the whole tar stream for bundles
+    size = 0
+    try:
+        with reader:
+            for data in iter(functools.partial(src.read, _PIPELINE_BLOCK_SIZE),
+                             b''):
+                size += len(data)
+                mhash.update(data)
+                if upload is not None:
+                    upload.write(data)
+        ok = True
+    except (IOError, URLError, tarfile.TarError,
+            decompressor.DecompressorError) as exc:
+        vprint('%s: %s' % (source, exc))
+        ok = False
+
+    # Verify image size & checksums before committing the upload
+    if ok and 'bytes' in metadata:
+        ok = int(metadata['bytes']) == size
+        if ok:
+            vprint('%s: size: OK: %s' % (source, size_t(size)))
+        else:
+            vprint('%s: size: expected: %d' % (source, int(metadata['bytes'])))
+            vprint('%s: size:   actual: %d' % (source, size))
+    if ok and not args.nocheck:
+        if not metadata['checksums']:
+            vprint(source + ': no checksum to verify')
+        verified = compare_digests(source, mhash.hexdigests(), metadata,
+                                   args.force)
+        ok = verified == len(metadata['checksums'])
+    if not ok and args.force:
+        vprint(source + ': verification failed, but forcing import')
+        ok = True
+
+    if upload is None:
+        return ok
+    if not ok:
+        upload.abort()
+    elif not upload.commit():
+        ok = False
+    if not ok:
+        vprint('%s: deleting unverified upload: %s' % (source, imgid))
+        glance.glance_delete(imgid, quiet=(not utils.get_verbose()))
+        return False
+
+    # Commit: replace the old image with the verified one
+    if glance.glance_exists(name) and not backup_image(name, args):
+        ok = False
+    else:
+        vprint(source + ': importing into glance as "%s"' % str(name))
+        ok = glance.glance_rename(imgid, name)
+    if not ok:
+        vprint('%s: deleting upload that could not replace "%s": %s' %
+               (source, name, imgid))
+        if not glance.glance_delete(imgid, quiet=(not utils.get_verbose())):
+            vprint('%s: cannot delete upload, remove it manually: %s' %
+                   (source, imgid))
+    return ok
+
 # Add to metadata['checksums'] a new message digest to be verified
 def add_checksum(dig, metadata, overrides=False):
     try:
@@ -190,11 +499,15 @@ def add_checksum(dig, metadata, overrides=False):
 
 # Check all message digests of the image file
 def check_digests(local_image_file, metadata, replace_bads=False):
+    mhash = multihash.multihash_hashlib(metadata['checksums'])
+    mhash.hash_file(local_image_file)
+    return compare_digests(local_image_file, mhash.hexdigests(), metadata,
+                           replace_bads)
+
+# Compare computed message digests with the ones from metadata
+def compare_digests(local_image_file, hds, metadata, replace_bads=False):
     verified = 0
     hashes = metadata['checksums']
-    mhash = multihash.multihash_hashlib(hashes)
-    mhash.hash_file(local_image_file)
-    hds = mhash.hexdigests()
     for hashfn in sorted(hashes):
         digest_computed = hds[hashfn]
         digest_expected = hashes[hashfn]
@@ -257,7 +570,8 @@ def main(sys_argv=sys.argv[1:]):
         # Get xml metadata file from StratusLab marketplace
         metadata_url_base = 'https://marketplace.stratuslab.eu/marketplace/metadata/'
         sl_md_url = metadata_url_base + args.descriptor
-        local_metadata_file = get_url(sl_md_url)
+        local_metadata_file = get_url(mirror.mirror_url(args.mirror,
+                                                        sl_md_url))
         if local_metadata_file is None:
             vprint('cannot get xml metadata file from StratuLab marketplace: ' + sl_md_url)
             return False
@@ -282,6 +596,10 @@ def main(sys_argv=sys.argv[1:]):
         vprint('Cannot retrieve metadata')
         return False
 
+    # VM images are compressed, but checksums are for uncompressed files
+    chext = decompressor.compression_ext(metadata.get('compression'))
+    compressed = chext is not None
+
     # Retrieve image in a local file
     if image_type == 'image':
         # Already a local file
@@ -292,23 +610,69 @@ def main(sys_argv=sys.argv[1:]):
             url = metadata['location']
         elif image_type == 'url':
             url = args.descriptor
-        local_image_file = get_url(url)
-        if not local_image_file or not os.path.exists(local_image_file):
-            vprint('cannot download from: ' + url)
-            return False
-        vprint(local_image_file + ': downloaded image from: ' + url)
-
-    # VM images are compressed, but checksums are for uncompressed files
-    compressed = ('compression' in metadata and metadata['compression'] and
-                  metadata['compression'].lower() != 'none')
-    if compressed:
-        chext = '.' + metadata['compression']
-        decomp = decompressor.Decompressor(local_image_file, ext=chext)
+        local_image_file = None
+        if args.pipeline:
+            # Streamed later, once checksums are known: see import_pipeline()
+            local_image_file = url
+        elif args.deltabase:
+            local_image_file = get_delta(url, args.deltabase, args.mirror,
+                                         compressed)
+        if local_image_file is None:
+            # Under the same name as in a previous run, for its leftovers to
+            # be found
+            fname = download_name(url) if rerunnable(args) else None
+            local_image_file = get_url(mirror.mirror_url(args.mirror, url),
+                                       fname)
+        if not args.pipeline:
+            if not local_image_file or not os.path.exists(local_image_file):
+                vprint('cannot download from: ' + url)
+                return False
+            vprint(local_image_file + ': downloaded image from: ' + url)
+
+    # Labels can be wrong: trust the content
+    if not args.pipeline:
+        detected = decompressor.detect_format(local_image_file)
+        vprint('%s: detected format: %s' % (local_image_file, detected))
+        if image_type != 'image':
+            chext = sniff_compression(local_image_file, detected, chext)
+            if decompressor.detect_bundle(local_image_file):
+                vprint(local_image_file + ': tar bundle')
+                chext = '.tar'
+            compressed = chext is not None
+        elif decompressor.is_compressed(detected):
+            vprint(local_image_file + ': looks compressed, importing as is')
+
+    decomp = None
+    if compressed and not args.pipeline:
+        size = int(metadata['bytes']) if 'bytes' in metadata else None
+        # A complete output is as far as a checkpointed run can resume
+        decomp = decompressor.Decompressor(local_image_file, ext=chext,
+                                           size=size, member=args.member,
+                                           reuse=rerunnable(args),
+                                           checkpoint=args.checkpoint)
+        if size is None and decompressor.size_is_exact(decomp.ext):
+            # The archive tells what to expect, have it verified
+            if decomp.hint is not None:
+                vprint('%s: expected size from archive: %d' %
+                       (local_image_file, decomp.hint))
+                metadata['bytes'] = decomp.hint
+        if get_scratch_dir() and not decomp.admit():
+            vprint('%s: decompressing into: %s' %
+                   (local_image_file, get_scratch_dir()))
+            decomp = decompressor.Decompressor(local_image_file, ext=chext,
+                                               size=size, member=args.member,
+                                               reuse=rerunnable(args),
+                                               checkpoint=args.checkpoint,
+                                               outdir=get_scratch_dir())
         res, local_image_file = decomp.doit(delete=(not args.keeptemps))
         if not res:
             vprint(local_image_file + ': cannot uncompress')
             return False
         vprint(local_image_file + ': uncompressed file')
+        detected = decompressor.detect_format(local_image_file)
+
+    if not args.pipeline:
+        sniff_disk_format(local_image_file, detected, metadata)
 
     if image_type == 'image':
         base_name = os.path.basename(local_image_file)
@@ -333,7 +697,8 @@ def main(sys_argv=sys.argv[1:]):
         re_chks_line = re.compile(r'(?P<digest>[a-zA-Z0-9]+)\s+(?P<filename>.+)')
         for sum_file in args.sums_files:
             if sum_file.startswith(('http://', 'https://')):
-                local_sum_file = get_url(sum_file)
+                local_sum_file = get_url(mirror.mirror_url(args.mirror,
+                                                           sum_file))
                 if not local_sum_file or not os.path.exists(local_sum_file):
                     vprint('cannot download from: ' + sum_file)
                     return False
@@ -362,6 +727,9 @@ def main(sys_argv=sys.argv[1:]):
             if not ret:
                 return False
 
+    if args.pipeline:
+        return import_pipeline(local_image_file, name, metadata, args)
+
     # Verify image size
     size_ok = True
     if 'bytes' in metadata:
@@ -401,27 +769,10 @@ def main(sys_argv=sys.argv[1:]):
                 vprint(local_image_file +
                        ': size differ, not verifying checksums')
 
-    # If image already exists, download it to backup directory prior to deleting
+    # If image already exists, back it up, out of the way of the new one
     if not args.dryrun and glance.glance_exists(name):
-        if args.backupdir:
-            backupdir = args.backupdir
-        else:
-            backupdir = os.environ.get('GLANCING_BACKUP_DIR', '/tmp/glancing')
-
-        do_backup = True
-        if not os.path.exists(backupdir):
-            os.mkdir(backupdir)
-        elif not os.path.isdir(backupdir):
-            vprint(backupdir + ' exists but is not a directory, sorry '
-                   'cannot backup old images...')
-            do_backup = False
-
-        if do_backup:
-            fn_local = os.path.join(backupdir, name)
-            status = glance.glance_download(name, fn_local)
-            if not status:
-                return False
-        glance.glance_delete(name, quiet=(not utils.get_verbose()))
+        if not backup_image(name, args):
+            return False
 
     # Import image into glance
     if not args.dryrun:
@@ -446,6 +797,8 @@ def main(sys_argv=sys.argv[1:]):
     if not image_type == 'image' and not args.keeptemps:
         vprint(local_image_file + ': deleting temporary file')
         os.remove(local_image_file)
+        if decomp is not None:
+            decomp.remove_sidecars()
 
     # That's all folks !
     return True
@@ -183,15 +183,60 @@ class MetaStratusLabXml(MetaDataBase):
         else:
             rdf = root
         desc = rdf.find('rdf:Description', nsp)
-        for cksum in desc.findall('slreq:checksum', nsp):
-            algo = cksum.find('slreq:algorithm', nsp)
-            val = cksum.find('slreq:value', nsp)
-            ret['checksums'][sl_to_hashlib(algo.text)] = val.text
-        for key, val in StratusLabNS._RETKEY_TO_NS_PREFIXES.items():
-            if key == 'algorithm':
+        return sl_xml_description(desc, ret)
+
+def sl_xml_description(desc, ret):
+    '''Extract interesting data from a StratusLab marketplace XML
+       "rdf:Description" element into the ret dict
+    '''
+    nsp = StratusLabNS._NS_TO_URL_PREFIXES
+    for cksum in desc.findall('slreq:checksum', nsp):
+        algo = cksum.find('slreq:algorithm', nsp)
+        val = cksum.find('slreq:value', nsp)
+        ret['checksums'][sl_to_hashlib(algo.text)] = val.text
+    for key, val in StratusLabNS._RETKEY_TO_NS_PREFIXES.items():
+        if key == 'algorithm':
+            continue
+        mdkey = val + ':' + key
+        node = desc.find(mdkey, nsp)
+        if node is not None:
+            ret[key] = node.text
+    return ret
+
+class MetaStratusLabXmlCatalog(object):
+    '''Parse a StratusLab marketplace XML catalogue, holding the metadata of
+       many images, in a single streaming pass.
+       When an image has multiple entries, the latest endorsed one is kept.
+    '''
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def get_all_metadata(self, wanted=None):
+        '''Return a {identifier: (metadata, xml)} mapping, for all the images
+           in the catalogue, or only for those whose identifier is in wanted.
+           xml is a standalone document, loadable with MetaStratusLabXml
+        '''
+        nsp = StratusLabNS._NS_TO_URL_PREFIXES
+        for prefix, url in nsp.items():
+            if prefix != 'base':
+                et.register_namespace(prefix, url)
+        desc_tag = '{%s}Description' % nsp['rdf']
+        ret = {}
+        dates = {}
+        for _, elem in et.iterparse(self.fileobj):
+            if elem.tag != desc_tag:
                 continue
-            mdkey = val + ':' + key
-            node = desc.find(mdkey, nsp)
-            if node is not None:
-                ret[key] = node.text
+            ident = elem.findtext('dcterms:identifier', None, nsp)
+            if ident and (wanted is None or ident in wanted):
+                date = elem.findtext('slreq:endorsement/dcterms:created',
+                                     '', nsp)
+                if ident not in dates or date > dates[ident]:
+                    dates[ident] = date
+                    rdf = et.Element('{%s}RDF' % nsp['rdf'])
+                    rdf.append(elem)
+                    data = sl_xml_description(elem, {'checksums': {}})
+                    ret[ident] = (data, et.tostring(rdf))
+            # Do not keep the whole catalogue in memory
+            elem.clear()
         return ret
@@ -0,0 +1,581 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2016 Vincent Legoll <vincent.legoll@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Caching HTTP mirror for marketplace metadata & VM images.
+
+Upstream resources are made available through the mirror at:
+
+    http://<mirror>/<scheme>/<host>/<path>[?<query>]
+
+Each resource is retrieved only once from upstream, and served to all
+requesters from the local cache, even while it is still being downloaded.
+
+The block map of a resource, used for delta downloads (see delta.py), is
+available at:
+
+    http://<mirror>/blockmap/<scheme>/<host>/<path>[?<query>]
+
+Only the upstream hosts given are mirrored, requests for others are refused.
+
+Images are only admitted into the cache once their size, and their message
+digests, are verified. The digests are taken from the image lists given, and
+from the metadata files going through the mirror: StratusLab marketplace
+metadata or catalogues, and CERN image lists. When upstream cannot be reached
+to revalidate a cached resource, the cached copy is served.
+'''
+
+import os
+import re
+import sys
+import json
+import time
+import fnmatch
+import hashlib
+import argparse
+import functools
+import threading
+import xml.etree.ElementTree as et
+
+from email.utils import formatdate
+
+try:
+    from urllib2 import urlopen, Request, URLError, HTTPError
+    from urlparse import urlsplit
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError: # pragma: no cover
+    from urllib.request import urlopen, Request
+    from urllib.error import URLError, HTTPError
+    from urllib.parse import urlsplit
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+import delta
+import utils
+import multihash
+import decompressor
+import metadata as md
+from utils import vprint
+
+_DEFAULT_CACHE_DIR = os.path.join('/', 'var', 'cache', 'glancing')
+_BLOCK_SIZE = 64 * 1024
+
+_RE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Larger resources are not looked into for image metadata
+_METADATA_MAX_SIZE = 1024 * 1024
+
+def mirror_url(mirror_base, url):
+    '''Translate an upstream URL into its location on the mirror
+    '''
+    scheme, netloc, path, query, _ = urlsplit(url)
+    # Local files are not mirrored
+    if not mirror_base or scheme not in ('http', 'https'):
+        return url
+    ret = '%s/%s/%s%s' % (mirror_base.rstrip('/'), scheme, netloc, path)
+    if query:
+        ret += '?' + query
+    return ret
+
+def blockmap_url(mirror_base, url):
+    '''Location of an upstream resource's block map on the mirror
+    '''
+    return mirror_url(mirror_base.rstrip('/') + '/blockmap', url)
+
+def upstream_url(path):
+    '''Translate a mirror request path back into its upstream URL
+    '''
+    parts = path.lstrip('/').split('/', 2)
+    if len(parts) < 3 or parts[0] not in ('http', 'https') or not parts[1]:
+        return None
+    return '%s://%s/%s' % tuple(parts)
+
+def host_allowed(url, patterns):
+    '''Tell if the host of an URL, or its host:port, matches one of the
+       shell-style patterns
+    '''
+    parts = urlsplit(url)
+    names = [(parts.hostname or '').lower(), parts.netloc.lower()]
+    return any(fnmatch.fnmatch(name, pattern.lower())
+               for pattern in patterns for name in names)
+
+def image_metadata(fname):
+    '''{image URL: metadata} of the images described in a file: StratusLab
+       XML metadata or catalogue, StratusLab JSON metadata, or CERN JSON
+       image list. Empty if it is none of those
+    '''
+    images = []
+    try:
+        with open(fname, 'rb') as fin:
+            catalogue = md.MetaStratusLabXmlCatalog(fin).get_all_metadata()
+        images = [data for data, _ in catalogue.values()]
+    except et.ParseError:
+        try:
+            with open(fname, 'rb') as fin:
+                obj = json.loads(fin.read())
+            if isinstance(obj, dict) and 'hv:imagelist' in obj:
+                images = md.MetaCern(fname, None).all_images.values()
+            elif isinstance(obj, dict):
+                images = [md.MetaStratusLabJson(fname).get_metadata()]
+        except (ValueError, KeyError, TypeError, AttributeError,
+                IndexError):
+            pass
+    except (IOError, KeyError, TypeError, AttributeError):
+        pass
+    return dict((data['location'], data) for data in images
+                if data and data.get('location') and data.get('checksums'))
+
+def parse_range(header, size):
+    '''Parse a single-range "Range:" HTTP header into [start, end) offsets.
+       Return None if the header has to be ignored, raise ValueError if it
+       cannot be satisfied.
+    '''
+    match = _RE_RANGE.match(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError('Empty suffix range: ' + header)
+        return max(0, size - length), size
+    start = int(first)
+    end = size if not last else min(int(last) + 1, size)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError('Range beyond end of resource: ' + header)
+    return start, end
+
+class Fill(object):
+    '''Retrieve one upstream resource into the cache, while letting
+       concurrent readers follow its progress
+    '''
+
+    def __init__(self, url, cache_name, expected=None, learn=None):
+        self.url = url
+        self.cache_name = cache_name
+        self.part_name = cache_name + '.part'
+        self.expected = expected
+        self.learn = learn
+        self.cond = threading.Condition()
+        self.bmap_lock = threading.Lock()
+        self.size = None
+        self.written = 0
+        self.started = False
+        self.done = False
+        self.error = None
+
+    @classmethod
+    def cached(cls, url, cache_name):
+        '''An already complete fill, for cache hits'''
+        fill = cls(url, cache_name)
+        fill.size = fill.written = os.path.getsize(cache_name)
+        fill.started = fill.done = True
+        return fill
+
+    def finished(self):
+        with self.cond:
+            return self.done or self.error is not None
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def _set(self, **kwargs):
+        with self.cond:
+            for key, val in kwargs.items():
+                setattr(self, key, val)
+            self.cond.notify_all()
+
+    def stale(self):
+        '''Serve the cached copy, if any, when upstream cannot revalidate it'''
+        if not os.path.exists(self.cache_name):
+            return False
+        vprint('%s: serving the cached copy' % self.url)
+        size = os.path.getsize(self.cache_name)
+        self._set(size=size, written=size, started=True, done=True)
+        return True
+
+    def verifier(self):
+        '''(hasher, decompressor) for the expected message digests of the
+           uncompressed resource, None if there are none to verify
+        '''
+        checksums = (self.expected or {}).get('checksums') or {}
+        algos = []
+        for algo in checksums:
+            try:
+                multihash.hash2len(algo)
+                algos.append(algo)
+            except KeyError:
+                vprint('%s: unsupported digest: %s' % (self.url, algo))
+        if not algos:
+            return None
+        ext = decompressor.compression_ext(self.expected.get('compression'))
+        try:
+            dec = decompressor.StreamDecompressor(ext) if ext else None
+        except decompressor.DecompressorError as exc:
+            vprint('%s: cannot verify: %s' % (self.url, exc))
+            return None
+        return multihash.multihash_hashlib(algos), dec
+
+    def verified(self, hasher):
+        '''Compare computed message digests to the expected ones'''
+        digests = hasher.hexdigests()
+        ret = True
+        for algo, digest in sorted(digests.items()):
+            expected = self.expected['checksums'][algo].lower()
+            if digest != expected:
+                vprint('%s: %s: expected: %s, computed: %s' %
+                       (self.url, algo, expected, digest))
+                ret = False
+        return ret
+
+    def run(self):
+        headers = {}
+        if os.path.exists(self.cache_name):
+            mtime = os.path.getmtime(self.cache_name)
+            headers['If-Modified-Since'] = formatdate(mtime, usegmt=True)
+        try:
+            url_f = urlopen(Request(self.url, headers=headers))
+        except HTTPError as exc:
+            if exc.code == 304:
+                vprint('%s: not modified upstream' % self.url)
+                os.utime(self.cache_name, None)
+                size = os.path.getsize(self.cache_name)
+                self._set(size=size, written=size, started=True, done=True)
+            else:
+                vprint('%s: upstream error: %s' % (self.url, exc))
+                # Gone upstream: do not serve it anymore
+                if exc.code in (404, 410) or not self.stale():
+                    self._set(error=exc.code)
+            return
+        except (URLError, ValueError, IOError) as exc:
+            vprint('%s: cannot reach upstream: %s' % (self.url, exc))
+            if not self.stale():
+                self._set(error=502)
+            return
+        length = url_f.info().get('Content-Length')
+        hasher, dec = self.verifier() or (None, None)
+        # Readers get the last byte only once the download is admitted, so
+        # that they never see a complete unverified resource
+        count = 0
+        try:
+            with open(self.part_name, 'wb') as fout:
+                self._set(size=int(length) if length else None, started=True)
+                reader = functools.partial(url_f.read, _BLOCK_SIZE)
+                for block in iter(reader, b''):
+                    fout.write(block)
+                    fout.flush()
+                    count += len(block)
+                    self._set(written=count - 1)
+                    if hasher is not None:
+                        hasher.update(dec.decompress(block) if dec else block)
+                if dec is not None:
+                    hasher.update(dec.flush())
+        except (IOError, OSError, decompressor.DecompressorError) as exc:
+            vprint('%s: download failed: %s' % (self.url, exc))
+            if os.path.exists(self.part_name):
+                os.remove(self.part_name)
+            self._set(error=502)
+            return
+        # Only verified downloads make it into the cache
+        admit = True
+        if self.size is not None and self.size != count:
+            vprint('%s: size: expected: %d, actual: %d' %
+                   (self.url, self.size, count))
+            admit = False
+        elif hasher is not None:
+            admit = self.verified(hasher)
+        # Digests of images described there, before readers get to them
+        if (admit and self.learn is not None and
+                count <= _METADATA_MAX_SIZE):
+            self.learn(self.part_name)
+        with self.cond:
+            if not admit:
+                os.remove(self.part_name)
+                self.error = 502
+            else:
+                os.rename(self.part_name, self.cache_name)
+                vprint('%s: cached as: %s' % (self.url, self.cache_name))
+                self.size = self.written = count
+                self.done = True
+            self.cond.notify_all()
+
+    def wait_headers(self):
+        '''Wait until the resource size is known, or the fill failed.
+           Return (size, error)
+        '''
+        with self.cond:
+            while not self.started and self.error is None:
+                self.cond.wait()
+            return self.size, self.error
+
+    def wait_done(self):
+        '''Wait until the resource is complete, or the fill failed.
+           Return error
+        '''
+        with self.cond:
+            while not self.done and self.error is None:
+                self.cond.wait()
+            return self.error
+
+    def block_map(self):
+        '''Get the block map of the complete resource, computed only once'''
+        bmap_name = self.cache_name + '.blockmap'
+        # Requests sharing this fill wait for the one computing it, others
+        # (cache hits get their own fill) write it under their own name
+        with self.bmap_lock:
+            if (not os.path.exists(bmap_name) or os.path.getmtime(bmap_name) <
+                    os.path.getmtime(self.cache_name)):
+                vprint('%s: computing block map' % self.url)
+                bmap = delta.block_map(self.cache_name)
+                utils.write_atomic(bmap_name, json.dumps(bmap), 'w')
+        with open(bmap_name, 'rb') as fin:
+            return fin.read()
+
+    def follow(self, start, end, write):
+        '''Pass the [start, end) range of the resource to write(), as soon
+           as it is available. A None end means up to the end of resource.
+        '''
+        with self.cond:
+            if self.error is not None:
+                return False
+            fin = open(self.cache_name if self.done else self.part_name, 'rb')
+        with fin:
+            fin.seek(start)
+            pos = start
+            while end is None or pos < end:
+                with self.cond:
+                    while (self.written <= pos and not self.done and
+                           self.error is None):
+                        self.cond.wait()
+                    if self.error is not None:
+                        return False
+                    avail = self.written if end is None else min(self.written, end)
+                if pos >= avail:
+                    break
+                while pos < avail:
+                    block = fin.read(min(_BLOCK_SIZE, avail - pos))
+                    if not block:
+                        return False
+                    write(block)
+                    pos += len(block)
+        return True
+
+class Cache(object):
+    '''Map upstream URLs to local files, and to their pending downloads
+    '''
+
+    def __init__(self, cache_dir, ttl, image_lists=()):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.fills = {}
+        # Metadata, with message digests, of images by URL
+        self.images = {}
+        for fname in image_lists:
+            self.learn(fname)
+
+    def learn(self, fname):
+        '''Record the metadata of the images described in a file'''
+        images = image_metadata(fname)
+        if images:
+            vprint('%s: metadata of %d images' % (fname, len(images)))
+            with self.lock:
+                self.images.update(images)
+
+    def cache_name(self, url):
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest)
+
+    def get(self, url):
+        cache_name = self.cache_name(url)
+        with self.lock:
+            fill = self.fills.get(url)
+            if fill is not None and not fill.finished():
+                vprint('%s: joining running download' % url)
+                return fill
+            hit = (os.path.exists(cache_name) and
+                   time.time() - os.path.getmtime(cache_name) < self.ttl)
+            if not hit:
+                vprint('%s: cache miss' % url)
+                fill = Fill(url, cache_name, self.images.get(url), self.learn)
+                self.fills[url] = fill
+                fill.start()
+                return fill
+        vprint('%s: cache hit' % url)
+        fill = Fill.cached(url, cache_name)
+        # Metadata cached before a restart
+        if fill.size <= _METADATA_MAX_SIZE:
+            self.learn(cache_name)
+        return fill
+
+class MirrorHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.serve(body=True)
+
+    def do_HEAD(self):
+        self.serve(body=False)
+
+    def serve(self, body):
+        if self.path.startswith('/blockmap/'):
+            self.serve_block_map(body)
+            return
+        url = upstream_url(self.path)
+        if url is None:
+            self.send_error(404)
+            return
+        if not self.server.allowed(url):
+            self.send_error(403)
+            return
+        fill = self.server.cache.get(url)
+        size, error = fill.wait_headers()
+        if error is not None:
+            self.send_error(error)
+            return
+        start, end = 0, size
+        rng = self.headers.get('Range')
+        if rng and size is not None:
+            try:
+                rng = parse_range(rng, size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.end_headers()
+                return
+        else:
+            rng = None
+        if rng is not None:
+            start, end = rng
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end - 1, size))
+        else:
+            self.send_response(200)
+        if end is not None:
+            self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.end_headers()
+        if body:
+            fill.follow(start, end, self.wfile.write)
+
+    def serve_block_map(self, body):
+        url = upstream_url(self.path[len('/blockmap'):])
+        if url is None:
+            self.send_error(404)
+            return
+        if not self.server.allowed(url):
+            self.send_error(403)
+            return
+        fill = self.server.cache.get(url)
+        error = fill.wait_done()
+        if error is not None:
+            self.send_error(error)
+            return
+        data = fill.block_map()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        vprint('%s: %s' % (self.address_string(), fmt % args))
+
+class MirrorServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, cache, allowed_hosts=()):
+        HTTPServer.__init__(self, address, MirrorHandler)
+        self.cache = cache
+        self.allowed_hosts = list(allowed_hosts)
+
+    def allowed(self, url):
+        '''Tell if an upstream URL can be mirrored, else the mirror would be
+           an open proxy
+        '''
+        return host_allowed(url, self.allowed_hosts)
+
+# Handle CLI options
+def do_argparse(sys_argv):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Display additional information')
+
+    parser.add_argument('-a', '--address', default='',
+                        help='Address to listen on (default: all)')
+
+    parser.add_argument('-p', '--port', default=8080, type=int,
+                        help='Port to listen on (default: 8080)')
+
+    parser.add_argument('-C', '--cache-dir', dest='cachedir',
+                        default=_DEFAULT_CACHE_DIR,
+                        help='Cache directory (default: %s)' % _DEFAULT_CACHE_DIR)
+
+    parser.add_argument('-t', '--ttl', default=3600, type=int,
+                        help='Seconds before a cached resource is revalidated '
+                             'against upstream (default: 3600)')
+
+    parser.add_argument('-A', '--allow-host', dest='hosts', action='append',
+                        required=True, metavar='PATTERN',
+                        help='Upstream host, or host:port, to mirror. Can be '
+                             'a shell-style pattern (*.example.org), and '
+                             'given multiple times')
+
+    parser.add_argument('-i', '--image-list', dest='imagelists',
+                        action='append', default=[], metavar='FILE',
+                        help='Image list or metadata file, giving the '
+                             'digests images are verified with before being '
+                             'cached. Can be given multiple times')
+
+    args = parser.parse_args(sys_argv)
+
+    if args.verbose:
+        utils.set_verbose(True)
+        vprint('verbose mode')
+
+    return args
+
+def main(sys_argv=sys.argv[1:]):
+    args = do_argparse(sys_argv)
+    cache = Cache(args.cachedir, args.ttl, args.imagelists)
+    server = MirrorServer((args.address, args.port), cache, args.hosts)
+    vprint('Serving %s on port %d' % (args.cachedir, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return True
+
+if __name__ == '__main__': # pragma: no cover
+    main()
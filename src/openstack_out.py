@@ -92,6 +92,19 @@ def map_block(block, key_index=0):
             ret[bline[key_index]] = (bline[:key_index] + bline[key_index+1:])
     return ret
 
+def format_block(header, rows):
+    '''Format a table like the openstack command line clients do, so that
+    parse_block() gets header & rows back
+    '''
+    widths = [max([len(cell) for cell in col])
+              for col in zip(header, *rows)]
+    sep = '+' + '+'.join('-' * (width + 2) for width in widths) + '+'
+    def line(cells):
+        return '| ' + ' | '.join(cell.ljust(width) for cell, width
+                                  in zip(cells, widths)) + ' |'
+    return '\n'.join([sep, line(header), sep] + [line(row) for row in rows] +
+                     [sep]) + '\n'
+
 def cli(sys_argv=sys.argv[1:]):
     if not sys_argv:
         return None
@@ -23,6 +23,7 @@ import re
 import sys
 import uuid
 import math
+import stat
 import shutil
 import inspect
 import argparse
@@ -345,9 +346,254 @@ def block_read_filedesc(filedesc, callback, block_size=4096):
     if block_size < 1:
         raise IOError('Wrong block_size')
     chunk_reader = functools.partial(filedesc.read, block_size)
-    for block in iter(chunk_reader, ''):
+    for block in iter(chunk_reader, b''):
         callback(block)
 
+# From linux/fs.h: _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+
+# Upper bound of a single in-kernel copy call
+_KERNEL_COPY_CHUNK = 1024 * 1024 * 1024
+
+def _reflink(fd_in, fd_out):
+    '''Try to share fd_in's data extents with fd_out (btrfs, XFS, ...)'''
+    try:
+        import fcntl
+    except ImportError: # pragma: no cover
+        return False
+    # A clone is all-or-nothing, only use it for whole-file copies
+    if os.lseek(fd_in, 0, os.SEEK_CUR) != 0:
+        return False
+    if os.lseek(fd_out, 0, os.SEEK_CUR) != 0:
+        return False
+    try:
+        fcntl.ioctl(fd_out, _FICLONE, fd_in)
+    except (IOError, OSError):
+        return False
+    os.lseek(fd_in, 0, os.SEEK_END)
+    os.lseek(fd_out, 0, os.SEEK_END)
+    return True
+
+def _libc_copy_file_range(fd_in, fd_out, count):
+    '''os.copy_file_range(), from the C library, for python < 3.8'''
+    func = _libc_func('copy_file_range')
+    ret = func(fd_in, None, fd_out, None, count, 0)
+    if ret < 0:
+        err = _libc_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+def _libc_sendfile(fd_out, fd_in, offset, count):
+    '''os.sendfile(), from the C library, for python 2'''
+    import ctypes
+    func = _libc_func('sendfile')
+    off = ctypes.c_int64(offset)
+    ret = func(fd_out, fd_in, ctypes.byref(off), count)
+    if ret < 0:
+        err = _libc_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+def _kernel_copy(fd_in, fd_out):
+    '''Copy from fd_in to fd_out without bringing data to userspace.
+       Return the name of the system call used, or None if none worked, in
+       which case the copy has to be finished from the current offsets.
+    '''
+    copy_range = getattr(os, 'copy_file_range', None)
+    if copy_range is None and _libc_func('copy_file_range'):
+        copy_range = _libc_copy_file_range
+    sendfile = getattr(os, 'sendfile', None)
+    if sendfile is None and _libc_func('sendfile'):
+        sendfile = _libc_sendfile
+    for name, func in (('copy_file_range', copy_range), ('sendfile', sendfile)):
+        if func is None:
+            continue
+        offset = os.lseek(fd_in, 0, os.SEEK_CUR)
+        left = os.fstat(fd_in).st_size - offset
+        try:
+            while left > 0:
+                count = min(left, _KERNEL_COPY_CHUNK)
+                if name == 'sendfile':
+                    done = func(fd_out, fd_in, offset, count)
+                    os.lseek(fd_in, offset + done, os.SEEK_SET)
+                else:
+                    done = func(fd_in, fd_out, count)
+                # Premature EOF, file shrunk under us
+                if done == 0:
+                    break
+                offset += done
+                left -= done
+        except OSError:
+            continue
+        return name
+    return None
+
+def copy_filedesc(fd_in, fd_out, block_size=4096):
+    """Copy data between two file descriptors, from their current offsets.
+    Cheapest methods are tried first: reflink clone, then in-kernel copy,
+    and only then a read/write loop in block_size chunks.
+    Return the name of the method used.
+    """
+    if block_size < 1:
+        raise IOError('Wrong block_size')
+    if stat.S_ISREG(os.fstat(fd_in).st_mode):
+        if _reflink(fd_in, fd_out):
+            return 'reflink'
+        how = _kernel_copy(fd_in, fd_out)
+        if how is not None:
+            return how
+    for block in iter(functools.partial(os.read, fd_in, block_size), b''):
+        while block:
+            block = block[os.write(fd_out, block):]
+    return 'read/write'
+
+def free_space(path):
+    """Disk space available to unprivileged users in the file system of
+    path, in bytes
+    """
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+def makedirs(dirname):
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # Created concurrently
+            if not os.path.isdir(dirname):
+                raise
+
+def write_atomic(fname, data, mode='wb', overwrite=True):
+    '''Write a file under a temporary name, renamed when complete. Without
+    overwrite, raise OSError(EEXIST) if the file already exists
+    '''
+    dirname = os.path.dirname(fname)
+    makedirs(dirname)
+    fdesc, tmp_name = tempfile.mkstemp(dir=dirname, suffix='.part')
+    try:
+        with os.fdopen(fdesc, mode) as fout:
+            fout.write(data)
+        if overwrite:
+            os.rename(tmp_name, fname)
+        else:
+            # Unlike rename(), fails if the file exists
+            os.link(tmp_name, fname)
+            os.remove(tmp_name)
+    except (IOError, OSError):
+        os.remove(tmp_name)
+        raise
+
+_LIBC = None
+
+# (result type, argument types) of the C library functions used
+_LIBC_PROTOTYPES = {
+    'fallocate': ('c_int', ('c_int', 'c_int', 'c_int64', 'c_int64')),
+    'copy_file_range': ('c_ssize_t', ('c_int', 'c_void_p', 'c_int',
+                                      'c_void_p', 'c_size_t', 'c_uint')),
+    'sendfile': ('c_ssize_t', ('c_int', 'c_int', 'c_void_p', 'c_size_t')),
+}
+
+def _libc_func(name):
+    """A function of the C library, through ctypes, None if not there"""
+    global _LIBC
+    import ctypes
+    if _LIBC is None:
+        import ctypes.util
+        try:
+            _LIBC = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        except OSError:
+            _LIBC = False
+    if not _LIBC:
+        return None
+    try:
+        func = getattr(_LIBC, name)
+    except AttributeError:
+        return None
+    restype, argtypes = _LIBC_PROTOTYPES[name]
+    func.restype = getattr(ctypes, restype)
+    func.argtypes = [getattr(ctypes, argtype) for argtype in argtypes]
+    return func
+
+def _libc_errno():
+    import ctypes
+    return ctypes.get_errno()
+
+def fallocate(fd, offset, length):
+    """Allocate disk space for a byte range of a file, without changing
+    its size if the range is inside it. Return False if not supported.
+    """
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, offset, length)
+        except OSError:
+            return False
+        return True
+    func = _libc_func('fallocate')
+    if func is None:
+        return False
+    return func(fd, 0, offset, length) == 0
+
+class SparseWriter(object):
+    """Write to a file, seeking over all-zero blocks to leave holes, call
+    finish() when done. If the final size is known, the file is sized
+    upfront, and the non-zero data ranges can be preallocated before being
+    written.
+    """
+
+    def __init__(self, fileobj, block_size=4096, size=None,
+                 preallocate=False, sparse=True):
+        if block_size < 1:
+            raise IOError('Wrong block_size')
+        self.fout = fileobj
+        self.fd = fileobj.fileno()
+        self.block_size = block_size
+        self.zeros = b'\0' * block_size
+        self.preallocate = preallocate
+        self.sparse = sparse
+        self.pos = fileobj.tell()
+        self.written = 0
+        if size is not None:
+            fileobj.truncate(size)
+
+    def _write_run(self, offset, data):
+        if not data:
+            return
+        if self.preallocate:
+            self.preallocate = fallocate(self.fd, offset, len(data))
+        if self.fout.tell() != offset:
+            self.fout.seek(offset)
+        self.fout.write(data)
+        self.written += len(data)
+
+    def write(self, data):
+        if not self.sparse:
+            self._write_run(self.pos, data)
+            self.pos += len(data)
+            return
+        # Whole buffer of zeros: nothing to look at in details
+        if data.count(b'\0') == len(data):
+            self.pos += len(data)
+            return
+        bsize = self.block_size
+        # Blocks aligned on file offsets, the first one may be partial
+        start = 0
+        run_start = 0
+        end = bsize - self.pos % bsize
+        while start < len(data):
+            block = data[start:end]
+            if block == self.zeros[:len(block)]:
+                self._write_run(self.pos + run_start, data[run_start:start])
+                run_start = end
+            start = end
+            end = start + bsize
+        self._write_run(self.pos + run_start, data[run_start:])
+        self.pos += len(data)
+
+    def finish(self):
+        """Set the file size to what has been written, holes included"""
+        self.fout.truncate(self.pos)
+        return self.pos
+
 class Exceptions(object):
     """Class to match an exception's type and its args against a list of
     other exceptions
@@ -0,0 +1,314 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2016 Vincent Legoll <vincent.legoll@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Checkpointed decompression of gzip & bzip2 files, zran-style: while
+decompressing, the points where decompression can restart from are recorded
+in an index, with their compressed & uncompressed offsets and, for gzip, the
+last 32KB of uncompressed data that what follows can refer to.
+
+After a failure, decompression resumes from the last recorded point, and the
+uncompressed data can be read at any offset, without decompressing from the
+start, to spot-check an image.
+
+Python's zlib cannot start inflating at the bit offset of any deflate block,
+as zran does: restart points are the starts of the streams of multi-stream
+files, and the byte-aligned sync / full flush points of gzip streams, as
+written by pigz.
+'''
+
+from __future__ import print_function
+
+import os
+import bz2
+import sys
+import json
+import zlib
+import base64
+import bisect
+import struct
+
+_WINDOW_SIZE = 32 * 1024
+
+# Empty stored deflate block, ending a sync or full flush
+_SYNC_MARKER = b'\x00\x00\xff\xff'
+
+# Compressed data decoded from a sync marker to check it is a real one
+_VERIFY_SIZE = 16 * 1024
+
+_DEFAULT_SPACING = 64 * 1024 * 1024
+
+_BLOCK_SIZE = 1024 * 1024
+
+class ZIndexError(Exception):
+    '''Class to allow catching exceptions from this module'''
+
+_FACTORIES = {
+    '.gz': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    '.bz2': bz2.BZ2Decompressor,
+}
+
+def supported(ext):
+    '''Tell if files with that extension can be indexed'''
+    return ext in _FACTORIES
+
+def primed_inflater(window):
+    '''Raw deflate decompressor, with window as history: it is fed first,
+    as a stored block, and its output dropped
+    '''
+    dec = zlib.decompressobj(-zlib.MAX_WBITS)
+    dec.decompress(b'\0' + struct.pack('<HH', len(window),
+                                       len(window) ^ 0xffff) + window)
+    return dec
+
+def ended(dec):
+    '''Tell if a zlib or bz2 decompressor reached the end of its stream'''
+    if hasattr(dec, 'eof'):
+        return dec.eof
+    # Python 2: past its end, a stream leaves fed data unused, or raises
+    # EOFError for bz2
+    try:
+        dec.decompress(b'\0')
+    except EOFError:
+        return True
+    except (IOError, zlib.error):
+        return False
+    return bool(dec.unused_data)
+
+class IndexedDecompressor(object):
+    '''Incremental decompression of .gz or .bz2 data fed in chunks, like
+    decompressor.StreamDecompressor, also finding restart points at least
+    spacing uncompressed bytes apart, appended to self.points. Start from
+    the beginning of the data, or from a restart point.
+    '''
+
+    def __init__(self, ext, spacing=_DEFAULT_SPACING, point=None):
+        if ext not in _FACTORIES:
+            raise ZIndexError('Cannot index: ' + str(ext))
+        self.ext = ext
+        self.spacing = spacing
+        self.points = []
+        point = point or {'in': 0, 'out': 0}
+        self.in_off = point['in']
+        self.out_off = point['out']
+        self.last_out = point['out']
+        # Current stream start, running CRC, and for a resumed gzip stream
+        # its trailer, checked here as raw deflate data has none
+        self.stream_out = point.get('stream_out', self.out_off)
+        self.crc = point.get('crc', 0)
+        self.trailer = None
+        self.window = point.get('window') or b''
+        self.dec = None
+        self.raw = point.get('window') is not None
+        if self.raw:
+            self.dec = primed_inflater(self.window)
+
+    def _emit(self, data, out):
+        if not data:
+            return
+        out.append(data)
+        self.out_off += len(data)
+        if self.ext == '.gz':
+            self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+            if len(data) >= _WINDOW_SIZE:
+                self.window = data[-_WINDOW_SIZE:]
+            else:
+                self.window = (self.window + data)[-_WINDOW_SIZE:]
+
+    def _due(self):
+        return self.out_off - self.last_out >= self.spacing
+
+    def _add_point(self, window=False):
+        point = {'in': self.in_off, 'out': self.out_off}
+        if window:
+            point.update(crc=self.crc, stream_out=self.stream_out,
+                         window=self.window)
+        self.points.append(point)
+        self.last_out = self.out_off
+
+    def _end_stream(self):
+        if self.raw:
+            self.trailer = b''
+        self.dec = None
+        self.raw = False
+
+    def _check_trailer(self):
+        crc, isize = struct.unpack('<II', self.trailer)
+        self.trailer = None
+        if (crc != self.crc or
+                isize != (self.out_off - self.stream_out) & 0xffffffff):
+            raise ZIndexError('Corrupted stream: bad gzip trailer')
+
+    def _sync_point(self, data):
+        '''Record a point at the sync marker just fed, if decoding what
+        follows from there gives the same data as going on
+        '''
+        sample = data[:_VERIFY_SIZE]
+        try:
+            expected = self.dec.copy().decompress(sample)
+            if expected and primed_inflater(self.window).decompress(
+                    sample) == expected:
+                self._add_point(window=True)
+        except zlib.error:
+            pass
+
+    def decompress(self, data):
+        '''Return the uncompressed data available after feeding data'''
+        out = []
+        while data:
+            if self.trailer is not None:
+                take = data[:8 - len(self.trailer)]
+                self.trailer += take
+                self.in_off += len(take)
+                data = data[len(take):]
+                if len(self.trailer) == 8:
+                    self._check_trailer()
+                continue
+            if self.dec is None:
+                # Start of a stream
+                if self._due():
+                    self._add_point()
+                self.dec = _FACTORIES[self.ext]()
+                self.stream_out = self.out_off
+                self.crc = 0
+            piece = data
+            sync = -1
+            if self.ext == '.gz' and self._due():
+                sync = data.find(_SYNC_MARKER)
+                if sync >= 0:
+                    piece = data[:sync + len(_SYNC_MARKER)]
+            try:
+                ret = self.dec.decompress(piece)
+                unused = self.dec.unused_data
+            except EOFError:
+                # Python 2 BZ2Decompressor, past the end of its stream
+                ret, unused = b'', piece
+            except (IOError, zlib.error) as exc:
+                raise ZIndexError('Corrupted stream: ' + str(exc))
+            consumed = len(piece) - len(unused)
+            self.in_off += consumed
+            self._emit(ret, out)
+            data = data[consumed:]
+            if unused or getattr(self.dec, 'eof', False):
+                self._end_stream()
+            elif sync >= 0:
+                self._sync_point(data)
+        return b''.join(out)
+
+    def flush(self):
+        '''Fail on truncated input'''
+        if (self.trailer is not None or self.in_off == 0 or
+                (self.dec is not None and (self.raw or not ended(self.dec)))):
+            raise ZIndexError('Truncated compressed stream')
+        return b''
+
+def _dump_point(point):
+    point = dict(point)
+    if point.get('window') is not None:
+        point['window'] = base64.b64encode(
+            zlib.compress(point['window'])).decode('ascii')
+    return json.dumps(point, sort_keys=True)
+
+def _load_point(line):
+    point = json.loads(line)
+    if point.get('window') is not None:
+        point['window'] = zlib.decompress(base64.b64decode(point['window']))
+    return point
+
+def create_index(fname, ext, fingerprint):
+    '''Start an index file, return it open for append_points()'''
+    fidx = open(fname, 'w')
+    fidx.write(json.dumps({'ext': ext, 'input': fingerprint},
+                          sort_keys=True) + '\n')
+    return fidx
+
+def append_points(fidx, points):
+    '''Record restart points in an index file, on disk'''
+    fidx.write(''.join(_dump_point(point) + '\n' for point in points))
+    fidx.flush()
+    os.fsync(fidx.fileno())
+
+def load_index(fname):
+    '''Return the header & restart points of an index file, and the size of
+    its valid part: a crash can leave its last line cut short.
+    None if there is no usable index.
+    '''
+    try:
+        with open(fname) as fin:
+            lines = fin.read().split('\n')
+        header = json.loads(lines[0])
+    except (IOError, ValueError):
+        return None
+    points = [{'in': 0, 'out': 0}]
+    valid = len(lines[0]) + 1
+    for line in lines[1:-1]:
+        try:
+            points.append(_load_point(line))
+        except (ValueError, TypeError, zlib.error):
+            break
+        valid += len(line) + 1
+    return header, points, valid
+
+def reopen_index(fname, valid):
+    '''Open an index file to append more points, after its valid part'''
+    fidx = open(fname, 'r+')
+    fidx.truncate(valid)
+    fidx.seek(valid)
+    return fidx
+
+def read_at(fname, index, offset, size):
+    '''Read up to size bytes of the uncompressed data of fname at offset,
+    decompressing from the closest restart point of its index before it
+    '''
+    header, points = index[:2]
+    pos = bisect.bisect_right([point['out'] for point in points], offset)
+    point = points[pos - 1]
+    dec = IndexedDecompressor(header['ext'], sys.maxsize, point)
+    skip = offset - point['out']
+    ret = []
+    with open(fname, 'rb') as fin:
+        fin.seek(point['in'])
+        while size > 0:
+            data = fin.read(_BLOCK_SIZE)
+            if not data:
+                break
+            data = dec.decompress(data)
+            if skip:
+                data, skip = data[skip:], max(0, skip - len(data))
+            data = data[:size]
+            size -= len(data)
+            ret.append(data)
+    return b''.join(ret)
+
+def main(args=sys.argv[1:]):
+    '''Output the restart points of the .gz or .bz2 files given as CLI
+    arguments
+    '''
+    for fname in args:
+        dec = IndexedDecompressor(os.path.splitext(fname)[1])
+        with open(fname, 'rb') as fin:
+            for data in iter(lambda: fin.read(_BLOCK_SIZE), b''):
+                dec.decompress(data)
+        dec.flush()
+        for point in dec.points:
+            print(fname, point['in'], point['out'],
+                  'window' if 'window' in point else 'stream')
+    return True
+
+if __name__ == '__main__': # pragma: no cover
+    main()
@@ -0,0 +1,252 @@
+#! /usr/bin/env python
+
+'''
+Benchmark decompressor.py on synthetic images: zero-heavy raw disks,
+filesystem-like content and random data, compressed in all the supported
+formats, decompressed with each backend and block size.
+
+Results are output as JSON, and compared to a previous run if given one:
+
+    bench_decompressor.py -s 64 -r 3 -o before.json
+    bench_decompressor.py -s 64 -r 3 --baseline before.json
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import bz2
+import gzip
+import json
+import time
+import random
+import shutil
+import zipfile
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from tutils import local_pythonpath
+
+# Setup project-local PYTHONPATH
+local_pythonpath('..', '..', 'src')
+
+import zindex
+import decompressor
+
+_MB = 1024 * 1024
+_BLOCK = 64 * 1024
+
+def make_image(fname, size, kind):
+    '''Write a synthetic image of size bytes'''
+    words = [b'%x' % random.getrandbits(32) for _ in range(1000)]
+    with open(fname, 'wb') as fout:
+        written = 0
+        while written < size:
+            length = min(_BLOCK, size - written)
+            draw = random.random()
+            if kind == 'random' or (kind == 'zero' and draw < 0.1):
+                block = os.urandom(length)
+            elif kind == 'zero' or draw < 0.4:
+                block = b'\0' * length
+            elif draw < 0.8:
+                # Text, binaries & metadata
+                block = b' '.join(random.choice(words)
+                                  for _ in range(length // 4))[:length]
+                block += b'\0' * (length - len(block))
+            else:
+                # Already compressed files
+                block = os.urandom(length)
+            fout.write(block)
+            written += length
+
+def compress_gz(fin, fname):
+    with gzip.GzipFile(fname, 'wb', compresslevel=6) as fout:
+        shutil.copyfileobj(fin, fout, _MB)
+
+def compress_bz2(fin, fname):
+    fout = bz2.BZ2File(fname, 'wb')
+    try:
+        shutil.copyfileobj(fin, fout, _MB)
+    finally:
+        fout.close()
+
+def compress_zip(fin, fname):
+    zipf = zipfile.ZipFile(fname, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+    try:
+        zipf.write(fin.name, os.path.basename(os.path.splitext(fname)[0]))
+    finally:
+        zipf.close()
+
+def compress_cmd(cmd):
+    def compress(fin, fname):
+        with open(fname, 'wb') as fout:
+            subprocess.check_call(cmd, stdin=fin, stdout=fout)
+    return compress
+
+# Compressors, by file extension: the external ones may be missing
+_COMPRESSORS = {
+    '.gz': compress_gz,
+    '.bz2': compress_bz2,
+    '.zip': compress_zip,
+    '.xz': compress_cmd(['xz', '-c', '-T0']),
+    '.zst': compress_cmd(['zstd', '-q', '-c']),
+}
+
+def rusage_cpu():
+    '''CPU seconds used by this process and its children'''
+    ret = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        ret += usage.ru_utime + usage.ru_stime
+    return ret
+
+# Decompressor parameters for each backend
+_BACKENDS = {
+    'native': {'native': True},
+    'python': {'native': False},
+    'checkpointed': {'native': False, 'checkpoint': 16 * _MB},
+}
+
+def backend_ok(backend, ext):
+    '''Tell if a backend can decompress a format, rather than fall back'''
+    if backend == 'native':
+        return ext in decompressor.get_native_decoders()
+    if backend == 'checkpointed':
+        return zindex.supported(ext)
+    if ext in ('.xz', '.lzma'):
+        return decompressor.lzma is not None
+    if ext == '.zst':
+        return decompressor.zstandard is not None
+    return True
+
+def bench_one(fname, backend, block_size, size):
+    decomp = decompressor.Decompressor(fname, block_size=block_size,
+                                       **_BACKENDS[backend])
+    cpu = rusage_cpu()
+    start = time.time()
+    error = None
+    try:
+        ret, fout_name = decomp.doit()
+    except Exception as exc:
+        ret, fout_name = False, decomp.fout_name
+        error = '%s: %s' % (type(exc).__name__, exc)
+    elapsed = time.time() - start
+    cpu = rusage_cpu() - cpu
+    ok = ret and os.path.getsize(fout_name) == size
+    for name in (fout_name, decomp.tmp_name, decomp.index_name):
+        if name != fname and os.path.exists(name):
+            os.remove(name)
+    return {
+        'ok': ok,
+        'error': error,
+        'method': decomp.method,
+        'seconds': elapsed,
+        'throughput_MBps': size / _MB / elapsed if elapsed else None,
+        'cpu_seconds': cpu,
+        'bytes_written': decomp.written,
+    }
+
+def result_key(result):
+    return (result['kind'], result['format'], result['backend'],
+            result['block_size'])
+
+def compare(results, baseline):
+    '''Add to results their throughput ratio to the baseline ones'''
+    previous = dict((result_key(result), result)
+                    for result in baseline['results'])
+    for result in results:
+        old = previous.get(result_key(result))
+        if old and old.get('throughput_MBps') and result['throughput_MBps']:
+            result['baseline_throughput_MBps'] = old['throughput_MBps']
+            result['speedup'] = (result['throughput_MBps'] /
+                                 old['throughput_MBps'])
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('-s', '--size', type=int, default=32,
+                        help='Image size in MB (default: 32)')
+    parser.add_argument('-k', '--kinds', nargs='+',
+                        choices=('zero', 'fs', 'random'),
+                        default=['zero', 'fs', 'random'],
+                        help='Image contents (default: all)')
+    parser.add_argument('-f', '--formats', nargs='+',
+                        choices=sorted(_COMPRESSORS),
+                        default=sorted(_COMPRESSORS),
+                        help='Compression formats (default: all)')
+    parser.add_argument('-B', '--backends', nargs='+',
+                        choices=sorted(_BACKENDS), default=sorted(_BACKENDS),
+                        help='Decompression backends (default: all)')
+    parser.add_argument('-b', '--block-sizes', nargs='+', type=int,
+                        default=[4096, 65536, _MB],
+                        help='Block sizes of the python backend, in bytes '
+                             '(default: 4096 65536 1048576)')
+    parser.add_argument('-r', '--repeats', type=int, default=1,
+                        help='Runs per combination (default: 1)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed, for reproducible runs (default: 0)')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='Compare to the JSON results of a previous run')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='Write JSON results to FILE instead of stdout')
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    size = args.size * _MB
+    workdir = tempfile.mkdtemp(prefix='glancing-bench-')
+    results = []
+    try:
+        # Decompressed files are written next to the compressed ones
+        rawdir = os.path.join(workdir, 'raw')
+        os.mkdir(rawdir)
+        for kind in args.kinds:
+            raw = os.path.join(rawdir, kind + '.img')
+            make_image(raw, size, kind)
+            for ext in args.formats:
+                fname = os.path.join(workdir, kind + '.img' + ext)
+                try:
+                    with open(raw, 'rb') as fin:
+                        _COMPRESSORS[ext](fin, fname)
+                except (OSError, subprocess.CalledProcessError) as exc:
+                    print('%s: cannot compress: %s' % (ext, exc),
+                          file=sys.stderr)
+                    continue
+                csize = os.path.getsize(fname)
+                for backend in args.backends:
+                    if not backend_ok(backend, ext):
+                        continue
+                    bsizes = args.block_sizes if backend == 'python' else [None]
+                    for bsize in bsizes:
+                        for _ in range(args.repeats):
+                            result = bench_one(fname, backend,
+                                               bsize or 4096, size)
+                            result.update(kind=kind, format=ext,
+                                          backend=backend, block_size=bsize,
+                                          compressed_bytes=csize)
+                            results.append(result)
+                os.remove(fname)
+            os.remove(raw)
+    finally:
+        shutil.rmtree(workdir)
+    if args.baseline:
+        with open(args.baseline) as fin:
+            compare(results, json.load(fin))
+    report = {
+        'config': dict(vars(args), python=sys.version.split()[0],
+                       native_decoders=decompressor.get_native_decoders()),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(report, fout, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,364 @@
+#! /usr/bin/env python
+
+'''
+Benchmark image download strategies against a local HTTP server, with
+network shaping: latency, bandwidth cap, connection limit, range support
+and injected disconnects.
+
+Results are output as JSON, for example:
+
+    bench_get_url.py -s 64 -l 0.05 -b 20 -r 3 -o before.json
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import resource
+import tempfile
+import threading
+import multiprocessing
+
+try:
+    from urllib2 import urlopen
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError: # pragma: no cover
+    from urllib.request import urlopen
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+from tutils import local_pythonpath
+
+# Setup project-local PYTHONPATH
+local_pythonpath('..', '..', 'src')
+
+import delta
+import utils
+import mirror
+import glancing
+
+_CHUNK = 16 * 1024
+_MB = 1024 * 1024
+_GB = 1024 * _MB
+
+class ShapedHandler(BaseHTTPRequestHandler):
+    '''Serve files from the server's directory, through a shaped link'''
+
+    def do_GET(self):
+        shaping = self.server.shaping
+        with self.server.slots:
+            time.sleep(shaping['latency'])
+            path = os.path.join(self.server.directory,
+                                self.path.split('?', 1)[0].lstrip('/'))
+            if not os.path.isfile(path):
+                self.send_error(404)
+                return
+            size = os.path.getsize(path)
+            start, end = 0, size
+            rng = self.headers.get('Range')
+            if rng and shaping['ranges']:
+                try:
+                    rng = mirror.parse_range(rng, size)
+                except ValueError:
+                    self.send_error(416)
+                    return
+            else:
+                rng = None
+            if rng is not None:
+                start, end = rng
+                self.send_response(206)
+                self.send_header('Content-Range',
+                                 'bytes %d-%d/%d' % (start, end - 1, size))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(end - start))
+            if shaping['ranges']:
+                self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            with open(path, 'rb') as fin:
+                fin.seek(start)
+                self.send_body(fin, end - start)
+
+    def send_body(self, fin, length):
+        shaping = self.server.shaping
+        cut = length
+        if random.random() < shaping['drop_rate']:
+            cut = random.randint(0, length)
+        began = time.time()
+        sent = 0
+        while sent < cut:
+            chunk = fin.read(min(_CHUNK, cut - sent))
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if shaping['bandwidth']:
+                ahead = sent / shaping['bandwidth'] - (time.time() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def log_message(self, *args):
+        pass
+
+class ShapedServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, directory, shaping):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), ShapedHandler)
+        self.directory = directory
+        self.shaping = shaping
+        self.slots = threading.BoundedSemaphore(shaping['connections'])
+
+def start_server(server):
+    '''Serve from a child process, so that server CPU usage is not
+       accounted to the download strategies
+    '''
+    proc = multiprocessing.Process(target=server.serve_forever)
+    proc.daemon = True
+    proc.start()
+    server.socket.close()
+    return proc, 'http://127.0.0.1:%d' % server.server_port
+
+class TimedResponse(object):
+    '''Wrap an urlopen() response, to record the time of its first byte'''
+
+    first_byte = None
+
+    def __init__(self, resp):
+        self._resp = resp
+
+    def read(self, *args):
+        data = self._resp.read(*args)
+        if data and TimedResponse.first_byte is None:
+            TimedResponse.first_byte = time.time()
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._resp, name)
+
+def timed_urlopen(*args, **kwargs):
+    return TimedResponse(urlopen(*args, **kwargs))
+
+class TempDirWatcher(threading.Thread):
+    '''Poll a directory's disk usage, to get its peak value'''
+
+    def __init__(self, directory, period=0.02):
+        super(TempDirWatcher, self).__init__()
+        self.daemon = True
+        self.directory = directory
+        self.period = period
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def usage(self):
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for fname in files:
+                try:
+                    total += os.stat(os.path.join(root, fname)).st_blocks * 512
+                except OSError:
+                    pass
+        return total
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, self.usage())
+            self.stopped.wait(self.period)
+        self.peak = max(self.peak, self.usage())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.peak
+
+def make_images(directory, size, kind, changes):
+    '''Create a synthetic image, and a previous version of it differing by
+       a fraction of its 64KB blocks. Return their paths & the image md5
+    '''
+    bsize = 64 * 1024
+    nblocks = (size + bsize - 1) // bsize
+    changed = set(random.sample(range(nblocks), int(nblocks * changes)))
+    image = os.path.join(directory, 'image.img')
+    base = os.path.join(directory, 'base.img')
+    md5 = hashlib.md5()
+    with open(image, 'wb') as fimg:
+        with open(base, 'wb') as fbase:
+            for idx in range(nblocks):
+                length = min(bsize, size - idx * bsize)
+                if kind == 'zero' or (kind == 'mixed' and idx % 2):
+                    block = b'\0' * length
+                else:
+                    block = os.urandom(length)
+                fimg.write(block)
+                md5.update(block)
+                fbase.write(os.urandom(length) if idx in changed else block)
+    return image, base, md5.hexdigest()
+
+def md5sum(fname):
+    md5 = hashlib.md5()
+    utils.block_read_filename(fname, md5.update, _MB)
+    return md5.hexdigest()
+
+def strategy_get_url(ctx):
+    return glancing.get_url(ctx['origin'] + '/image.img')
+
+def strategy_mirror_cold(ctx):
+    return glancing.get_url(mirror.mirror_url(ctx['mirror'](),
+                                              ctx['origin'] + '/image.img'))
+
+def strategy_mirror_warm(ctx):
+    url = mirror.mirror_url(ctx['mirror'](), ctx['origin'] + '/image.img')
+    os.remove(glancing.get_url(url))
+    return strategy_timed(ctx, glancing.get_url, url)
+
+def strategy_delta(ctx):
+    base = ctx['mirror']()
+    url = ctx['origin'] + '/image.img'
+    # Warm up the mirror, and have it compute the block map
+    urlopen(mirror.blockmap_url(base, url)).read()
+    return strategy_timed(ctx, delta.get_delta, mirror.mirror_url(base, url),
+                          mirror.blockmap_url(base, url), ctx['base'])
+
+def strategy_timed(ctx, func, *args):
+    '''Restart measurements after the setup part of a strategy'''
+    ctx['restart']()
+    return func(*args)
+
+_STRATEGIES = {
+    'get_url': strategy_get_url,
+    'mirror-cold': strategy_mirror_cold,
+    'mirror-warm': strategy_mirror_warm,
+    'delta': strategy_delta,
+}
+
+def bench_one(name, ctx, tmpdir, expected_md5, size):
+    children = []
+    def start_mirror():
+        cache = mirror.Cache(tempfile.mkdtemp(dir=ctx['workdir']), 3600)
+        proc, url = start_server(mirror.MirrorServer(('127.0.0.1', 0), cache,
+                                                         ['127.0.0.1']))
+        children.append(proc)
+        return url
+    state = {}
+    def restart():
+        TimedResponse.first_byte = None
+        state['cpu'] = resource.getrusage(resource.RUSAGE_SELF)
+        state['start'] = time.time()
+    ctx = dict(ctx, mirror=start_mirror, restart=restart)
+    tempfile.tempdir = tmpdir
+    watcher = TempDirWatcher(tmpdir)
+    watcher.start()
+    restart()
+    fname, error = None, None
+    try:
+        fname = _STRATEGIES[name](ctx)
+    except Exception as exc:
+        error = '%s: %s' % (type(exc).__name__, exc)
+    finally:
+        elapsed = time.time() - state['start']
+        cpu_end = resource.getrusage(resource.RUSAGE_SELF)
+        tempfile.tempdir = None
+        peak = watcher.stop()
+        for proc in children:
+            proc.terminate()
+    cpu = ((cpu_end.ru_utime - state['cpu'].ru_utime) +
+           (cpu_end.ru_stime - state['cpu'].ru_stime))
+    ok = bool(fname) and md5sum(fname) == expected_md5
+    if fname:
+        os.remove(fname)
+    ttfb = TimedResponse.first_byte
+    return {
+        'strategy': name,
+        'ok': ok,
+        'error': error,
+        'seconds': elapsed,
+        'throughput_MBps': size / _MB / elapsed if elapsed else None,
+        'ttfb_seconds': ttfb - state['start'] if ttfb else None,
+        'cpu_seconds': cpu,
+        'cpu_seconds_per_GB': cpu * _GB / size if size else None,
+        'tmp_peak_bytes': peak,
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('-s', '--size', type=int, default=32,
+                        help='Image size in MB (default: 32)')
+    parser.add_argument('-k', '--kind', choices=('random', 'zero', 'mixed'),
+                        default='mixed', help='Image content (default: mixed)')
+    parser.add_argument('-c', '--changes', type=float, default=0.05,
+                        help='Fraction of blocks changed since the previous '
+                             'image version, for delta downloads (default: 0.05)')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help='Seconds of latency per request (default: 0)')
+    parser.add_argument('-b', '--bandwidth', type=float, default=0,
+                        help='Bandwidth cap per connection in MB/s '
+                             '(default: none)')
+    parser.add_argument('-n', '--connections', type=int, default=16,
+                        help='Concurrent connections served (default: 16)')
+    parser.add_argument('-R', '--no-ranges', dest='ranges',
+                        action='store_false', help='Ignore Range requests')
+    parser.add_argument('-D', '--drop-rate', type=float, default=0.0,
+                        help='Probability of a response being cut short '
+                             '(default: 0)')
+    parser.add_argument('-r', '--repeats', type=int, default=1,
+                        help='Runs per strategy (default: 1)')
+    parser.add_argument('-S', '--strategies', nargs='+',
+                        choices=sorted(_STRATEGIES), default=sorted(_STRATEGIES),
+                        help='Strategies to benchmark (default: all)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed, for reproducible runs (default: 0)')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='Write JSON results to FILE instead of stdout')
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    shaping = {
+        'latency': args.latency,
+        'bandwidth': args.bandwidth * _MB,
+        'connections': args.connections,
+        'ranges': args.ranges,
+        'drop_rate': args.drop_rate,
+    }
+    size = args.size * _MB
+    workdir = tempfile.mkdtemp(prefix='glancing-bench-')
+    try:
+        origin_dir = os.path.join(workdir, 'origin')
+        tmpdir = os.path.join(workdir, 'tmp')
+        os.mkdir(origin_dir)
+        os.mkdir(tmpdir)
+        _, base, md5 = make_images(origin_dir, size, args.kind, args.changes)
+        origin_proc, origin = start_server(ShapedServer(origin_dir, shaping))
+        glancing.urlopen = delta.urlopen = timed_urlopen
+        ctx = {'origin': origin, 'base': base, 'workdir': workdir}
+        results = []
+        try:
+            for name in args.strategies:
+                for _ in range(args.repeats):
+                    results.append(bench_one(name, ctx, tmpdir, md5, size))
+        finally:
+            origin_proc.terminate()
+    finally:
+        shutil.rmtree(workdir)
+    report = {
+        'config': dict(vars(args), python=sys.version.split()[0]),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(report, fout, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+#! /usr/bin/env python
+
+import os
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from tutils import local_pythonpath, get_local_path, GlanceServer
+
+# Setup project-local PYTHONPATH
+local_pythonpath('..', '..', 'src')
+
+import utils
+import glance
+import backup
+import chunkstore
+import glance_api
+
+# Always verbose messages during tests
+utils.set_verbose(True)
+
+_DAY = 24 * 60 * 60
+
+_RND1M_FILE = get_local_path('..', 'data', 'random_1M.bin')
+
+class BackupTest(unittest.TestCase):
+
+    def test_backup_name_time(self):
+        name = backup.backup_name('img', 86400 + 61)
+        self.assertEqual(name, 'img_backup_19700102T000101Z')
+        self.assertEqual(backup.backup_time('img', name), 86400 + 61)
+        self.assertIsNone(backup.backup_time('other', name))
+        self.assertIsNone(backup.backup_time('img', 'img_backup_garbage'))
+
+    def test_backup_get_strategy(self):
+        with mock.patch.dict(os.environ):
+            os.environ.pop('GLANCING_BACKUP_STRATEGY', None)
+            self.assertEqual(backup.get_strategy(), 'rename')
+            self.assertEqual(backup.get_strategy(None, '/tmp'), 'store')
+            self.assertEqual(backup.get_strategy('tag', '/tmp'), 'tag')
+            os.environ['GLANCING_BACKUP_STRATEGY'] = 'deactivate'
+            self.assertEqual(backup.get_strategy(), 'deactivate')
+            os.environ['GLANCING_BACKUP_STRATEGY'] = 'unknown'
+            with self.assertRaises(backup.BackupError):
+                backup.get_strategy()
+
+    def test_backup_expired(self):
+        now = 100 * _DAY
+        bklist = [(now - 10 * _DAY, 'a'), (now - 5 * _DAY, 'b'),
+                  (now - 2 * _DAY, 'c'), (now - _DAY, 'd')]
+        self.assertEqual(backup.expired(bklist, 3, None, now), ['a'])
+        self.assertEqual(backup.expired(bklist, 10, None, now), [])
+        self.assertEqual(backup.expired(bklist, 0, None, now),
+                         ['a', 'b', 'c', 'd'])
+        self.assertEqual(backup.expired(bklist, None, 3 * _DAY, now),
+                         ['a', 'b'])
+        self.assertEqual(backup.expired(bklist, 3, 3 * _DAY, now), ['a', 'b'])
+
+class BackupServerTest(unittest.TestCase):
+    '''Backups kept in a local fake glance, through the API'''
+
+    def setUp(self):
+        self.server = GlanceServer()
+        self.server.start()
+        self.environ = mock.patch.dict(os.environ, self.server.env)
+        self.environ.start()
+        glance_api.reset()
+        glance._INDEX.invalidate()
+
+    def tearDown(self):
+        glance._INDEX.invalidate()
+        glance_api.reset()
+        self.environ.stop()
+        self.server.stop()
+
+    def test_backup_rename(self):
+        imgid = glance.glance_create_id('img', 'raw')
+        self.assertTrue(backup.backup_image('img', now=_DAY))
+        self.assertFalse(glance.glance_exists('img'))
+        image = self.server.images[imgid]
+        self.assertEqual(image['name'], 'img_backup_19700102T000000Z')
+        self.assertEqual(image['glancing_backup_of'], 'img')
+        self.assertEqual(image['status'], 'queued')
+        self.assertEqual(backup.backups('img'), [(_DAY, imgid)])
+
+    def test_backup_deactivate_tag(self):
+        imgid = glance.glance_create_id('img', 'raw')
+        self.assertTrue(backup.backup_image('img', 'deactivate'))
+        self.assertEqual(self.server.images[imgid]['status'], 'deactivated')
+        imgid = glance.glance_create_id('img', 'raw')
+        self.assertTrue(backup.backup_image('img', 'tag'))
+        self.assertEqual(self.server.images[imgid]['tags'],
+                         ['glancing-backup'])
+        self.assertEqual(len(backup.backups('img')), 2)
+
+    def test_backup_retention(self):
+        ids = []
+        for day in range(1, 6):
+            ids.append(glance.glance_create_id('img', 'raw'))
+            self.assertTrue(backup.backup_image('img', keep=3, now=day * _DAY))
+        self.assertEqual([imgid for _, imgid in backup.backups('img')],
+                         ids[2:])
+        self.assertEqual(sorted(self.server.images), sorted(ids[2:]))
+        # By age
+        self.assertTrue(backup.prune('img', None, 1.5 * _DAY, 6 * _DAY))
+        self.assertEqual(list(self.server.images), [ids[4]])
+        # Other images are not touched
+        glance.glance_create_id('other', 'raw')
+        self.assertTrue(backup.prune('img', 0))
+        self.assertEqual(backup.backups('img'), [])
+        self.assertTrue(glance.glance_exists('other'))
+
+    def test_backup_download_none(self):
+        backupdir = tempfile.mkdtemp(prefix='glancing-backup-')
+        glance.glance_import_id(os.devnull, name='img', diskformat='raw')
+        self.assertTrue(backup.backup_image('img', 'download', backupdir))
+        ext = backup.get_compressor()[0]
+        self.assertEqual(sorted(os.listdir(backupdir)),
+                         sorted(['img' + ext, 'img.manifest.json']))
+        self.assertEqual(self.server.images, {})
+        shutil.rmtree(backupdir)
+        # Not backed up: a single image deleted, as before
+        ids = [glance.glance_create_id('img', 'raw') for _ in range(2)]
+        self.assertTrue(backup.backup_image('img', 'none'))
+        self.assertEqual(len(self.server.images), 1)
+        self.assertIn(list(self.server.images)[0], ids)
+
+    def test_backup_download_several(self):
+        backupdir = tempfile.mkdtemp(prefix='glancing-backup-')
+        ids = sorted(glance.glance_import_id(_RND1M_FILE, name='img',
+                                             diskformat='raw')
+                     for _ in range(2))
+        other = glance.glance_import_id(_RND1M_FILE, name='other',
+                                        diskformat='raw')
+        self.assertTrue(backup.backup_image('img', 'download', backupdir))
+        # One backup each, only those deleted
+        self.assertEqual(sorted(fname for fname in os.listdir(backupdir)
+                                if fname.endswith('.manifest.json')),
+                         ['img_%s.manifest.json' % imgid for imgid in ids])
+        self.assertEqual(list(self.server.images), [other])
+        shutil.rmtree(backupdir)
+        for _ in range(2):
+            glance.glance_import_id(_RND1M_FILE, name='img', diskformat='raw')
+        self.assertTrue(backup.backup_image('img', 'store', backupdir,
+                                            now=_DAY))
+        self.assertEqual(list(self.server.images), [other])
+        # Both kept, despite being backed up at the same time
+        self.assertEqual(
+            len(chunkstore.ChunkStore(backupdir).versions('img')), 2)
+        shutil.rmtree(backupdir)
+
+    def test_backup_dir_unusable(self):
+        with tempfile.NamedTemporaryFile() as fout:
+            glance.glance_import_id(_RND1M_FILE, name='img', diskformat='raw')
+            self.assertFalse(backup.backup_image('img', 'download', fout.name))
+            self.assertTrue(glance.glance_exists('img'))
+
+    def test_backup_download_compressed(self):
+        backupdir = tempfile.mkdtemp(prefix='glancing-backup-')
+        with open(_RND1M_FILE, 'rb') as fin:
+            data = fin.read()
+        imgid = glance.glance_import_id(_RND1M_FILE, name='img',
+                                        diskformat='raw')
+        for compressor in (('.gz', None), ('.gz', ['gzip', '-1', '-c'])):
+            self.assertTrue(backup.download_image('img', backupdir,
+                                                  compressor, _DAY))
+            self.assertEqual(sorted(os.listdir(backupdir)),
+                             ['img.gz', 'img.manifest.json'])
+            fname = os.path.join(backupdir, 'img.gz')
+            with gzip.open(fname, 'rb') as fin:
+                self.assertEqual(fin.read(), data)
+            with open(os.path.join(backupdir, 'img.manifest.json')) as fin:
+                manifest = json.load(fin)
+            self.assertEqual(manifest['id'], imgid)
+            self.assertEqual(manifest['size'], len(data))
+            self.assertEqual(manifest['compressed_size'],
+                             os.path.getsize(fname))
+            self.assertEqual(manifest['checksums']['sha512'],
+                             self.server.images[imgid]['os_hash_value'])
+            self.assertEqual(manifest['created'], '19700102T000000Z')
+            self.assertTrue(manifest['verified'])
+        shutil.rmtree(backupdir)
+
+    def test_backup_restore_latest(self):
+        backupdir = tempfile.mkdtemp(prefix='glancing-backup-')
+        outdir = tempfile.mkdtemp(prefix='glancing-restore-')
+        with open(_RND1M_FILE, 'rb') as fin:
+            data = fin.read()
+        self.assertIsNone(backup.restore_latest('img', backupdir, outdir))
+        for strategy in ('download', 'store'):
+            glance.glance_import_id(_RND1M_FILE, name='img', diskformat='raw')
+            self.assertTrue(backup.backup_image('img', strategy, backupdir))
+            fname = backup.restore_latest('img', backupdir, outdir)
+            with open(fname, 'rb') as fin:
+                self.assertEqual(fin.read(), data)
+            os.remove(fname)
+        shutil.rmtree(backupdir)
+        shutil.rmtree(outdir)
+
+    def test_backup_download_corrupted(self):
+        backupdir = tempfile.mkdtemp(prefix='glancing-backup-')
+        imgid = glance.glance_import_id(_RND1M_FILE, name='img',
+                                        diskformat='raw')
+        self.server.images[imgid]['os_hash_value'] = '0' * 128
+        self.assertFalse(backup.backup_image('img', 'download', backupdir))
+        self.assertEqual(os.listdir(backupdir), [])
+        # Not deleted, as not backed up
+        self.assertTrue(glance.glance_exists('img'))
+        # Compressor failure
+        self.assertFalse(backup.download_image('img', backupdir,
+                                               ('.gz', ['false'])))
+        self.assertEqual(os.listdir(backupdir), [])
+        shutil.rmtree(backupdir)
+
+    def test_backup_store(self):
+        backupdir = tempfile.mkdtemp(prefix='glancing-backup-')
+        for day in range(1, 4):
+            glance.glance_import_id(_RND1M_FILE, name='img', diskformat='raw')
+            self.assertTrue(backup.backup_image('img', 'store', backupdir,
+                                                keep=2, now=day * _DAY))
+            self.assertFalse(glance.glance_exists('img'))
+        store = chunkstore.ChunkStore(backupdir)
+        versions = store.versions('img')
+        self.assertEqual([when for when, _ in versions], [2 * _DAY, 3 * _DAY])
+        # The same data, stored once
+        chunks = set()
+        for _, fname in versions:
+            chunks.update(digest for digest, _ in
+                          chunkstore.load_manifest(fname)['chunks'])
+        self.assertEqual(store.referenced(), chunks)
+        with tempfile.TemporaryFile() as fout:
+            self.assertTrue(store.restore(versions[0][1], fout))
+            fout.seek(0)
+            with open(_RND1M_FILE, 'rb') as fin:
+                self.assertEqual(fout.read(), fin.read())
+        shutil.rmtree(backupdir)
+
+    def test_backup_main(self):
+        for day in range(1, 4):
+            glance.glance_create_id('img', 'raw')
+            backup.backup_image('img', now=day * _DAY)
+        with utils.devnull('stdout'):
+            self.assertTrue(backup.main(['-P', '-K', '1', 'img']))
+        self.assertEqual(len(self.server.images), 1)
+
+if __name__ == '__main__': # pragma: no cover
+    import pytest
+    pytest.main(['-x', '--pdb', __file__])
@@ -0,0 +1,185 @@
+#! /usr/bin/env python
+
+import os
+import time
+import random
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from tutils import local_pythonpath, get_local_path
+
+# Setup project-local PYTHONPATH
+local_pythonpath('..', '..', 'src')
+
+import utils
+import chunkstore
+
+# Always verbose messages during tests
+utils.set_verbose(True)
+
+_RND1M_FILE = get_local_path('..', 'data', 'random_1M.bin')
+
+_BLOCK = 4096
+
+def random_data(size):
+    '''Incompressible data, reproducible with random.seed()'''
+    return b''.join(hashlib.sha512(str(random.random()).encode()).digest()
+                    for _ in range(size // 64))
+
+def chunk(data, pieces=100000, **kwargs):
+    ret = []
+    chunker = chunkstore.Chunker(ret.append, **kwargs)
+    for idx in range(0, len(data), pieces):
+        chunker.write(data[idx:idx + pieces])
+    chunker.flush()
+    return ret
+
+class ChunkerTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(_RND1M_FILE, 'rb') as fin:
+            self.data = fin.read()
+
+    def test_chunker_sizes(self):
+        chunks = chunk(self.data, min_size=16 * _BLOCK, max_size=64 * _BLOCK,
+                       mask=0xf)
+        self.assertEqual(b''.join(chunks), self.data)
+        self.assertTrue(len(chunks) > 1)
+        for data in chunks[:-1]:
+            self.assertTrue(16 * _BLOCK <= len(data) <= 64 * _BLOCK)
+            self.assertEqual(len(data) % _BLOCK, 0)
+        # Whatever the size of the pieces written
+        self.assertEqual(chunk(self.data, 4097, min_size=16 * _BLOCK,
+                               max_size=64 * _BLOCK, mask=0xf), chunks)
+
+    def test_chunker_content_defined(self):
+        kwargs = {'min_size': 4 * _BLOCK, 'max_size': 64 * _BLOCK,
+                  'mask': 0x7}
+        chunks = chunk(self.data, **kwargs)
+        # Blocks inserted at the start: the following chunks are the same
+        shifted = chunk(os.urandom(3 * _BLOCK) + self.data, **kwargs)
+        self.assertTrue(len(set(chunks) & set(shifted)) >= len(chunks) - 3)
+
+    def test_chunker_empty(self):
+        self.assertEqual(chunk(b''), [])
+        self.assertEqual(chunk(b'x'), [b'x'])
+
+class ChunkStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='glancing-chunks-')
+        self.store = chunkstore.ChunkStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def backup(self, data, now, name='img'):
+        writer = self.store.writer(name, now=now)
+        for idx in range(0, len(data), 100000):
+            writer.write(data[idx:idx + 100000])
+        self.assertTrue(writer.close())
+        writer.commit({'name': name, 'size': writer.size,
+                       'checksums': writer.mhash.hexdigests()})
+        return writer
+
+    def restore(self, fname):
+        with tempfile.TemporaryFile() as fout:
+            self.store.restore(fname, fout)
+            fout.seek(0)
+            return fout.read()
+
+    def test_chunkstore_dedup(self):
+        random.seed(0)
+        data = bytearray(random_data(8 * 1024 * 1024))
+        versions = []
+        for day in range(1, 11):
+            # A block changed in each version
+            pos = random.randrange(len(data) // _BLOCK) * _BLOCK
+            data[pos:pos + _BLOCK] = random_data(_BLOCK)
+            versions.append(bytes(data))
+            writer = self.backup(versions[-1], day * 86400)
+            if day > 1:
+                self.assertTrue(writer.stored <= 2 * chunkstore._MAX_CHUNK)
+        stored = self.store.versions('img')
+        self.assertEqual([when for when, _ in stored],
+                         [day * 86400 for day in range(1, 11)])
+        for (_, fname), data in zip(stored, versions):
+            self.assertEqual(self.restore(fname), data)
+        # Much less than 10 versions
+        size = sum(os.path.getsize(os.path.join(dirname, fname))
+                   for dirname, _, fnames in os.walk(self.store.chunks_dir)
+                   for fname in fnames)
+        self.assertTrue(size < 4 * len(data))
+
+    def test_chunkstore_gc(self):
+        with open(_RND1M_FILE, 'rb') as fin:
+            data = fin.read()
+        self.backup(data, 86400)
+        self.backup(data[::-1], 2 * 86400)
+        first, second = [fname for _, fname in self.store.versions('img')]
+        self.assertEqual(self.store.gc(), (0, 0))
+        self.store.remove_version(first)
+        # Too recent to be removed
+        self.assertEqual(self.store.gc()[0], 0)
+        removed, freed = self.store.gc(grace=0)
+        self.assertTrue(removed > 0 and freed > 0)
+        self.assertEqual(self.restore(second), data[::-1])
+        self.store.remove_version(second)
+        self.store.gc(grace=0)
+        self.assertEqual(self.store.names(), [])
+        self.assertEqual(self.store.referenced(), set())
+        self.assertEqual([fnames for _, _, fnames
+                          in os.walk(self.store.chunks_dir) if fnames], [])
+
+    def test_chunkstore_same_second(self):
+        self.backup(b'first', 86400)
+        self.backup(b'second', 86400)
+        self.backup(b'third', 86400)
+        versions = self.store.versions('img')
+        self.assertEqual([when for when, _ in versions], [86400] * 3)
+        self.assertEqual([self.restore(fname) for _, fname in versions],
+                         [b'first', b'second', b'third'])
+
+    def test_chunkstore_gc_writing(self):
+        writer = self.store.writer('img')
+        writer.write(b'data' * 1000)
+        self.assertTrue(writer.close())
+        # Not referenced yet, but being written
+        self.assertEqual(self.store.gc(grace=0), (0, 0))
+        writer.abort()
+        self.assertEqual(self.store.gc(grace=0)[0], 1)
+        # Dead writer
+        writer = self.store.writer('img')
+        writer.write(b'data' * 1000)
+        self.assertTrue(writer.close())
+        self.assertEqual(self.store.gc(grace=0)[0], 0)
+        later = time.time() + chunkstore._LOCK_TIMEOUT
+        self.assertEqual(self.store.gc(grace=0, now=later)[0], 1)
+        self.assertEqual(sorted(os.listdir(self.root)), ['chunks'])
+
+    def test_chunkstore_corrupted(self):
+        self.backup(b'data' * 1000, 86400)
+        fname = self.store.versions('img')[0][1]
+        digest = hashlib.sha256(b'data' * 1000).hexdigest()
+        with open(self.store.chunk_path(digest), 'wb') as fout:
+            fout.write(b'garbage')
+        with self.assertRaises(chunkstore.ChunkStoreError):
+            self.restore(fname)
+
+    def test_chunkstore_main(self):
+        self.backup(b'data', 86400)
+        fname = self.store.versions('img')[0][1]
+        with utils.devnull('stdout'):
+            self.assertTrue(chunkstore.main([self.root]))
+        out = os.path.join(self.root, 'restored')
+        self.assertTrue(chunkstore.main([self.root, '-r', fname, out]))
+        with open(out, 'rb') as fin:
+            self.assertEqual(fin.read(), b'data')
+        self.assertTrue(chunkstore.main([self.root, '-g']))
+        self.assertFalse(chunkstore.main([self.root, '-r', out, out]))
+
+if __name__ == '__main__': # pragma: no cover
+    import pytest
+    pytest.main(['-x', '--pdb', __file__])
@@ -1,8 +1,15 @@
 #! /usr/bin/env python
 
+import io
 import os
+import bz2
+import gzip
+import tarfile
+import hashlib
 import shutil
+import tempfile
 import unittest
+import subprocess
 
 import mock
 
@@ -52,7 +59,10 @@ class DecompressorSimpleTest(unittest.TestCase):
 
     def test_decompressor_main(self):
         test_files = [os.path.join(self.testdir, fn) for fn in _TEST_FILES]
-        self.assertTrue(decompressor.main(test_files))
+        self.assertTrue(decompressor.main(['-r'] + test_files))
+        with mock.patch('decompressor.Decompressor.doit_any') as doit:
+            self.assertTrue(decompressor.main(['-r'] + test_files))
+            self.assertFalse(doit.called)
 
     def test_decompressor_ioerror(self):
         fn = os.path.join(self.testdir, _TEST_FILES[0])
@@ -115,6 +125,720 @@ class DecompressorErrorsTest(unittest.TestCase):
         with self.assertRaises(decompressor.DecompressorError):
             decompressor.Decompressor('/tmp/nonexistent')
 
+class StreamDecompressorTest(unittest.TestCase):
+
+    _STREAM_FILES = {'.bz2': 'random_1M_bz2.bin.bz2',
+                     '.gz': 'random_1M_gz.bin.gz'}
+
+    def setUp(self):
+        with open(get_local_path('..', 'data', 'random_1M.bin'), 'rb') as fin:
+            self.expected = fin.read()
+
+    def stream(self, ext, data, block_size=4096):
+        dec = decompressor.StreamDecompressor(ext)
+        ret = [dec.decompress(data[i:i + block_size])
+               for i in range(0, len(data), block_size)]
+        ret.append(dec.flush())
+        return b''.join(ret)
+
+    def test_stream_decompressor(self):
+        for ext, fn in self._STREAM_FILES.items():
+            with open(get_local_path('..', 'data', fn), 'rb') as fin:
+                data = fin.read()
+            self.assertEqual(self.stream(ext, data), self.expected)
+            # Concatenated streams
+            self.assertEqual(self.stream(ext, data + data), self.expected * 2)
+
+    def test_stream_decompressor_truncated(self):
+        for ext, fn in self._STREAM_FILES.items():
+            with open(get_local_path('..', 'data', fn), 'rb') as fin:
+                data = fin.read()
+            with self.assertRaises(decompressor.DecompressorError):
+                self.stream(ext, data[:-100])
+            with self.assertRaises(decompressor.DecompressorError):
+                self.stream(ext, self.expected)
+
+    def test_stream_decompressor_unsupported(self):
+        with self.assertRaises(decompressor.DecompressorError):
+            decompressor.StreamDecompressor('.zip')
+
+class DecompressingReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(get_local_path('..', 'data', 'random_1M.bin'), 'rb') as fin:
+            self.expected = fin.read()
+
+    def test_reader_iter_hooks(self):
+        for fn in ('random_1M_bz2.bin.bz2', 'random_1M_gz.bin.gz'):
+            fname = get_local_path('..', 'data', fn)
+            with open(fname, 'rb') as fin:
+                compressed = fin.read()
+            md5_in, md5_out = hashlib.md5(), hashlib.md5()
+            with decompressor.DecompressingReader(fname, block_size=1000,
+                                                  on_input=md5_in.update,
+                                                  on_output=md5_out.update) as reader:
+                data = b''.join(reader)
+            self.assertEqual(data, self.expected)
+            self.assertEqual(md5_in.hexdigest(),
+                             hashlib.md5(compressed).hexdigest())
+            self.assertEqual(md5_out.hexdigest(),
+                             hashlib.md5(self.expected).hexdigest())
+            self.assertEqual(reader.bytes_in, len(compressed))
+            self.assertEqual(reader.bytes_out, len(self.expected))
+
+    def test_reader_readinto_fileobj(self):
+        fileobj = io.BytesIO(gzip_compress(self.expected))
+        with decompressor.DecompressingReader(fileobj, '.bz2') as reader:
+            self.assertEqual(reader.ext, '.gz')
+            buf = bytearray(100000)
+            chunks = []
+            nread = reader.readinto(buf)
+            while nread:
+                chunks.append(bytes(buf[:nread]))
+                nread = reader.readinto(buf)
+        self.assertFalse(fileobj.closed)
+        self.assertEqual(b''.join(chunks), self.expected)
+
+    def test_reader_read(self):
+        fname = get_local_path('..', 'data', 'random_1M_gz.bin.gz')
+        with decompressor.DecompressingReader(fname) as reader:
+            self.assertEqual(reader.read(10), self.expected[:10])
+            self.assertEqual(reader.read(), self.expected[10:])
+            self.assertEqual(reader.read(10), b'')
+        self.assertTrue(reader.fin.closed)
+
+    def test_reader_uncompressed(self):
+        data = b'\0' * 510 + b'\x55\xaa' + self.expected
+        with decompressor.DecompressingReader(io.BytesIO(data),
+                                              '.gz') as reader:
+            self.assertEqual(reader.detected, 'raw')
+            self.assertIsNone(reader.ext)
+            self.assertEqual(reader.read(), data)
+        # Unknown data: the label is trusted
+        with self.assertRaises(decompressor.DecompressorError):
+            with decompressor.DecompressingReader(io.BytesIO(self.expected),
+                                                  '.gz') as reader:
+                reader.read()
+
+    def test_reader_truncated(self):
+        fileobj = io.BytesIO(gzip_compress(self.expected)[:-100])
+        with self.assertRaises(decompressor.DecompressorError):
+            with decompressor.DecompressingReader(fileobj) as reader:
+                reader.read()
+
+def gzip_compress(data, compresslevel=9):
+    fileobj = io.BytesIO()
+    with gzip.GzipFile(fileobj=fileobj, mode='wb',
+                       compresslevel=compresslevel) as fout:
+        fout.write(data)
+    return fileobj.getvalue()
+
+class DecompressorMultiStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp(prefix='glancing-multistream-')
+        with open(get_local_path('..', 'data', 'random_1M.bin'), 'rb') as fin:
+            self.data = fin.read()
+        self.parts = [self.data[i:i + 300000]
+                      for i in range(0, len(self.data), 300000)]
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def write(self, fn, data):
+        fname = os.path.join(self.testdir, fn)
+        with open(fname, 'wb') as fout:
+            fout.write(data)
+        return fname
+
+    def check(self, fname, expected, processes):
+        ret, fout_name = decompressor.Decompressor(fname,
+                                                   processes=processes).doit()
+        self.assertTrue(ret)
+        with open(fout_name, 'rb') as fin:
+            self.assertEqual(fin.read(), expected)
+        os.remove(fout_name)
+
+    def test_decompressor_multistream(self):
+        for fn, compress in (('multi.bin.bz2', bz2.compress),
+                             ('multi.bin.gz', gzip_compress)):
+            fname = self.write(fn, b''.join(compress(part)
+                                            for part in self.parts))
+            ext = os.path.splitext(fn)[1]
+            self.assertEqual(len(decompressor.find_streams(fname, ext)), 4)
+            for processes in (1, 2):
+                self.check(fname, self.data, processes)
+
+    def test_decompressor_single_stream(self):
+        fname = get_local_path('..', 'data', 'random_1M_gz.bin.gz')
+        self.assertEqual(len(decompressor.find_streams(fname, '.gz')), 1)
+        self.assertIsNone(decompressor.Decompressor(fname).parallel_chunks())
+
+    def test_decompressor_multistream_false_start(self):
+        # Stored (uncompressed) gzip data, looking like a gzip header
+        data = self.parts[0] + gzip_compress(b'fake')[:10] + self.parts[1]
+        fname = self.write('fake.bin.gz', gzip_compress(data, 0) +
+                           gzip_compress(self.parts[2]))
+        self.assertEqual(len(decompressor.find_streams(fname, '.gz')), 3)
+        for processes in (1, 2):
+            self.check(fname, data + self.parts[2], processes)
+
+    def test_decompressor_multistream_output_bound(self):
+        for fn, compress in (('multi.bin.bz2', bz2.compress),
+                             ('multi.bin.gz', gzip_compress)):
+            fname = self.write(fn, b''.join(compress(part)
+                                            for part in self.parts))
+            ext = os.path.splitext(fn)[1]
+            chunks = decompressor.find_streams(fname, ext)
+            job = (fname, ext) + chunks[0]
+            self.assertEqual(decompressor.decompress_stream(job),
+                             self.parts[0])
+            with mock.patch('decompressor._MAX_STREAM_SIZE', 200000):
+                # Too large streams are left to the serial fallback
+                self.assertIsNone(decompressor.decompress_stream(job))
+                out = []
+                decompressor.write_streams(fname, ext, chunks, out.append, 1)
+                self.assertEqual(b''.join(out), self.data)
+
+    def test_decompressor_multistream_gzip_isize(self):
+        # Small compressed streams, of large uncompressed size
+        parts = [b'\0' * len(part) for part in self.parts]
+        fname = self.write('multi.bin.gz', b''.join(gzip_compress(part)
+                                                    for part in parts))
+        chunks = decompressor.find_streams(fname, '.gz')
+        self.assertEqual(decompressor.gzip_stream_isizes(fname, chunks),
+                         [len(part) for part in parts])
+        self.assertEqual(decompressor.Decompressor(fname).parallel_chunks(),
+                         chunks)
+        with mock.patch('decompressor._MAX_STREAM_SIZE', 200000):
+            self.assertIsNone(
+                decompressor.Decompressor(fname).parallel_chunks())
+
+    def test_decompressor_multistream_corrupted(self):
+        data = b''.join(bz2.compress(part) for part in self.parts)
+        fname = self.write('bad.bin.bz2', data[:-100])
+        ret, fout_name = decompressor.Decompressor(fname, processes=2).doit()
+        self.assertFalse(ret)
+        self.assertFalse(os.path.exists(fout_name))
+
+class DecompressorNativeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp(prefix='glancing-native-')
+        shutil.copy(get_local_path('..', 'data', 'random_1M_gz.bin.gz'),
+                    self.testdir)
+        self.fname = os.path.join(self.testdir, 'random_1M_gz.bin.gz')
+        with open(get_local_path('..', 'data', 'random_1M.bin'), 'rb') as fin:
+            self.expected = fin.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+        decompressor.get_native_decoders(refresh=True)
+
+    def doit(self, decoders, **kwargs):
+        with mock.patch('decompressor.get_native_decoders',
+                        return_value=decoders):
+            decomp = decompressor.Decompressor(self.fname, **kwargs)
+            ret, fout_name = decomp.doit()
+        self.assertTrue(ret)
+        with open(fout_name, 'rb') as fin:
+            self.assertEqual(fin.read(), self.expected)
+        os.remove(fout_name)
+        return decomp.method
+
+    def test_decompressor_native(self):
+        self.assertEqual(self.doit({'.gz': ['gzip', '-dc']}), 'gzip')
+
+    def test_decompressor_native_disabled(self):
+        self.assertEqual(self.doit({'.gz': ['gzip', '-dc']}, native=False),
+                         'serial')
+
+    def test_decompressor_native_fallback(self):
+        self.assertEqual(self.doit({'.gz': ['false']}), 'serial')
+        self.assertEqual(self.doit({'.gz': ['/nonexistent/pigz', '-dc']}),
+                         'serial')
+
+    def test_decompressor_native_detection(self):
+        pigz = os.path.join(self.testdir, 'pigz')
+        with open(pigz, 'w') as fout:
+            fout.write('#! /bin/sh\nexec gzip "$@"\n')
+        os.chmod(pigz, 0o755)
+        with utils.environ('PATH', self.testdir):
+            decoders = decompressor.get_native_decoders(refresh=True)
+        self.assertEqual(decoders, {'.gz': [pigz, '-dc']})
+        # Cached
+        self.assertIs(decompressor.get_native_decoders(), decoders)
+        decomp = decompressor.Decompressor(self.fname)
+        ret, fout_name = decomp.doit()
+        self.assertTrue(ret)
+        self.assertEqual(decomp.method, 'pigz')
+        os.remove(fout_name)
+
+class DecompressorXzZstdTest(unittest.TestCase):
+
+    _ENCODERS = {
+        '.xz': ['xz', '-c'],
+        '.lzma': ['xz', '--format=lzma', '-c'],
+        '.zst': ['zstd', '-q', '-c'],
+    }
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp(prefix='glancing-xz-zstd-')
+        self.src = get_local_path('..', 'data', 'random_1M.bin')
+        with open(self.src, 'rb') as fin:
+            self.expected = fin.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def compress(self, ext):
+        cmd = self._ENCODERS[ext]
+        if not decompressor.find_executable(cmd[0]):
+            self.skipTest(cmd[0] + ' not available')
+        fname = os.path.join(self.testdir, 'random_1M' + ext)
+        with open(fname, 'wb') as fout:
+            subprocess.check_call(cmd + [self.src], stdout=fout)
+        return fname
+
+    def test_decompressor_xz_zstd(self):
+        for ext in self._ENCODERS:
+            self.assertIn(ext, decompressor.get_ext_map())
+            fname = self.compress(ext)
+            decomp = decompressor.Decompressor(fname)
+            ret, fout_name = decomp.doit()
+            self.assertTrue(ret, ext)
+            with open(fout_name, 'rb') as fin:
+                self.assertEqual(fin.read(), self.expected)
+            os.remove(fout_name)
+
+    def test_decompressor_xz_no_module(self):
+        fname = self.compress('.xz')
+        with mock.patch('decompressor.lzma', None):
+            decomp = decompressor.Decompressor(fname, native=False)
+            ret, fout_name = decomp.doit()
+        self.assertFalse(ret)
+
+    def test_compression_ext(self):
+        self.assertIsNone(decompressor.compression_ext(None))
+        self.assertIsNone(decompressor.compression_ext(''))
+        self.assertIsNone(decompressor.compression_ext('None'))
+        self.assertEqual(decompressor.compression_ext('gz'), '.gz')
+        self.assertEqual(decompressor.compression_ext('.XZ'), '.xz')
+        self.assertEqual(decompressor.compression_ext('zstd'), '.zst')
+        self.assertEqual(decompressor.compression_ext('bzip2'), '.bz2')
+
+class DecompressorDetectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp(prefix='glancing-detect-')
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_detect_format(self):
+        for fn, fmt in (('random_1M_gz.bin.gz', '.gz'),
+                        ('random_1M_bz2.bin.bz2', '.bz2'),
+                        ('random_1M_zip.bin.zip', '.zip'),
+                        ('random_1M.bin', 'unknown'),
+                        ('zero_length.bin', None)):
+            fname = get_local_path('..', 'data', fn)
+            self.assertEqual(decompressor.detect_format(fname), fmt, fn)
+        self.assertIsNone(decompressor.detect_format('/nonexistent'))
+
+    def test_detect_magic(self):
+        self.assertEqual(decompressor.detect_magic(b'\xfd7zXZ\x00\x00'), '.xz')
+        self.assertEqual(decompressor.detect_magic(b'\x28\xb5\x2f\xfd'),
+                         '.zst')
+        self.assertEqual(decompressor.detect_magic(b'QFI\xfb\x00\x00\x00\x03'),
+                         'qcow2')
+        self.assertEqual(decompressor.detect_magic(
+            b'\x5d\x00\x00\x80\x00' + b'\xff' * 8), '.lzma')
+        self.assertEqual(decompressor.detect_magic(
+            b'\x5d\x00\x00\x18\x00' + b'\x00' * 8), '.lzma')
+        # Not a power of two dictionary size, huge uncompressed size
+        self.assertEqual(decompressor.detect_magic(
+            b'\x5d\x00\x00\x81\x00' + b'\xff' * 8), 'unknown')
+        self.assertEqual(decompressor.detect_magic(
+            b'\x5d\x00\x00\x80\x00' + b'\xff' * 7 + b'\x7f'), 'unknown')
+        self.assertEqual(decompressor.detect_magic(b'\x5d\x00\x00'),
+                         'unknown')
+        mbr = b'\xeb\x63\x90' + b'\x01' * 507 + b'\x55\xaa'
+        self.assertEqual(decompressor.detect_magic(mbr), 'raw')
+        self.assertEqual(decompressor.detect_magic(b'\0' * 512 + b'EFI PART'),
+                         'raw')
+        self.assertEqual(decompressor.detect_magic(b'\0' * 100), 'raw')
+        self.assertEqual(decompressor.detect_magic(b'\xeb\x63\x90'),
+                         'unknown')
+        self.assertIsNone(decompressor.detect_magic(b''))
+
+    def test_decompressor_mislabelled(self):
+        fname = os.path.join(self.testdir, 'random_1M.bin.bz2')
+        shutil.copy(get_local_path('..', 'data', 'random_1M_gz.bin.gz'),
+                    fname)
+        decomp = decompressor.Decompressor(fname)
+        self.assertEqual(decomp.ext, '.gz')
+        ret, fout_name = decomp.doit()
+        self.assertTrue(ret)
+        self.assertTrue(utils.run(['cmp', fout_name, get_local_path('..',
+                                   'data', 'random_1M.bin')])[0])
+
+    def test_decompressor_not_compressed(self):
+        for data, fmt in ((b'\0' * 1024, 'raw'),
+                          (b'QFI\xfb' + b'\0' * 1020, 'qcow2')):
+            fname = os.path.join(self.testdir, 'image.gz')
+            with open(fname, 'wb') as fout:
+                fout.write(data)
+            decomp = decompressor.Decompressor(fname)
+            self.assertEqual(decomp.detected, fmt)
+            self.assertEqual(decomp.doit(delete=True), (True, fname))
+            self.assertEqual(decomp.method, 'none')
+            self.assertTrue(os.path.exists(fname))
+
+    def test_decompressor_corrupted(self):
+        # Unknown data labelled compressed: the decoder has a say
+        for ext in ('.gz', '.bz2'):
+            fname = os.path.join(self.testdir, 'image' + ext)
+            shutil.copy(get_local_path('..', 'data', 'random_1M.bin'), fname)
+            decomp = decompressor.Decompressor(fname)
+            self.assertEqual(decomp.detected, 'unknown')
+            self.assertFalse(decomp.doit()[0])
+            self.assertNotEqual(decomp.method, 'none')
+
+class DecompressorSparseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp(prefix='glancing-sparse-')
+        with open(get_local_path('..', 'data', 'random_1M.bin'), 'rb') as fin:
+            rnd = fin.read(65536)
+        self.data = rnd + b'\0' * 8 * 1024 * 1024 + rnd
+        self.fname = os.path.join(self.testdir, 'image.gz')
+        with open(self.fname, 'wb') as fout:
+            fout.write(gzip_compress(self.data))
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def doit(self, **kwargs):
+        decomp = decompressor.Decompressor(self.fname, **kwargs)
+        ret, fout_name = decomp.doit()
+        self.assertTrue(ret)
+        with open(fout_name, 'rb') as fin:
+            self.assertEqual(fin.read(), self.data)
+        usage = os.stat(fout_name).st_blocks * 512
+        os.remove(fout_name)
+        return decomp, usage
+
+    def test_decompressor_sparse(self):
+        for native in (True, False):
+            decomp, usage = self.doit(native=native)
+            self.assertEqual(decomp.written, 2 * 65536)
+            self.assertLess(usage, 1024 * 1024)
+
+    def test_decompressor_sparse_native(self):
+        with mock.patch('decompressor.get_native_decoders',
+                        return_value={'.gz': ['gzip', '-dc']}):
+            decomp, usage = self.doit(size=len(self.data), preallocate=True)
+        self.assertEqual(decomp.method, 'gzip')
+        self.assertEqual(decomp.written, 2 * 65536)
+
+    def test_decompressor_not_sparse(self):
+        decomp, _ = self.doit(sparse=False)
+        self.assertEqual(decomp.written, len(self.data))
+
+class DecompressorReuseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp(prefix='glancing-reuse-')
+        self.fname = os.path.join(self.testdir, 'random_1M_gz.bin.gz')
+        shutil.copy(get_local_path('..', 'data', 'random_1M_gz.bin.gz'),
+                    self.fname)
+        self.fout_name = os.path.join(self.testdir, 'random_1M_gz.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def doit(self, **kwargs):
+        decomp = decompressor.Decompressor(self.fname, reuse=True, **kwargs)
+        ret, fout_name = decomp.doit()
+        self.assertTrue(ret)
+        self.assertEqual(fout_name, self.fout_name)
+        self.assertFalse(os.path.exists(decomp.tmp_name))
+        return decomp.method
+
+    def test_decompressor_reuse(self):
+        self.assertEqual(self.doit(native=False), 'serial')
+        self.assertTrue(os.path.exists(self.fout_name + '.fingerprint'))
+        self.assertEqual(self.doit(), 'reused')
+        self.assertEqual(self.doit(size=1024 * 1024), 'reused')
+        # Not the expected size
+        self.assertEqual(self.doit(size=2 * 1024 * 1024, native=False),
+                         'serial')
+
+    def test_decompressor_reuse_stale(self):
+        self.doit(native=False)
+        # Changed input
+        os.utime(self.fname, (0, 0))
+        self.assertEqual(self.doit(native=False), 'serial')
+        # Output without its fingerprint
+        os.remove(self.fout_name + '.fingerprint')
+        self.assertEqual(self.doit(native=False), 'serial')
+        # Truncated output
+        with open(self.fout_name, 'r+b') as fout:
+            fout.truncate(1000)
+        self.assertEqual(self.doit(native=False), 'serial')
+        self.assertEqual(os.path.getsize(self.fout_name), 1024 * 1024)
+
+    def test_decompressor_partial_output(self):
+        with open(self.fout_name + '.part', 'wb') as fout:
+            fout.write(b'partial')
+        decomp = decompressor.Decompressor(self.fname)
+        self.assertTrue(decomp.doit()[0])
+        self.assertEqual(os.path.getsize(self.fout_name), 1024 * 1024)
+        self.assertFalse(os.path.exists(decomp.tmp_name))
+        self.assertFalse(os.path.exists(decomp.fingerprint_name))
+
+    def test_decompressor_failed_no_output(self):
+        decomp = decompressor.Decompressor(self.fname, native=False)
+        with mock.patch('utils.block_read_filedesc',
+                        mock.Mock(side_effect=IOError('Boom!'))):
+            self.assertFalse(decomp.doit()[0])
+        self.assertFalse(os.path.exists(self.fout_name))
+
+class DecompressorSizeHintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp(prefix='glancing-hint-')
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_size_hint(self):
+        for fn, ext in (('random_1M_gz.bin.gz', '.gz'),
+                        ('random_1M_zip.bin.zip', '.zip'),
+                        ('random_1M_xz.bin.xz', '.xz')):
+            self.assertEqual(decompressor.size_hint(
+                get_local_path('..', 'data', fn), ext), 1024 * 1024)
+        self.assertIsNone(decompressor.size_hint(
+            get_local_path('..', 'data', 'random_1M_bz2.bin.bz2'), '.bz2'))
+        for ext in ('.gz', '.zip', '.xz'):
+            self.assertIsNone(decompressor.size_hint(os.devnull, ext))
+        self.assertIsNone(decompressor.size_hint(
+            get_local_path('..', 'data', 'random_1M.bin'), '.xz'))
+
+    def test_size_hint_xz_streams(self):
+        fname = os.path.join(self.testdir, 'multi.xz')
+        with open(get_local_path('..', 'data', 'random_1M_xz.bin.xz'),
+                  'rb') as fin:
+            data = fin.read()
+        with open(fname, 'wb') as fout:
+            fout.write(data + data + b'\0' * 8 + data)
+        self.assertEqual(decompressor.size_hint(fname, '.xz'),
+                         3 * 1024 * 1024)
+
+    def test_size_consistent(self):
+        self.assertTrue(decompressor.size_consistent('.xz', None, 42))
+        self.assertTrue(decompressor.size_consistent('.xz', 42, None))
+        self.assertTrue(decompressor.size_consistent('.xz', 42, 42))
+        self.assertFalse(decompressor.size_consistent('.zip', 42, 43))
+        self.assertTrue(decompressor.size_consistent('.gz', 42, 43))
+        self.assertFalse(decompressor.size_consistent('.gz', 43, 42))
+
+    def test_decompressor_admit(self):
+        fname = os.path.join(self.testdir, 'random_1M_gz.bin.gz')
+        shutil.copy(get_local_path('..', 'data', 'random_1M_gz.bin.gz'), fname)
+        decomp = decompressor.Decompressor(fname)
+        self.assertEqual(decomp.needed(), 1024 * 1024)
+        with mock.patch('utils.free_space', return_value=1024):
+            self.assertFalse(decomp.admit())
+            self.assertFalse(decomp.doit()[0])
+        self.assertFalse(os.path.exists(decomp.fout_name))
+        self.assertFalse(os.path.exists(decomp.tmp_name))
+        # Expected size mismatch
+        decomp = decompressor.Decompressor(fname, size=1024)
+        self.assertFalse(decomp.doit()[0])
+        # Relocated output
+        outdir = os.path.join(self.testdir, 'out')
+        os.mkdir(outdir)
+        decomp = decompressor.Decompressor(fname, outdir=outdir)
+        ret, fout_name = decomp.doit()
+        self.assertTrue(ret)
+        self.assertEqual(fout_name, os.path.join(outdir, 'random_1M_gz.bin'))
+        self.assertEqual(os.path.getsize(fout_name), 1024 * 1024)
+
+def make_bundle(fname, mode, members):
+    '''Write a tar bundle, members is a list of (name, data) tuples'''
+    with tarfile.open(fname, mode) as tarf:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tarf.addfile(info, io.BytesIO(data))
+
+class DecompressorTarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp(prefix='glancing-tar-')
+        with open(get_local_path('..', 'data', 'random_1M.bin'), 'rb') as fin:
+            self.disk = fin.read()
+        self.members = [('appliance.ovf', b'<Envelope/>'),
+                        ('appliance-disk1.vmdk', self.disk),
+                        ('appliance.mf', b'SHA1(appliance.ovf)= 42')]
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def bundle(self, name, mode='w'):
+        fname = os.path.join(self.testdir, name)
+        make_bundle(fname, mode, self.members)
+        return fname
+
+    def test_bundle_ext(self):
+        self.assertEqual(decompressor.bundle_ext('a.ova'), '.ova')
+        self.assertEqual(decompressor.bundle_ext('a.tar.gz'), '.tar.gz')
+        self.assertEqual(decompressor.bundle_ext('a.tgz'), '.tgz')
+        self.assertIsNone(decompressor.bundle_ext('a.gz'))
+
+    def test_detect_bundle(self):
+        ova = self.bundle('a.ova')
+        self.assertEqual(decompressor.detect_format(ova), '.tar')
+        self.assertTrue(decompressor.detect_bundle(ova))
+        self.assertTrue(decompressor.detect_bundle(self.bundle('a.tgz',
+                                                               'w:gz')))
+        self.assertFalse(decompressor.detect_bundle(
+            get_local_path('..', 'data', 'random_1M_gz.bin.gz')))
+
+    def test_tar_open(self):
+        ova = self.bundle('a.ova')
+        with decompressor.tar_open(ova) as member:
+            self.assertEqual(member.name, 'appliance-disk1.vmdk')
+            self.assertEqual(member.read(), self.disk)
+        with decompressor.tar_open(ova, '*.ovf') as member:
+            self.assertEqual(member.read(), b'<Envelope/>')
+        with self.assertRaises(decompressor.DecompressorError):
+            decompressor.tar_open(ova, '*.qcow2')
+
+    def test_tar_open_single_pass(self):
+        tgz = self.bundle('a.tar.gz', 'w:gz')
+        with mock.patch('tarfile.TarFile.getmembers',
+                        side_effect=AssertionError('second pass')):
+            with decompressor.tar_open(tgz) as member:
+                self.assertEqual(member.name, 'appliance-disk1.vmdk')
+                self.assertEqual(member.read(), self.disk)
+        # No disk image name: the largest member, in a second pass
+        self.members[1] = ('appliance-disk1', self.disk)
+        with decompressor.tar_open(self.bundle('b.tar.gz', 'w:gz')) as member:
+            self.assertEqual(member.name, 'appliance-disk1')
+            self.assertEqual(member.read(), self.disk)
+
+    def test_tar_open_stream(self):
+        tgz = self.bundle('a.tar.gz', 'w:gz')
+        with decompressor.DecompressingReader(tgz) as reader:
+            self.assertEqual(decompressor.detect_magic(reader.peek(512)),
+                             '.tar')
+            with decompressor.tar_open(reader, '*.vmdk') as member:
+                self.assertEqual(member.read(), self.disk)
+        with decompressor.DecompressingReader(tgz) as reader:
+            with self.assertRaises(decompressor.DecompressorError):
+                decompressor.tar_open(reader)
+
+    def test_decompressor_bundle(self):
+        for name, mode in (('a.ova', 'w'), ('b.tar.gz', 'w:gz'),
+                           ('c.tbz2', 'w:bz2')):
+            decomp = decompressor.Decompressor(self.bundle(name, mode))
+            ret, fout_name = decomp.doit()
+            self.assertTrue(ret)
+            self.assertEqual(decomp.method, 'tar')
+            self.assertEqual(fout_name,
+                             os.path.join(self.testdir, name.split('.')[0]))
+            with open(fout_name, 'rb') as fin:
+                self.assertEqual(fin.read(), self.disk)
+
+    def test_decompressor_bundle_member(self):
+        fname = self.bundle('a.ova')
+        decomp = decompressor.Decompressor(fname, member='*.mf')
+        ret, fout_name = decomp.doit()
+        self.assertTrue(ret)
+        with open(fout_name, 'rb') as fin:
+            self.assertEqual(fin.read(), b'SHA1(appliance.ovf)= 42')
+        os.remove(fout_name)
+        decomp = decompressor.Decompressor(fname, member='nope')
+        self.assertFalse(decomp.doit()[0])
+        self.assertFalse(os.path.exists(fout_name))
+
+class DecompressorCheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp(prefix='glancing-checkpoint-')
+        with open(get_local_path('..', 'data', 'random_1M.bin'), 'rb') as fin:
+            rnd = fin.read()
+        self.data = rnd * 4
+        self.fname = os.path.join(self.testdir, 'image.gz')
+        # One stream per MB, restart points between them
+        with open(self.fname, 'wb') as fout:
+            for i in range(4):
+                fout.write(gzip_compress(rnd))
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def check_output(self, fout_name):
+        with open(fout_name, 'rb') as fin:
+            self.assertEqual(fin.read(), self.data)
+
+    def test_decompressor_checkpoint(self):
+        decomp = decompressor.Decompressor(self.fname, checkpoint=1)
+        ret, fout_name = decomp.doit()
+        self.assertTrue(ret)
+        self.assertEqual(decomp.method, 'checkpointed')
+        self.check_output(fout_name)
+        offset = 3 * 1024 * 1024 + 42
+        self.assertEqual(decomp.read_at(offset, 100),
+                         self.data[offset:offset + 100])
+
+    def test_decompressor_resume(self):
+        decomp = decompressor.Decompressor(self.fname, checkpoint=1)
+        orig_write = utils.SparseWriter.write
+        def write(writer, data):
+            if writer.pos >= 2 * 1024 * 1024:
+                raise IOError('No space left on device')
+            orig_write(writer, data)
+        with mock.patch('utils.SparseWriter.write', write):
+            self.assertFalse(decomp.doit()[0])
+        self.assertTrue(os.path.exists(decomp.tmp_name))
+        with mock.patch('zindex.IndexedDecompressor',
+                        wraps=decompressor.zindex.IndexedDecompressor) as dec:
+            ret, fout_name = decomp.doit()
+            point = dec.call_args[0][2]
+        self.assertTrue(ret)
+        self.assertEqual(point['out'], 2 * 1024 * 1024)
+        self.check_output(fout_name)
+
+    def test_decompressor_resume_other_input(self):
+        decomp = decompressor.Decompressor(self.fname, checkpoint=1)
+        with mock.patch('utils.SparseWriter.write',
+                        mock.Mock(side_effect=IOError('Boom!'))):
+            self.assertFalse(decomp.doit()[0])
+        os.utime(self.fname, (0, 0))
+        with mock.patch('zindex.IndexedDecompressor',
+                        wraps=decompressor.zindex.IndexedDecompressor) as dec:
+            self.assertTrue(decomp.doit()[0])
+            self.assertIsNone(dec.call_args[0][2])
+        self.check_output(decomp.fout_name)
+
+    def test_decompressor_sidecars(self):
+        decomp = decompressor.Decompressor(self.fname, checkpoint=1)
+        with mock.patch('utils.SparseWriter.write',
+                        mock.Mock(side_effect=IOError('Boom!'))):
+            self.assertFalse(decomp.doit()[0])
+        self.assertTrue(os.path.exists(decomp.index_name))
+        # Not resumed without checkpoint: its index would be stale
+        decomp = decompressor.Decompressor(self.fname, reuse=True)
+        self.assertTrue(decomp.doit()[0])
+        self.assertFalse(os.path.exists(decomp.index_name))
+        self.assertTrue(os.path.exists(decomp.fingerprint_name))
+        decomp.remove_sidecars()
+        self.assertEqual(sorted(os.listdir(self.testdir)),
+                         ['image', 'image.gz'])
+
 if __name__ == '__main__': # pragma: no cover
     import pytest
     pytest.main(['-x', '--pdb', __file__])
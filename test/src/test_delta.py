@@ -0,0 +1,244 @@
+#! /usr/bin/env python
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import unittest
+import threading
+
+import mock
+
+try:
+    from urllib2 import urlopen
+except ImportError: # pragma: no cover
+    from urllib.request import urlopen
+
+from tutils import local_pythonpath, get_local_path, StaticServer, GlanceServer
+
+# Setup project-local PYTHONPATH
+local_pythonpath('..', '..', 'src')
+
+import delta
+import glance
+import mirror
+import glancing
+import chunkstore
+import glance_api
+import glance_manager
+
+_OLD_FILE = get_local_path('..', 'data', 'random_1M.bin')
+_BSIZE = 64 * 1024
+_OLD_ID = '5e2c1a3e-7a2b-4d4f-9c1e-0d5b8f3a6c71'
+
+class DeltaBlockMapTest(unittest.TestCase):
+
+    def test_delta_block_map(self):
+        bmap = delta.block_map(_OLD_FILE)
+        self.assertEqual(bmap['size'], 1024 * 1024)
+        self.assertEqual(bmap['block_size'], _BSIZE)
+        self.assertEqual(len(bmap['blocks']), 16)
+        with open(_OLD_FILE, 'rb') as fin:
+            block = fin.read(_BSIZE)
+        self.assertEqual(bmap['blocks'][0],
+                         [delta.weak_sum(block), delta.strong_sum(block)])
+
+    def test_delta_block_map_empty(self):
+        bmap = delta.block_map(get_local_path('..', 'data', 'zero_length.bin'))
+        self.assertEqual(bmap['size'], 0)
+        self.assertEqual(bmap['blocks'], [])
+
+    def test_delta_missing_ranges(self):
+        self.assertEqual(delta.missing_ranges([], 10), [])
+        self.assertEqual(delta.missing_ranges([0, 1, 2], 10), [(0, 3)])
+        self.assertEqual(delta.missing_ranges([0, 3, 9], 10), [(0, 4), (9, 10)])
+
+class BaseDeltaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='glancing-delta-')
+        self.cachedir = os.path.join(self.tmpdir, 'cache')
+        self.new_file = os.path.join(self.tmpdir, 'new.img')
+        with open(_OLD_FILE, 'rb') as fin:
+            data = bytearray(fin.read())
+        # Change two blocks, and append a short one
+        data[3 * _BSIZE] ^= 0xff
+        data[10 * _BSIZE + 42] ^= 0xff
+        data += b'tail'
+        with open(self.new_file, 'wb') as fout:
+            fout.write(data)
+        self.upstream = StaticServer(self.tmpdir)
+        self.url = self.upstream.start() + '/new.img'
+        self.mirror = mirror.MirrorServer(('127.0.0.1', 0),
+                                          mirror.Cache(self.cachedir, 3600),
+                                          ['127.0.0.1'])
+        self.mirror_base = 'http://127.0.0.1:%d' % self.mirror.server_port
+        thread = threading.Thread(target=self.mirror.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.mirror.shutdown()
+        self.mirror.server_close()
+        self.upstream.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def md5(self, fname):
+        with open(fname, 'rb') as fin:
+            return hashlib.md5(fin.read()).hexdigest()
+
+    def meta_file(self, compression=''):
+        meta_file = os.path.join(self.tmpdir, 'meta.json')
+        with open(meta_file, 'w') as fout:
+            json.dump({'http://mp.stratuslab.eu/#IMG': {
+                'http://mp.stratuslab.eu/slterms#location': [
+                    {'type': 'literal', 'value': self.url}],
+                'http://mp.stratuslab.eu/slterms#os': [
+                    {'type': 'literal', 'value': 'random'}],
+                'http://purl.org/dc/terms/format': [
+                    {'type': 'literal', 'value': 'raw'}],
+                'http://purl.org/dc/terms/compression': [
+                    {'type': 'literal', 'value': compression}],
+            }}, fout)
+        return meta_file
+
+    def upgrade(self, backupdir, compression=''):
+        '''Upgrade image "img" from version 1 (ID _OLD_ID) to 2, return the
+        delta download bases: (md5, delta downloaded)
+        '''
+        old = {'checksum': '0' * 32, 'name': 'img', 'version': 1,
+               'id': _OLD_ID}
+        new = {'checksums': {'md5': self.md5(self.new_file)}, 'title': 'img',
+               'version': 2, 'compression': compression}
+        bases = []
+        get_delta = glancing.get_delta
+        def spy(url, base_file, mirror_base, compressed):
+            ret = get_delta(url, base_file, mirror_base, compressed)
+            bases.append((self.md5(base_file), ret is not None))
+            return ret
+        main = glancing.main
+        with mock.patch.dict(os.environ, {'GLANCING_BACKUP_DIR': backupdir}), \
+                mock.patch('glance.glance_rename', return_value=True), \
+                mock.patch('glance_manager.update_properties'), \
+                mock.patch('glancing.get_delta', spy), \
+                mock.patch('glancing.main',
+                           lambda args: main(['-d', '-s', new['checksums']
+                                              ['md5']] + args)):
+            glance_manager.needs_upgrade('MP', old, new,
+                                         self.meta_file(compression),
+                                         self.mirror_base)
+        return bases
+
+class DeltaDownloadTest(BaseDeltaTest):
+
+    def test_delta_rebuild(self):
+        bmap_url = mirror.blockmap_url(self.mirror_base, self.url)
+        murl = mirror.mirror_url(self.mirror_base, self.url)
+        bmap = delta.block_map(self.new_file)
+        with tempfile.NamedTemporaryFile() as fout:
+            reused, fetched = delta.rebuild(murl, bmap, _OLD_FILE, fout)
+            fout.flush()
+            self.assertEqual(self.md5(fout.name), self.md5(self.new_file))
+        self.assertEqual(reused, 14 * _BSIZE)
+        self.assertEqual(fetched, 2 * _BSIZE + 4)
+        fname = delta.get_delta(murl, bmap_url, _OLD_FILE)
+        self.assertEqual(self.md5(fname), self.md5(self.new_file))
+        os.remove(fname)
+
+    def test_delta_block_map_concurrent(self):
+        bmap_url = mirror.blockmap_url(self.mirror_base, self.url)
+        results = []
+        def fetch():
+            results.append(urlopen(bmap_url).read())
+        threads = [threading.Thread(target=fetch) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 8)
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(json.loads(results[0].decode()),
+                         delta.block_map(self.new_file))
+        # No temporary file left behind
+        self.assertEqual(len(os.listdir(self.cachedir)), 2)
+
+    def test_delta_no_block_map(self):
+        bmap_url = mirror.blockmap_url(self.mirror_base, self.url + '.nope')
+        self.assertIsNone(delta.get_delta(self.url, bmap_url, _OLD_FILE))
+
+    def test_delta_no_range_support(self):
+        bmap_url = mirror.blockmap_url(self.mirror_base, self.url)
+        self.assertIsNone(delta.get_delta(self.url, bmap_url, _OLD_FILE))
+
+    def test_delta_glancing(self):
+        args = ['-d', '-m', self.mirror_base, '-B', _OLD_FILE, self.url,
+                '-s', self.md5(self.new_file)]
+        self.assertTrue(glancing.main(args))
+        self.assertTrue(glancing.main(args[:3] + args[5:]))
+
+    def test_delta_glance_manager(self):
+        # The previous version, in the chunk store of the backup directory
+        backupdir = os.path.join(self.tmpdir, 'backup')
+        writer = chunkstore.ChunkStore(backupdir).writer('img')
+        with open(_OLD_FILE, 'rb') as fin:
+            writer.write(fin.read())
+        self.assertTrue(writer.close())
+        writer.commit({'name': 'img', 'id': _OLD_ID, 'size': writer.size,
+                       'checksums': writer.mhash.hexdigests()})
+        with mock.patch('backup.download_id') as download:
+            bases = self.upgrade(backupdir)
+            # Already backed up
+            self.assertFalse(download.called)
+        # Delta download from the restored backup
+        self.assertEqual(bases, [(self.md5(_OLD_FILE), True)])
+
+    def test_delta_glance_manager_compressed(self):
+        backupdir = os.path.join(self.tmpdir, 'backup')
+        with mock.patch('backup.store_version') as store, \
+                mock.patch('backup.restore_latest') as restore:
+            self.assertEqual(self.upgrade(backupdir, 'gz'), [])
+            self.assertFalse(store.called)
+            self.assertFalse(restore.called)
+
+class DeltaGlanceManagerBackupTest(BaseDeltaTest):
+    '''The previous version, backed up from a local fake glance'''
+
+    def setUp(self):
+        super(DeltaGlanceManagerBackupTest, self).setUp()
+        self.glance = GlanceServer()
+        self.glance.start()
+        self.environ = mock.patch.dict(os.environ, self.glance.env)
+        self.environ.start()
+        glance_api.reset()
+        glance._INDEX.invalidate()
+
+    def tearDown(self):
+        glance._INDEX.invalidate()
+        glance_api.reset()
+        self.environ.stop()
+        self.glance.stop()
+        super(DeltaGlanceManagerBackupTest, self).tearDown()
+
+    def test_delta_glance_manager_backup(self):
+        with open(_OLD_FILE, 'rb') as fin:
+            self.glance.upload(self.glance.create({'id': _OLD_ID,
+                                                   'name': 'img'}),
+                               fin.read())
+        backupdir = os.path.join(self.tmpdir, 'backup')
+        self.assertEqual(self.upgrade(backupdir), [(self.md5(_OLD_FILE), True)])
+        versions = chunkstore.ChunkStore(backupdir).versions('img')
+        self.assertEqual(len(versions), 1)
+        self.assertEqual(chunkstore.load_manifest(versions[0][1])['id'],
+                         _OLD_ID)
+
+    def test_delta_glance_manager_backup_failure(self):
+        backupdir = os.path.join(self.tmpdir, 'backup')
+        # No such image in glance: full download
+        with mock.patch('backup.restore_latest') as restore:
+            self.assertEqual(self.upgrade(backupdir), [])
+            self.assertFalse(restore.called)
+
+if __name__ == '__main__': # pragma: no cover
+    import pytest
+    pytest.main(['-x', '--pdb', __file__])
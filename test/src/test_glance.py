@@ -1,15 +1,21 @@
 #! /usr/bin/env python
 
 import os
+import time
+import hashlib
 import unittest
+import threading
 
-from tutils import local_pythonpath, get_local_path
+import mock
+
+from tutils import local_pythonpath, get_local_path, GlanceServer
 
 # Setup project-local PYTHONPATH
 local_pythonpath('..', '..', 'src')
 
 import glance
 import utils
+import glance_api
 import openstack_out
 
 # Always verbose messages during tests
@@ -30,6 +36,264 @@ class GlanceTestNoSkip(unittest.TestCase):
                 self.assertFalse(glance.glance_ok())
         self.assertTrue(glance.glance_ok())
 
+class GlanceServerTestCase(unittest.TestCase):
+    '''Run against a local fake glance, through the API'''
+
+    def setUp(self):
+        self.server = GlanceServer()
+        self.server.start()
+        self.environ = mock.patch.dict(os.environ, self.server.env)
+        self.environ.start()
+        glance_api.reset()
+        glance._INDEX.invalidate()
+
+    def tearDown(self):
+        glance._INDEX.invalidate()
+        glance_api.reset()
+        self.environ.stop()
+        self.server.stop()
+
+    def listings(self):
+        return [req[1] for req in self.server.requests if req[0] == 'GET' and
+                req[1].split('?')[0] == '/v2/images']
+
+class GlanceIndexTest(GlanceServerTestCase):
+    '''Name to ID index'''
+
+    def test_glance_index_memoized(self):
+        for name in ('img1', 'img2', 'img2'):
+            self.assertTrue(glance.glance_import(os.devnull, name=name,
+                                                 diskformat='raw'))
+        self.assertEqual(self.listings(), [])
+        self.assertTrue(glance.glance_exists('img1'))
+        self.assertEqual(len(glance.glance_ids('img2')), 2)
+        self.assertEqual(len(glance.glance_ids(['img1', 'img2'])), 3)
+        self.assertTrue(glance.glance_show('img1'))
+        # Filtered by glance, by pages
+        self.assertEqual(self.listings(), ['/v2/images?limit=100&name=img1',
+                                           '/v2/images?limit=100&name=img2'])
+        self.assertEqual(len(glance.glance_ids()), 3)
+        self.assertEqual(len(self.listings()), 3)
+        # Created, renamed & deleted images are followed
+        imgid = glance.glance_create_id('img3', 'raw')
+        self.assertEqual(glance.glance_ids('img3'), set([imgid]))
+        self.assertTrue(glance.glance_rename('img3', 'img4'))
+        self.assertFalse(glance.glance_exists('img3'))
+        self.assertEqual(glance.glance_ids('img4'), set([imgid]))
+        self.assertTrue(glance.glance_update('img4', '--property', 'a=b'))
+        self.assertTrue(glance.glance_exists('img4'))
+        self.assertTrue(glance.glance_delete_all(['img2', 'img4']))
+        self.assertFalse(glance.glance_exists('img2'))
+        self.assertFalse(glance.glance_exists(imgid))
+        self.assertTrue(glance.glance_exists('img1'))
+        self.assertEqual(len(self.listings()), 3)
+
+    def test_glance_index_ids(self):
+        imgid = glance.glance_create_id('img', 'raw')
+        glance._INDEX.invalidate()
+        self.assertEqual(glance.glance_ids(imgid), set([imgid]))
+        self.assertEqual(glance.glance_ids(imgid.replace('-', '')), set())
+        self.assertEqual(self.listings(), [])
+        # Images without name need a full listing
+        emptyid = glance.glance_create_id('', 'raw')
+        self.assertEqual(glance.glance_ids(''), set([emptyid]))
+        self.assertEqual(self.listings(), ['/v2/images?limit=100'])
+
+    def test_glance_index_external_changes(self):
+        self.assertFalse(glance.glance_exists('img'))
+        self.server.create({'name': 'img'})
+        self.assertFalse(glance.glance_exists('img'))
+        self.assertTrue(glance.glance_refresh())
+        self.assertTrue(glance.glance_exists('img'))
+        self.assertEqual(len(self.listings()), 2)
+        # Deleted by someone else: the failure invalidates the index
+        self.server.images.clear()
+        self.assertFalse(glance.glance_delete('img', quiet=True))
+        self.assertFalse(glance.glance_exists('img'))
+        self.assertEqual(len(self.listings()), 3)
+
+    def test_glance_index_ttl(self):
+        with utils.environ('GLANCING_INDEX_TTL', '0'):
+            self.assertFalse(glance.glance_exists('img'))
+            self.assertFalse(glance.glance_exists('img'))
+        self.assertEqual(len(self.listings()), 2)
+        index = glance.ImageIndex(ttl=3600)
+        self.assertEqual(index.lookup(['img', None, [], True]), set())
+        self.assertEqual(index.lookup(['img']), set())
+        self.assertEqual(len(self.listings()), 3)
+
+    def test_glance_index_unlisted(self):
+        with mock.patch.dict(os.environ, {'OS_PASSWORD': 'wrong'}):
+            glance_api.reset()
+            self.assertFalse(glance.glance_refresh(full=True))
+            self.assertEqual(glance.glance_ids(), set())
+            self.assertEqual(glance.glance_ids('img'), set())
+            self.assertFalse(glance.main([]))
+
+    def test_glance_list_filters(self):
+        self.server.page_size = 1000
+        for idx in range(5):
+            self.server.create({'name': 'img', 'mpid': 'MP%d' % (idx % 2),
+                                'status': 'active' if idx else 'queued'})
+        self.server.create({'name': 'img', 'owner': 'someone-else'})
+        self.assertEqual(len(list(glance.glance_list(mpid='MP0'))), 3)
+        self.assertEqual(len(list(glance.glance_list(mpid='MP0',
+                                                     status='active'))), 2)
+        self.assertEqual(len(list(glance.glance_list(page_size=2))), 6)
+        self.assertEqual(len(self.listings()), 2 + 3)
+        # Streamed: a page at a time
+        images = glance.glance_list(page_size=2)
+        next(images)
+        self.assertEqual(len(self.listings()), 6)
+        # image-list arguments are passed as filters, along with the name
+        self.assertEqual(len(glance.glance_ids('img', '--owner',
+                                               self.server.project)), 5)
+        self.assertIn('name=img', self.listings()[-1])
+        self.assertEqual(len(glance.glance_ids(None, '--property-filter',
+                                               'mpid=MP1')), 2)
+        with mock.patch.dict(os.environ, {'OS_PASSWORD': 'wrong'}):
+            glance_api.reset()
+            with self.assertRaises(glance.GlanceError):
+                list(glance.glance_list())
+
+class GlanceInventoryTest(GlanceServerTestCase):
+
+    def test_glance_inventory(self):
+        imgid = glance.glance_import_id(os.devnull, name='img',
+                                        diskformat='raw')
+        self.assertTrue(glance.glance_update(imgid, '--property', 'mpid=MP',
+                                             '--property', 'version=3'))
+        for idx in range(3):
+            self.server.create({'name': 'other%d' % idx})
+        self.server.create({'name': 'notmine', 'owner': 'someone-else'})
+        del self.server.requests[:]
+        records = glance.glance_inventory(self.server.project, page_size=2)
+        self.assertEqual(len(records), 4)
+        record = [rec for rec in records if rec['id'] == imgid][0]
+        self.assertEqual(record, {
+            'id': imgid, 'name': 'img', 'status': 'active', 'mpid': 'MP',
+            'version': '3', 'checksum': hashlib.md5(b'').hexdigest(),
+            'os_hash_algo': 'sha512',
+            'os_hash_value': hashlib.sha512(b'').hexdigest()})
+        # Only the listing pages
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(len(glance.glance_inventory()), 5)
+        self.assertEqual(glance.glance_project_id(), self.server.project)
+        with mock.patch.dict(os.environ, {'OS_PASSWORD': 'wrong'}):
+            glance_api.reset()
+            self.assertIsNone(glance.glance_inventory())
+            self.assertIsNone(glance.glance_project_id())
+
+    def test_glance_inventory_cli(self):
+        show = openstack_out.format_block(['Property', 'Value'], [
+            ['id', 'id-1'], ['name', 'img'], ['checksum', 'sum'],
+            ['disk_format', 'raw'], ['mpid', 'MP']])
+        with utils.environ('GLANCING_GLANCE_BACKEND', 'cli'):
+            with mock.patch('glance.glance_list',
+                            return_value=[{'id': 'id-1', 'name': 'img'},
+                                          {'id': 'id-2', 'name': 'gone'}]):
+                with mock.patch('glance.glance_show',
+                                side_effect=[show, None]):
+                    self.assertEqual(glance.glance_inventory(), [
+                        {'id': 'id-1', 'name': 'img', 'checksum': 'sum',
+                         'mpid': 'MP'}])
+
+class GlanceBulkDeleteTest(GlanceServerTestCase):
+
+    def test_glance_delete_bulk(self):
+        ids = [glance.glance_create_id('img', 'raw') for _ in range(10)]
+        other = glance.glance_create_id('other', 'raw')
+        del self.server.requests[:]
+        results = glance.glance_delete_bulk(ids + ['', 'nonexistent'],
+                                            parallel=3)
+        self.assertEqual(set(results), set(ids + ['', 'nonexistent']))
+        self.assertEqual(sorted(imgid for imgid, error in results.items()
+                                if error),
+                         sorted(['', 'nonexistent']))
+        self.assertIn('404', results['nonexistent'])
+        self.assertEqual(list(self.server.images), [other])
+        # IDs were not looked up
+        self.assertEqual(set(req[0] for req in self.server.requests),
+                         set(['DELETE']))
+        self.assertEqual(glance.glance_ids('img'), set())
+
+    def test_glance_delete_ids_parallel(self):
+        ids = ['id-%d' % idx for idx in range(10)]
+        state = {'active': 0, 'peak': 0}
+        lock = threading.Lock()
+        def delete_id(imgid):
+            with lock:
+                state['active'] += 1
+                state['peak'] = max(state['peak'], state['active'])
+            time.sleep(0.05)
+            with lock:
+                state['active'] -= 1
+            return None if imgid != 'id-3' else 'failed'
+        with mock.patch('glance.delete_id', delete_id):
+            self.assertFalse(glance.glance_delete_ids(ids, parallel=4))
+            self.assertEqual(state['peak'], 4)
+            state['peak'] = 0
+            self.assertTrue(glance.glance_delete_ids(ids[4:], parallel=1))
+            self.assertEqual(state['peak'], 1)
+        self.assertTrue(glance.glance_delete_ids([]))
+
+    def test_glance_delete_main_parallel(self):
+        for _ in range(5):
+            glance.glance_create_id('img', 'raw')
+        glance.glance_create_id('other', 'raw')
+        self.assertTrue(glance.main(['-d', 'img', '-j', '3']))
+        self.assertEqual(len(self.server.images), 1)
+        self.assertFalse(glance.main(['-d', 'img']))
+
+    def test_glance_delete_cli(self):
+        with utils.environ('GLANCING_GLANCE_BACKEND', 'cli'):
+            with mock.patch('utils.run', return_value=(False, 1, '',
+                                                       'No image\n')):
+                self.assertEqual(glance.delete_id('id-1'), 'No image')
+            with mock.patch('utils.run', return_value=(False, None, None,
+                                                       None)):
+                self.assertEqual(glance.delete_id('id-1'),
+                                 'failed to run "image-delete"')
+            with mock.patch('utils.run', return_value=(True, 0, '', '')) as run:
+                self.assertEqual(glance.glance_delete_bulk(['id-1']),
+                                 {'id-1': None})
+                self.assertEqual(run.call_args[0][0][-2:],
+                                 ['image-delete', 'id-1'])
+
+class GlanceCliListTest(unittest.TestCase):
+
+    _IMAGE_LIST = '''+------+------+
+| ID   | Name |
++------+------+
+| id-1 | img  |
++------+------+
+'''
+
+    def test_glance_cli_filters(self):
+        self.assertEqual(glance.cli_filters({}, 10), ['--page-size', '10'])
+        self.assertEqual(glance.cli_filters({'owner': 'me', 'mpid': 'MP',
+                                             'name': 'img'}, 10),
+                         ['--page-size', '10', '--property-filter', 'mpid=MP',
+                          '--property-filter', 'name=img', '--owner', 'me'])
+        self.assertEqual(glance.api_filters(['--owner', 'me',
+                                             '--property-filter', 'mpid=MP']),
+                         {'owner': 'me', 'mpid': 'MP'})
+
+    def test_glance_cli_list(self):
+        with utils.environ('GLANCING_GLANCE_BACKEND', 'cli'):
+            with mock.patch('glance.glance_run',
+                            return_value=self._IMAGE_LIST) as run:
+                self.assertEqual(list(glance.glance_list(page_size=5,
+                                                         name='img')),
+                                 [{'id': 'id-1', 'name': 'img'}])
+                run.assert_called_once_with(
+                    'image-list', glance_args=None,
+                    subcmd_args=['--page-size', '5',
+                                 '--property-filter', 'name=img'])
+            with mock.patch('glance.glance_run', return_value=None):
+                with self.assertRaises(glance.GlanceError):
+                    list(glance.glance_list())
+
 @unittest.skipUnless(_GLANCE_OK, "glance not properly configured")
 class SkipGlanceNOK(unittest.TestCase):
     pass
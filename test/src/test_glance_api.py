@@ -0,0 +1,252 @@
+#! /usr/bin/env python
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+import mock
+
+from tutils import local_pythonpath, get_local_path, GlanceServer
+
+# Setup project-local PYTHONPATH
+local_pythonpath('..', '..', 'src')
+
+import utils
+import glance
+import glancing
+import glance_api
+import chunkstore
+import openstack_out
+
+_RND1M_FILE = get_local_path('..', 'data', 'random_1M.bin')
+
+class GlanceApiTestCase(unittest.TestCase):
+    '''Run against a local fake glance, with the API backend selected'''
+
+    def setUp(self):
+        self.server = GlanceServer()
+        self.server.start()
+        self.environ = mock.patch.dict(os.environ, self.server.env)
+        self.environ.start()
+        glance_api.reset()
+        glance._INDEX.invalidate()
+
+    def tearDown(self):
+        glance_api.reset()
+        self.environ.stop()
+        self.server.stop()
+
+    def auths(self):
+        return len(self.server.tokens)
+
+class GlanceApiClientTest(GlanceApiTestCase):
+
+    def test_glance_api_token_cached(self):
+        client = glance_api.client()
+        for idx in range(5):
+            client.create(name='img%d' % idx)
+        self.assertEqual(len(list(client.images())), 5)
+        self.assertEqual(self.auths(), 1)
+        # One connection to keystone, one to glance: the same server here
+        self.assertEqual(self.server.connections, 1)
+
+    def test_glance_api_token_renewed(self):
+        client = glance_api.client()
+        client.create(name='img')
+        # Token revoked
+        del self.server.tokens[:]
+        self.assertEqual(len(list(client.images())), 1)
+        self.assertEqual(client.auths, 2)
+        # Token expired
+        self.server.expires_at = '2000-01-01T00:00:00Z'
+        client.get_token(renew=True)
+        client.show(list(self.server.images)[0])
+        self.assertEqual(client.auths, 4)
+
+    def test_glance_api_auth_failure(self):
+        with mock.patch.dict(os.environ, {'OS_PASSWORD': 'wrong'}):
+            glance_api.reset()
+            with self.assertRaises(glance_api.GlanceApiError):
+                glance_api.client().get_token()
+            self.assertFalse(glance.glance_ok())
+
+    def test_glance_api_preauthenticated(self):
+        client = glance_api.Client({'OS_TOKEN': 'given',
+                                    'OS_IMAGE_URL': self.server.base})
+        self.server.tokens.append('given')
+        client.create(name='img')
+        self.assertEqual(client.auths, 0)
+
+    def test_glance_api_reconnect(self):
+        client = glance_api.client()
+        client.create(name='img')
+        # Server-side close of the persistent connection
+        conn, _ = client.connection('http', self.server.base[7:])
+        conn.sock.close()
+        self.assertEqual(len(list(client.images())), 1)
+
+    def test_glance_api_pagination(self):
+        self.server.page_size = 2
+        client = glance_api.client()
+        ids = set(client.create(name='img%d' % idx)['id'] for idx in range(5))
+        self.assertEqual(set(img['id'] for img in client.images()), ids)
+        listings = [req for req in self.server.requests
+                    if req[0] == 'GET' and req[1].startswith('/v2/images')]
+        self.assertEqual(len(listings), 3)
+
+    def test_glance_api_upload_download(self):
+        client = glance_api.client()
+        imgid = client.create(name='img', disk_format='raw')['id']
+        upload = client.upload(imgid)
+        with open(_RND1M_FILE, 'rb') as fin:
+            data = fin.read()
+        for idx in range(0, len(data), 100000):
+            upload.write(data[idx:idx + 100000])
+        self.assertTrue(upload.commit())
+        self.assertEqual(client.show(imgid)['checksum'],
+                         hashlib.md5(data).hexdigest())
+        with tempfile.TemporaryFile() as fout:
+            self.assertTrue(client.download(imgid, fout))
+            fout.seek(0)
+            self.assertEqual(fout.read(), data)
+        self.server.images[imgid]['checksum'] = '0' * 32
+        with tempfile.TemporaryFile() as fout:
+            with self.assertRaises(glance_api.GlanceApiError):
+                client.download(imgid, fout)
+
+    def test_glance_api_upload_refused(self):
+        client = glance_api.client()
+        imgid = client.create(name='img')['id']
+        upload = client.upload(imgid)
+        upload.write(b'data')
+        self.assertFalse(upload.commit())
+
+    def test_glance_api_parse_time(self):
+        self.assertEqual(glance_api.parse_time('1970-01-02T00:00:00Z'), 86400)
+        self.assertEqual(glance_api.parse_time('1970-01-01T00:01:00.123456Z'),
+                         60)
+        self.assertEqual(glance_api.parse_time('1970-01-01T00:00:01+00:00'), 1)
+
+    def test_glance_api_main(self):
+        glance_api.client().create(name='img')
+        with utils.devnull('stdout'):
+            self.assertTrue(glance_api.main([]))
+        with mock.patch.dict(os.environ, {'OS_PASSWORD': 'wrong'}):
+            glance_api.reset()
+            self.assertFalse(glance_api.main([]))
+
+class GlanceApiBackendTest(GlanceApiTestCase):
+    '''glance.py functions, through the API backend'''
+
+    def test_glance_api_backend_selected(self):
+        self.assertTrue(glance.use_api())
+        with mock.patch.dict(os.environ, {'GLANCING_GLANCE_BACKEND': 'cli'}):
+            self.assertFalse(glance.use_api())
+
+    def test_glance_api_import(self):
+        self.assertTrue(glance.glance_ok())
+        imgid = glance.glance_import_id(_RND1M_FILE, name='img',
+                                        diskformat='raw')
+        self.assertTrue(imgid)
+        self.assertTrue(glance.glance_exists('img'))
+        self.assertTrue(glance.glance_exists(imgid))
+        self.assertEqual(glance.glance_ids('img'), set([imgid]))
+        infos = openstack_out.map_block(glance.glance_show('img'))
+        self.assertEqual(infos['id'], imgid)
+        self.assertEqual(infos['name'], 'img')
+        self.assertEqual(infos['size'], str(1024 * 1024))
+        self.assertEqual(self.auths(), 1)
+
+    def test_glance_api_import_fail(self):
+        # No disk format
+        self.assertFalse(glance.glance_import_id(os.devnull, name='img'))
+        # Wrong checksum
+        self.assertFalse(glance.glance_import_id(os.devnull, md5='0',
+                                                 name='img', diskformat='raw'))
+        # Both cleaned up
+        self.assertEqual(self.server.images, {})
+        self.assertFalse(glance.glance_show('img'))
+
+    def test_glance_api_update(self):
+        imgid = glance.glance_import_id(os.devnull, name='img',
+                                        diskformat='raw')
+        self.assertTrue(glance.glance_update('img', '--property', 'mpid=MPID',
+                                             '--property', 'version=2'))
+        self.assertTrue(glance.glance_rename('img', 'img_old'))
+        self.assertFalse(glance.glance_exists('img'))
+        image = self.server.images[imgid]
+        self.assertEqual(image['name'], 'img_old')
+        self.assertEqual(image['mpid'], 'MPID')
+        self.assertTrue(glance.glance_update(imgid, '--remove-property',
+                                             'mpid'))
+        self.assertNotIn('mpid', image)
+        self.assertFalse(glance.glance_update(imgid, '--unknown', 'value'))
+        self.assertFalse(glance.glance_update('nonexistent', '--name', 'x'))
+
+    def test_glance_api_ids_filter(self):
+        glance.glance_create_id('img', 'raw')
+        self.server.create({'name': 'other', 'owner': 'someone-else'})
+        self.assertEqual(len(glance.glance_ids()), 2)
+        self.assertEqual(len(glance.glance_ids(None, '--owner',
+                                               self.server.project)), 1)
+
+    def test_glance_api_download_delete(self):
+        glance.glance_import_id(_RND1M_FILE, name='img', diskformat='raw')
+        glance.glance_import_id(os.devnull, name='img', diskformat='raw')
+        with tempfile.NamedTemporaryFile() as fout:
+            self.assertFalse(glance.glance_download('nonexistent', fout.name))
+        fname = tempfile.mktemp()
+        self.assertTrue(glance.glance_download('img', fname))
+        self.assertTrue(os.path.exists(fname))
+        os.remove(fname)
+        self.assertTrue(glance.glance_delete_all('img'))
+        self.assertFalse(glance.glance_exists('img'))
+        self.assertFalse(glance.glance_delete('img'))
+
+    def test_glance_api_upload(self):
+        imgid = glance.glance_create_id('img', 'raw')
+        upload = glance.glance_upload(imgid)
+        self.assertIsInstance(upload, glance_api.ImageUpload)
+        upload.write(b'data')
+        self.assertTrue(upload.commit())
+        self.assertEqual(self.server.data[imgid], b'data')
+        upload = glance.glance_upload(imgid)
+        upload.abort()
+        with mock.patch.dict(os.environ, {'OS_PASSWORD': 'wrong'}):
+            glance_api.reset()
+            upload = glance.glance_upload(imgid)
+            upload.write(b'data')
+            self.assertFalse(upload.commit())
+
+    def test_glance_api_glancing(self):
+        md5 = hashlib.md5(open(_RND1M_FILE, 'rb').read()).hexdigest()
+        backupdir = tempfile.mkdtemp(prefix='glancing-backup-')
+        args = ['-b', backupdir, '-n', 'img', '-s', md5, _RND1M_FILE]
+        for pipeline in ([], ['-p']):
+            self.assertTrue(glancing.main(pipeline + args))
+            self.assertEqual(len(glance.glance_ids('img')), 1)
+        # The first import was backed up when replaced by the second one
+        self.assertEqual(sorted(os.listdir(backupdir)),
+                         ['chunks', 'manifests'])
+        self.assertEqual(len(chunkstore.ChunkStore(backupdir).versions('img')),
+                         1)
+        shutil.rmtree(backupdir)
+        self.assertEqual(self.auths(), 1)
+
+    def test_glance_api_glancing_backup_kept(self):
+        md5 = hashlib.md5(open(_RND1M_FILE, 'rb').read()).hexdigest()
+        args = ['-p', '-n', 'img', '-s', md5, '--backup-keep', '1',
+                _RND1M_FILE]
+        for _ in range(3):
+            self.assertTrue(glancing.main(args))
+        # The replaced images were kept in glance, only the last one of them
+        names = sorted(image['name'] for image in self.server.images.values())
+        self.assertEqual(len(names), 2)
+        self.assertEqual(names[0], 'img')
+        self.assertTrue(names[1].startswith('img_backup_'))
+
+if __name__ == '__main__': # pragma: no cover
+    import pytest
+    pytest.main(['-x', '--pdb', __file__])
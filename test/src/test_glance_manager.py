@@ -1,14 +1,22 @@
 #! /usr/bin/env python
 
+import os
+import re
+import shutil
+import tempfile
 import unittest
 
-from tutils import local_pythonpath, get_local_path
+import mock
+
+from tutils import local_pythonpath, get_local_path, StaticServer, GlanceServer
 
 # Setup project-local PYTHONPATH
 local_pythonpath('..', '..', 'src')
 
 import utils
 import glance
+import metadata
+import glance_api
 import glance_manager
 
 utils.set_verbose(True)
@@ -34,6 +42,19 @@ class GlanceManagerBasicTest(unittest.TestCase):
         ret = glance_manager.main(['-v'])
         self.assertFalse(ret)
 
+    def test_glance_manager_options(self):
+        locpath = get_local_path('..', 'gm_list.txt')
+        with mock.patch('glance_manager.handle_vm') as handle_vm:
+            self.assertTrue(glance_manager.main(['-l', locpath, '--no-bulk',
+                                                 '-r', '-C', '1024']))
+        self.assertEqual(handle_vm.call_args[0][4], ['-r', '-C', '1024'])
+        # Passed on to glancing.py
+        with mock.patch('glancing.main') as glancing_main:
+            glance_manager.upload_image('MP', 'img', 'meta.xml',
+                                        options=['-r'])
+        self.assertEqual(glancing_main.call_args[0][0],
+                         ['-v', '-r', '-n', 'img', 'meta.xml'])
+
     def test_glance_manager_gmf(self):
         with self.assertRaises(TypeError):
             glance_manager.get_meta_file(None, None)
@@ -46,6 +67,87 @@ class GlanceManagerBasicTest(unittest.TestCase):
         ret = glance_manager.get_meta_file('Buh-tYElvOEvst1HDyTq_6v-1si', glance_manager._DEFAULT_SL_MP_URL)
         self.assertTrue(ret)
 
+_CIRROS_ID = 'JqcGhHxmTRAEpHMmRF-xhSTM3TO'
+_UBUNTU_ID = 'LHfKVPoHcv4oMirHU0KuOQc-TvI'
+
+def sl_catalog(*fnames):
+    '''Build a marketplace catalogue out of single-image XML metadata files'''
+    entries = []
+    for fname in fnames:
+        with open(get_local_path('..', 'stratuslab', fname), 'rb') as fin:
+            data = fin.read()
+        entries.append(re.sub(r'<\?xml[^>]*\?>|</?metadata>', '', data))
+    return '<metadata>' + ''.join(entries) + '</metadata>'
+
+class GlanceManagerBulkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='glancing-gm-')
+        os.mkdir(os.path.join(self.tmpdir, 'metadata'))
+        with open(os.path.join(self.tmpdir, 'metadata', 'index.html'), 'wb') as fout:
+            fout.write(sl_catalog('cirros.xml', _UBUNTU_ID + '.wget.xml'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_glance_manager_get_meta_files(self):
+        server = StaticServer(self.tmpdir)
+        with server as base_url:
+            ret = glance_manager.get_meta_files(
+                [_CIRROS_ID, _UBUNTU_ID, 'nonexistent'],
+                base_url + '/metadata/')
+        self.assertEqual(server.hits, 1)
+        self.assertEqual(set(ret), set([_CIRROS_ID, _UBUNTU_ID]))
+        meta_file, data = ret[_CIRROS_ID]
+        self.assertEqual(data['title'], 'GLANCE_MANAGER_CIRROS_TESTING_IMAGE')
+        self.assertEqual(data['checksums']['md5'],
+                         '79b4436412283bb63c2cba4ac796bcd9')
+        self.assertEqual(metadata.MetaStratusLabXml(meta_file).get_metadata(),
+                         data)
+        for meta_file, _ in ret.values():
+            os.remove(meta_file)
+
+    def test_glance_manager_get_meta_files_unsupported(self):
+        with StaticServer(self.tmpdir) as base_url:
+            ret = glance_manager.get_meta_files([_CIRROS_ID],
+                                                base_url + '/nonexistent')
+        self.assertEqual(ret, {})
+
+class GlanceManagerInventoryTest(unittest.TestCase):
+    '''Images already in glance, from a local fake glance, through the API'''
+
+    def setUp(self):
+        self.server = GlanceServer()
+        self.server.start()
+        env = dict(self.server.env, OS_TENANT_NAME='project')
+        self.environ = mock.patch.dict(os.environ, env)
+        self.environ.start()
+        os.environ.pop('OS_TENANT_ID', None)
+        glance_api.reset()
+        glance_manager._GLANCE_IMAGES = None
+
+    def tearDown(self):
+        glance_manager._GLANCE_IMAGES = None
+        glance_api.reset()
+        self.environ.stop()
+        self.server.stop()
+
+    def test_glance_manager_get_glance_images(self):
+        for idx in range(30):
+            self.server.create({'name': 'img%d' % idx, 'checksum': 'sum%d' % idx,
+                                'mpid': 'MP%d' % idx, 'version': '1'})
+        self.server.create({'name': 'notmine', 'owner': 'someone-else'})
+        images = glance_manager.get_glance_images()
+        self.assertEqual(len(images), 3 * 30)
+        self.assertEqual(images['MP3']['name'], 'img3')
+        self.assertIs(images['sum3'], images['img3'])
+        self.assertNotIn('notmine', images)
+        # A single listing, no image shown one by one
+        self.assertEqual([req[0] for req in self.server.requests],
+                         ['POST', 'GET'])
+        self.assertIn('owner=project-id', self.server.requests[1][1])
+        self.assertIs(glance_manager.get_glance_images(), images)
+
 @unittest.skipUnless(_GLANCE_OK, "glance not properly configured")
 class GlanceManagerTest(unittest.TestCase):
 
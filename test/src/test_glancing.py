@@ -1,12 +1,21 @@
 #! /usr/bin/env python
 
+import io
 import os
 import sys
+import gzip
+import json
+import shutil
+import hashlib
+import tarfile
+import tempfile
 import unittest
 
+import mock
+
 from functools import wraps
 
-from tutils import local_pythonpath, get_local_path
+from tutils import local_pythonpath, get_local_path, StaticServer, GlanceServer
 
 # Setup project-local PYTHONPATH
 local_pythonpath('..', '..', 'src')
@@ -16,6 +25,9 @@ from utils import devnull, environ, test_name, run, cleanup
 
 import glance
 import glancing
+import glance_api
+import zindex
+import decompressor
 import multihash
 
 # Check we have a cloud ready to import images into...
@@ -74,6 +86,14 @@ class GlancingGetUrlTest(unittest.TestCase):
         self.assertIsNone(glancing.get_url(u''))
         self.assertIsNone(glancing.get_url(u'http://google.fr/totototo'))
 
+    def test_glancing_get_url_local(self):
+        local_path = get_local_path('..', 'data', 'random_1M.bin')
+        fn = glancing.get_url(local_path)
+        self.assertTrue(fn)
+        self.assertNotEqual(fn, local_path)
+        self.assertTrue(run(['cmp', local_path, fn])[0])
+        os.remove(fn)
+
 class GlancingImageDryRunNotExistentTest(unittest.TestCase):
 
     def test_glancing_image_notexistent(self):
@@ -343,6 +363,338 @@ class GlancingUrlImportTest(BaseGlancingUrl):
         self.assertTrue(glancing.main(['-n', test_name(),
             self._CIRROS_URL, '-S', self._CIRROS_SUM]))
 
+class BaseGlancingPipeline(unittest.TestCase):
+
+    _RANDOM_MD5 = '2231acba004bce55517adc0e40cc4388'
+    _SLTERMS = 'http://mp.stratuslab.eu/slterms#'
+    _SLREQ = 'http://mp.stratuslab.eu/slreq#'
+    _DCTERMS = 'http://purl.org/dc/terms/'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='glancing-pipeline-')
+        self.server = StaticServer(get_local_path('..', 'data'))
+        self.base_url = self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def meta(self, fname, compression='', size=1024 * 1024, md5=None,
+             base_url=None):
+        '''Write StratusLab JSON metadata for a test data file'''
+        def lit(value):
+            return [{'type': 'literal', 'value': value}]
+        image = {
+            self._SLTERMS + 'location': lit((base_url or self.base_url) +
+                                            '/' + fname),
+            self._SLTERMS + 'os': lit('random'),
+            self._SLTERMS + 'os-version': lit('1'),
+            self._SLTERMS + 'os-arch': lit(test_name()),
+            self._DCTERMS + 'format': lit('raw'),
+            self._DCTERMS + 'compression': lit(compression),
+        }
+        if size is not None:
+            image[self._SLREQ + 'bytes'] = lit(str(size))
+        checksum = {
+            self._SLREQ + 'algorithm': lit('MD5'),
+            self._SLREQ + 'value': lit(md5 or self._RANDOM_MD5),
+        }
+        mdfile = os.path.join(self.tmpdir, 'meta.json')
+        with open(mdfile, 'wb') as fout:
+            json.dump({'http://mp.stratuslab.eu/#IMG': image,
+                       '_:checksum': checksum}, fout)
+        return mdfile
+
+    def raw_meta(self, compression):
+        '''Write metadata for a raw disk image, with a partition table'''
+        wwwdir = os.path.join(self.tmpdir, 'www')
+        os.mkdir(wwwdir)
+        with open(get_local_path('..', 'data', 'random_1M.bin'), 'rb') as fin:
+            data = b'\0' * 510 + b'\x55\xaa' + fin.read()
+        with open(os.path.join(wwwdir, 'disk.img'), 'wb') as fout:
+            fout.write(data)
+        server = StaticServer(wwwdir)
+        self.addCleanup(server.stop)
+        return self.meta('disk.img', compression, len(data),
+                         hashlib.md5(data).hexdigest(), server.start())
+
+class GlancingPipelineDryRunTest(BaseGlancingPipeline):
+
+    def test_glancing_pipeline_compressed(self):
+        self.assertTrue(glancing.main(['-d', '-p',
+            self.meta('random_1M_gz.bin.gz', 'gz')]))
+        self.assertTrue(glancing.main(['-d', '-p',
+            self.meta('random_1M_bz2.bin.bz2', 'bz2')]))
+
+    def test_glancing_pipeline_url(self):
+        url = self.base_url + '/random_1M.bin'
+        self.assertTrue(glancing.main(['-d', '-p', url,
+                                       '-s', self._RANDOM_MD5]))
+        self.assertFalse(glancing.main(['-d', '-p', url, '-s', '0' * 32]))
+
+    def test_glancing_pipeline_bad(self):
+        self.assertFalse(glancing.main(['-d', '-p',
+            self.meta('random_1M_gz.bin.gz', 'gz', md5='0' * 32)]))
+        self.assertFalse(glancing.main(['-d', '-p',
+            self.meta('random_1M_gz.bin.gz', 'gz', size=42)]))
+        self.assertFalse(glancing.main(['-d', '-p',
+            self.meta('random_1M_zip.bin.zip', 'zip')]))
+        self.assertFalse(glancing.main(['-d', '-p',
+            self.meta('nonexistent.gz', 'gz')]))
+
+    def test_glancing_pipeline_mislabelled(self):
+        self.assertTrue(glancing.main(['-d', '-p', self.raw_meta('gz')]))
+        # Not positively uncompressed: corrupted
+        self.assertFalse(glancing.main(['-d', '-p',
+            self.meta('random_1M.bin', 'gz')]))
+        self.assertTrue(glancing.main(['-d', '-p',
+            self.meta('random_1M_bz2.bin.bz2', 'gz')]))
+        self.assertTrue(glancing.main(['-d', '-p',
+            self.meta('random_1M_gz.bin.gz', '')]))
+
+class GlancingMislabelledDryRunTest(BaseGlancingPipeline):
+
+    def test_glancing_mislabelled(self):
+        self.assertTrue(glancing.main(['-d', self.raw_meta('gz')]))
+        # Not positively uncompressed: corrupted
+        self.assertFalse(glancing.main(['-d',
+            self.meta('random_1M.bin', 'gz')]))
+        self.assertTrue(glancing.main(['-d',
+            self.meta('random_1M_bz2.bin.bz2', 'gz')]))
+        self.assertTrue(glancing.main(['-d',
+            self.meta('random_1M_gz.bin.gz', '')]))
+        self.assertTrue(glancing.main(['-d',
+            self.meta('random_1M_xz.bin.xz', 'none')]))
+
+    def test_glancing_sniff(self):
+        self.assertEqual(glancing.sniff_compression('f', '.gz', None), '.gz')
+        self.assertEqual(glancing.sniff_compression('f', '.gz', '.bz2'), '.gz')
+        self.assertIsNone(glancing.sniff_compression('f', 'raw', '.gz'))
+        self.assertEqual(glancing.sniff_compression('f', 'unknown', '.gz'),
+                         '.gz')
+        self.assertIsNone(glancing.sniff_compression('f', 'qcow2', '.gz'))
+        self.assertEqual(glancing.sniff_compression('f', None, '.gz'), '.gz')
+        metadata = {'format': 'raw'}
+        glancing.sniff_disk_format('f', 'qcow2', metadata)
+        self.assertEqual(metadata['format'], 'qcow2')
+        metadata = {'format': 'vmdk'}
+        glancing.sniff_disk_format('f', 'qcow2', metadata)
+        self.assertEqual(metadata['format'], 'vmdk')
+
+class GlancingRerunDryRunTest(BaseGlancingPipeline):
+
+    def setUp(self):
+        super(GlancingRerunDryRunTest, self).setUp()
+        # Downloads & their leftovers
+        self.downloads = os.path.join(self.tmpdir, 'downloads')
+        os.mkdir(self.downloads)
+        self.tempdir = mock.patch.object(tempfile, 'tempdir', self.downloads)
+        self.tempdir.start()
+        self._v = utils.get_verbose()
+
+    def tearDown(self):
+        utils.set_verbose(self._v)
+        self.tempdir.stop()
+        super(GlancingRerunDryRunTest, self).tearDown()
+
+    def run_main(self, args):
+        with utils.stringio() as output:
+            with utils.redirect('stdout', output):
+                ret = glancing.main(['-v'] + args)
+            return ret, output.getvalue()
+
+    def test_glancing_download_name(self):
+        url = self.base_url + '/random_1M_gz.bin.gz'
+        self.assertEqual(glancing.download_name(url),
+                         glancing.download_name(url))
+        self.assertNotEqual(glancing.download_name(url),
+                            glancing.download_name(url + '.2'))
+        fname = glancing.download_name(url)
+        self.assertEqual(glancing.get_url(url, fname), fname)
+        mtime = os.path.getmtime(get_local_path('..', 'data',
+                                                'random_1M_gz.bin.gz'))
+        self.assertEqual(os.path.getmtime(fname), int(mtime))
+        # Not downloaded again
+        with mock.patch('utils.block_read_filedesc') as read:
+            self.assertEqual(glancing.get_url(url, fname), fname)
+            self.assertFalse(read.called)
+
+    def test_glancing_reuse(self):
+        # Decompressed, then failing verification
+        mdfile = self.meta('random_1M_gz.bin.gz', 'gz', md5='0' * 32)
+        self.assertFalse(glancing.main(['-d', '-r', mdfile]))
+        leftovers = os.listdir(self.downloads)
+        self.assertEqual(len(leftovers), 2)
+        # The output is reused by the rerun, with the right checksum
+        mdfile = self.meta('random_1M_gz.bin.gz', 'gz')
+        with mock.patch('decompressor.Decompressor.doit_any') as doit:
+            ret, output = self.run_main(['-d', '-r', mdfile])
+            self.assertTrue(ret)
+            self.assertFalse(doit.called)
+        self.assertIn('reusing output', output)
+        # Nothing left once done
+        self.assertEqual(os.listdir(self.downloads), [])
+
+    def test_glancing_checkpoint(self):
+        # Multi-stream gzip file: a restart point at each stream start
+        wwwdir = os.path.join(self.tmpdir, 'www')
+        os.mkdir(wwwdir)
+        with open(get_local_path('..', 'data', 'random_1M.bin'), 'rb') as fin:
+            data = fin.read()
+        with open(os.path.join(wwwdir, 'multi.bin.gz'), 'wb') as fout:
+            for idx in range(0, len(data), 256 * 1024):
+                with gzip.GzipFile(fileobj=fout, mode='wb') as gzf:
+                    gzf.write(data[idx:idx + 256 * 1024])
+        server = StaticServer(wwwdir)
+        self.addCleanup(server.stop)
+        mdfile = self.meta('multi.bin.gz', 'gz', base_url=server.start())
+        # Failing at the end, as if the disk was full
+        with mock.patch('decompressor.Decompressor.finish',
+                        side_effect=IOError('No space left on device')):
+            self.assertFalse(glancing.main(['-d', '-C', '1024', mdfile]))
+        index = [fname for fname in os.listdir(self.downloads)
+                 if fname.endswith('.zindex')]
+        self.assertEqual(len(index), 1)
+        _, points, _ = zindex.load_index(os.path.join(self.downloads,
+                                                      index[0]))
+        self.assertTrue(len(points) >= 4)
+        # The rerun neither downloads again, nor starts from scratch
+        ret, output = self.run_main(['-d', '-C', '1024', mdfile])
+        self.assertTrue(ret)
+        self.assertIn('unchanged since downloaded', output)
+        self.assertIn('resuming at', output)
+        # Nothing left once done
+        self.assertEqual(os.listdir(self.downloads), [])
+
+class GlancingSizeHintDryRunTest(BaseGlancingPipeline):
+
+    def test_glancing_size_hint(self):
+        self.assertTrue(glancing.main(['-d',
+            self.meta('random_1M_zip.bin.zip', 'zip', size=None)]))
+        # The archive disagrees, before decompressing
+        with mock.patch('decompressor.Decompressor.doit_serial') as doit:
+            self.assertFalse(glancing.main(['-d',
+                self.meta('random_1M_zip.bin.zip', 'zip', size=42)]))
+            self.assertFalse(doit.called)
+
+    def test_glancing_scratch_dir(self):
+        scratch = os.path.join(self.tmpdir, 'scratch')
+        os.mkdir(scratch)
+        def free_space(path):
+            return 1 << 30 if path == scratch else 1024
+        mdfile = self.meta('random_1M_gz.bin.gz', 'gz')
+        with mock.patch('utils.free_space', free_space):
+            self.assertFalse(glancing.main(['-d', mdfile]))
+            with environ('GLANCING_SCRATCH_DIR', scratch):
+                self.assertTrue(glancing.main(['-d', '-k', mdfile]))
+        outputs = os.listdir(scratch)
+        self.assertEqual(len(outputs), 1)
+        self.assertEqual(os.path.getsize(os.path.join(scratch, outputs[0])),
+                         1024 * 1024)
+        # Kept download
+        os.remove(os.path.join(tempfile.gettempdir(),
+                               outputs[0][:-len('_uncompressed')]))
+
+class GlancingBundleDryRunTest(BaseGlancingPipeline):
+
+    def setUp(self):
+        super(GlancingBundleDryRunTest, self).setUp()
+        self.bundle_server = StaticServer(self.tmpdir)
+        self.bundle_url = self.bundle_server.start()
+        with open(get_local_path('..', 'data', 'random_1M.bin'), 'rb') as fin:
+            disk = fin.read()
+        with tarfile.open(os.path.join(self.tmpdir, 'app.tar.gz'),
+                          'w:gz') as tarf:
+            for name, data in (('app.ovf', b'<Envelope/>'),
+                               ('app-disk1.vmdk', disk)):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tarf.addfile(info, io.BytesIO(data))
+
+    def tearDown(self):
+        self.bundle_server.stop()
+        super(GlancingBundleDryRunTest, self).tearDown()
+
+    def test_glancing_bundle(self):
+        url = self.bundle_url + '/app.tar.gz'
+        self.assertTrue(glancing.main(['-d', url, '-s', self._RANDOM_MD5]))
+        self.assertTrue(glancing.main(['-d', '-M', '*.vmdk', url,
+                                       '-s', self._RANDOM_MD5]))
+        self.assertFalse(glancing.main(['-d', '-M', '*.ovf', url,
+                                        '-s', self._RANDOM_MD5]))
+
+    def test_glancing_bundle_pipeline(self):
+        url = self.bundle_url + '/app.tar.gz'
+        self.assertTrue(glancing.main(['-d', '-p', '-M', '*.vmdk', url,
+                                       '-s', self._RANDOM_MD5]))
+        # The largest member cannot be found in a single pass
+        self.assertFalse(glancing.main(['-d', '-p', url,
+                                        '-s', self._RANDOM_MD5]))
+
+    def test_glancing_bundle_pipeline_size(self):
+        mdfile = self.meta('app.tar.gz', base_url=self.bundle_url)
+        self.assertTrue(glancing.main(['-d', '-p', '-M', '*.vmdk', mdfile]))
+        mdfile = self.meta('app.tar.gz', size=1024 * 1024 + 1,
+                           base_url=self.bundle_url)
+        self.assertFalse(glancing.main(['-d', '-p', '-M', '*.vmdk', mdfile]))
+
+class GlancingPipelineFakeGlanceTest(BaseGlancingPipeline):
+    '''Pipeline imports into a local fake glance, through the API'''
+
+    def setUp(self):
+        super(GlancingPipelineFakeGlanceTest, self).setUp()
+        self.glance = GlanceServer()
+        self.glance.start()
+        self.environ = mock.patch.dict(os.environ, self.glance.env)
+        self.environ.start()
+        glance_api.reset()
+        glance._INDEX.invalidate()
+
+    def tearDown(self):
+        glance._INDEX.invalidate()
+        glance_api.reset()
+        self.environ.stop()
+        self.glance.stop()
+        super(GlancingPipelineFakeGlanceTest, self).tearDown()
+
+    def names(self):
+        return sorted(img['name'] for img in self.glance.images.values())
+
+    def test_glancing_pipeline_fake_import(self):
+        mdfile = self.raw_meta('')
+        self.assertTrue(glancing.main(['-p', '-n', 'img', mdfile]))
+        self.assertEqual(self.names(), ['img'])
+
+    def test_glancing_pipeline_fake_backup_failure(self):
+        mdfile = self.raw_meta('')
+        self.assertTrue(glancing.main(['-p', '-n', 'img', mdfile]))
+        old = glance.glance_id('img')
+        with mock.patch('glancing.backup_image', return_value=False):
+            self.assertFalse(glancing.main(['-p', '-n', 'img', mdfile]))
+        # No staged upload left behind
+        self.assertEqual(self.names(), ['img'])
+        self.assertIn(old, self.glance.images)
+
+    def test_glancing_pipeline_fake_rename_failure(self):
+        mdfile = self.raw_meta('')
+        with mock.patch('glance.glance_rename', return_value=False):
+            self.assertFalse(glancing.main(['-p', '-n', 'img', mdfile]))
+        self.assertEqual(self.names(), [])
+
+@unittest.skipUnless(_GLANCE_OK, "glance not properly configured")
+class GlancingPipelineImportTest(BaseGlancingPipeline):
+
+    @glance_cleanup()
+    def test_glancing_pipeline_import(self):
+        mdfile = self.meta('random_1M_gz.bin.gz', 'gz')
+        self.assertTrue(glancing.main(['-p', '-n', test_name(), mdfile]))
+        # Replacing it with a bad one keeps the old one
+        mdfile = self.meta('random_1M_gz.bin.gz', 'gz', md5='0' * 32)
+        self.assertFalse(glancing.main(['-p', '-n', test_name(), mdfile]))
+        self.assertTrue(glance.glance_exists(test_name()))
+        self.assertFalse(glance.glance_exists(test_name() +
+                                              '.glancing-upload'))
+
 class GlancingAddChecksumTest(BaseGlancingUrl):
 
     def setUp(self):
@@ -1,6 +1,9 @@
 #! /usr/bin/env python
 
+import io
 import os
+import json
+import tempfile
 import unittest
 
 from tutils import local_pythonpath, get_local_path
@@ -60,6 +63,21 @@ class MetaDataCernTest(unittest.TestCase):
         self.assertEqual(md['location'],
                          'http://download.cirros-cloud.net/0.3.4/'
                          'cirros-0.3.4-i386-disk.img')
+        self.assertIsNone(md['compression'])
+
+    def test_metadata_cern_compression(self):
+        jsonfile = get_local_path('..', 'CERN', 'test_image_list')
+        with open(jsonfile, 'rb') as fin:
+            data = json.load(fin)
+        images = data['hv:imagelist']['hv:images']
+        for ext in ('gz', 'bz2', 'xz', 'lzma', 'zst'):
+            images[0]['hv:image']['hv:uri'] = 'http://nowhere/image.img.' + ext
+            with tempfile.NamedTemporaryFile(mode='w') as fout:
+                json.dump(data, fout)
+                fout.flush()
+                m = metadata.MetaCern(fout.name,
+                                      images[0]['hv:image']['dc:identifier'])
+            self.assertEqual(m.get_metadata()['compression'], ext)
 
 class MetaDataStratusLabXmlTest(unittest.TestCase):
 
@@ -95,6 +113,37 @@ class MetaDataStratusLabXmlTest(unittest.TestCase):
         m = metadata.MetaStratusLabXml(os.devnull)
         self.assertIsNone(m.get_metadata())
 
+class MetaDataStratusLabXmlCatalogTest(unittest.TestCase):
+
+    def catalog(self, *entries):
+        return io.BytesIO('<metadata>%s</metadata>' % ''.join(entries))
+
+    def entry(self, ident, created, title):
+        return ('<rdf:RDF xmlns:dcterms="http://purl.org/dc/terms/" '
+                'xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" '
+                'xmlns:slreq="http://mp.stratuslab.eu/slreq#">'
+                '<rdf:Description><dcterms:identifier>%s</dcterms:identifier>'
+                '<slreq:endorsement><dcterms:created>%s</dcterms:created>'
+                '</slreq:endorsement><dcterms:title>%s</dcterms:title>'
+                '</rdf:Description></rdf:RDF>' % (ident, created, title))
+
+    def test_metadata_xml_catalog(self):
+        cat = self.catalog(self.entry('A', '2016-01-01', 'old'),
+                           self.entry('B', '2016-01-01', 'other'),
+                           self.entry('A', '2016-06-01', 'new'),
+                           self.entry('A', '2016-03-01', 'middle'))
+        ret = metadata.MetaStratusLabXmlCatalog(cat).get_all_metadata()
+        self.assertEqual(set(ret), set(['A', 'B']))
+        self.assertEqual(ret['A'][0]['title'], 'new')
+        self.assertEqual(ret['B'][0]['title'], 'other')
+
+    def test_metadata_xml_catalog_wanted(self):
+        cat = self.catalog(self.entry('A', '2016-01-01', 'a'),
+                           self.entry('B', '2016-01-01', 'b'))
+        ret = metadata.MetaStratusLabXmlCatalog(cat).get_all_metadata(['B'])
+        self.assertEqual(list(ret), ['B'])
+        self.assertEqual(ret['B'][0], {'checksums': {}, 'title': 'b'})
+
 class MetaDataJsonFixtureTest(unittest.TestCase):
 
     fn = 'test.json'
@@ -0,0 +1,222 @@
+#! /usr/bin/env python
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import unittest
+import threading
+
+try:
+    from urllib2 import urlopen, Request, HTTPError
+    from httplib import IncompleteRead
+except ImportError: # pragma: no cover
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+    from http.client import IncompleteRead
+
+from tutils import local_pythonpath, get_local_path, StaticServer
+
+# Setup project-local PYTHONPATH
+local_pythonpath('..', '..', 'src')
+
+import mirror
+
+_SL_DIR = get_local_path('..', 'stratuslab')
+
+class MirrorUrlTest(unittest.TestCase):
+
+    def test_mirror_url(self):
+        url = 'https://marketplace.stratuslab.eu/metadata/ID?media=xml'
+        murl = mirror.mirror_url('http://mirror:8080/', url)
+        self.assertEqual(murl, 'http://mirror:8080/https/marketplace.'
+                         'stratuslab.eu/metadata/ID?media=xml')
+        self.assertEqual(mirror.upstream_url(murl[len('http://mirror:8080'):]),
+                         url)
+
+    def test_mirror_url_noop(self):
+        self.assertEqual(mirror.mirror_url(None, 'http://a/b'), 'http://a/b')
+        self.assertEqual(mirror.mirror_url('http://m', '/tmp/x'), '/tmp/x')
+
+    def test_upstream_url_bad(self):
+        self.assertIsNone(mirror.upstream_url('/'))
+        self.assertIsNone(mirror.upstream_url('/ftp/host/path'))
+        self.assertIsNone(mirror.upstream_url('/http//path'))
+
+    def test_parse_range(self):
+        self.assertEqual(mirror.parse_range('bytes=0-9', 100), (0, 10))
+        self.assertEqual(mirror.parse_range('bytes=90-', 100), (90, 100))
+        self.assertEqual(mirror.parse_range('bytes=90-200', 100), (90, 100))
+        self.assertEqual(mirror.parse_range('bytes=-10', 100), (90, 100))
+        self.assertIsNone(mirror.parse_range('bytes=0-1,5-6', 100))
+        self.assertIsNone(mirror.parse_range('bytes=9-0', 100))
+        with self.assertRaises(ValueError):
+            mirror.parse_range('bytes=100-', 100)
+        with self.assertRaises(ValueError):
+            mirror.parse_range('bytes=-0', 100)
+
+class MirrorServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp(prefix='glancing-mirror-')
+        self.upstream = StaticServer(_SL_DIR)
+        self.upstream_url = self.upstream.start()
+        cache = mirror.Cache(self.cachedir, ttl=3600)
+        self.mirror = mirror.MirrorServer(('127.0.0.1', 0), cache,
+                                          ['127.0.0.1'])
+        self.mirror_url = 'http://127.0.0.1:%d' % self.mirror.server_port
+        self.mirror_thread = threading.Thread(target=self.mirror.serve_forever)
+        self.mirror_thread.daemon = True
+        self.mirror_thread.start()
+
+    def tearDown(self):
+        self.mirror.shutdown()
+        self.mirror.server_close()
+        self.upstream.stop()
+        shutil.rmtree(self.cachedir)
+
+    def get(self, name, headers=None):
+        url = mirror.mirror_url(self.mirror_url,
+                                self.upstream_url + '/' + name)
+        return urlopen(Request(url, headers=headers or {}))
+
+    def test_mirror_get(self):
+        with open(os.path.join(_SL_DIR, 'cirros.xml'), 'rb') as fin:
+            expected = fin.read()
+        self.assertEqual(self.get('cirros.xml').read(), expected)
+        self.assertEqual(self.get('cirros.xml').read(), expected)
+        self.assertEqual(self.upstream.hits, 1)
+
+    def test_mirror_concurrent(self):
+        results = []
+        def fetch():
+            results.append(self.get('cirros.json').read())
+        threads = [threading.Thread(target=fetch) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 8)
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(self.upstream.hits, 1)
+
+    def test_mirror_range(self):
+        with open(os.path.join(_SL_DIR, 'cirros.xml'), 'rb') as fin:
+            expected = fin.read()
+        resp = self.get('cirros.xml', {'Range': 'bytes=10-19'})
+        self.assertEqual(resp.getcode(), 206)
+        self.assertEqual(resp.read(), expected[10:20])
+        resp = self.get('cirros.xml', {'Range': 'bytes=-5'})
+        self.assertEqual(resp.read(), expected[-5:])
+
+    def test_mirror_not_found(self):
+        with self.assertRaises(HTTPError) as ctx:
+            self.get('nonexistent.xml')
+        self.assertEqual(ctx.exception.code, 404)
+        self.assertEqual(os.listdir(self.cachedir), [])
+
+    def test_mirror_host_refused(self):
+        self.mirror.allowed_hosts = ['marketplace.stratuslab.eu']
+        with self.assertRaises(HTTPError) as ctx:
+            self.get('cirros.xml')
+        self.assertEqual(ctx.exception.code, 403)
+        self.assertEqual(self.upstream.hits, 0)
+        self.assertTrue(mirror.host_allowed('http://a.cern.ch:80/x',
+                                            ['*.CERN.ch']))
+        self.assertTrue(mirror.host_allowed('http://a:81/x', ['a:81']))
+        self.assertFalse(mirror.host_allowed('http://a:81/x', ['a:80']))
+        self.assertFalse(mirror.host_allowed('http://a/x', []))
+
+    def test_mirror_stale(self):
+        with open(os.path.join(_SL_DIR, 'cirros.xml'), 'rb') as fin:
+            expected = fin.read()
+        self.mirror.cache.ttl = 0
+        self.assertEqual(self.get('cirros.xml').read(), expected)
+        self.upstream.stop()
+        # Upstream gone: the cached copy is served
+        self.assertEqual(self.get('cirros.xml').read(), expected)
+        with self.assertRaises(HTTPError) as ctx:
+            self.get('cirros.json')
+        self.assertEqual(ctx.exception.code, 502)
+
+class MirrorVerifyTest(unittest.TestCase):
+    '''Images verified against the digests of an image list'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='glancing-upstream-')
+        self.cachedir = tempfile.mkdtemp(prefix='glancing-mirror-')
+        self.data = os.urandom(100000)
+        with open(os.path.join(self.tmpdir, 'img.bin'), 'wb') as fout:
+            fout.write(self.data)
+        self.upstream = StaticServer(self.tmpdir)
+        self.upstream_url = self.upstream.start()
+        self.mirror = None
+
+    def tearDown(self):
+        if self.mirror is not None:
+            self.mirror.shutdown()
+            self.mirror.server_close()
+        self.upstream.stop()
+        shutil.rmtree(self.tmpdir)
+        shutil.rmtree(self.cachedir)
+
+    def image_list(self, sha1):
+        image = {
+            'dc:identifier': 'img',
+            'hv:uri': self.upstream_url + '/img.bin',
+            'hv:size': len(self.data),
+            'sl:os': 'linux',
+            'sl:arch': 'x86_64',
+            'sl:osversion': '1',
+            'sl:checksum:sha1': sha1,
+        }
+        fname = os.path.join(self.tmpdir, 'list.json')
+        with open(fname, 'w') as fout:
+            json.dump({'hv:imagelist': {'hv:images': [{'hv:image': image}]}},
+                      fout)
+        return fname
+
+    def start(self, image_lists=()):
+        cache = mirror.Cache(self.cachedir, 3600, image_lists)
+        self.mirror = mirror.MirrorServer(('127.0.0.1', 0), cache,
+                                          ['127.0.0.1'])
+        thread = threading.Thread(target=self.mirror.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def get(self, name):
+        return urlopen(mirror.mirror_url(
+            'http://127.0.0.1:%d' % self.mirror.server_port,
+            self.upstream_url + '/' + name)).read()
+
+    def test_mirror_verified(self):
+        self.start([self.image_list(hashlib.sha1(self.data).hexdigest())])
+        self.assertEqual(self.get('img.bin'), self.data)
+        self.assertEqual(len(os.listdir(self.cachedir)), 1)
+
+    def test_mirror_verify_failed(self):
+        self.start([self.image_list('0' * 40)])
+        # Streamed while downloading, but never complete
+        try:
+            self.assertNotEqual(self.get('img.bin'), self.data)
+        except (HTTPError, IncompleteRead):
+            pass
+        self.assertEqual(os.listdir(self.cachedir), [])
+
+    def test_mirror_learn(self):
+        # Digests learnt from an image list going through the mirror
+        self.image_list('0' * 40)
+        self.start()
+        self.assertEqual(json.loads(self.get('list.json').decode())
+                         ['hv:imagelist']['hv:images'][0]['hv:image']
+                         ['sl:checksum:sha1'], '0' * 40)
+        try:
+            self.assertNotEqual(self.get('img.bin'), self.data)
+        except (HTTPError, IncompleteRead):
+            pass
+        self.assertEqual(len(os.listdir(self.cachedir)), 1)
+
+if __name__ == '__main__': # pragma: no cover
+    import pytest
+    pytest.main(['-x', '--pdb', __file__])
@@ -7,8 +7,13 @@ from __future__ import print_function
 import os
 import sys
 import uuid
+import errno
+import shutil
+import tempfile
 import unittest
 
+import mock
+
 from tutils import local_pythonpath, get_local_path
 
 # Setup project-local PYTHONPATH
@@ -352,6 +357,144 @@ class UtilsTest(unittest.TestCase):
         self.assertFalse(called[0])
 
 
+class UtilsCopyFiledescTest(unittest.TestCase):
+
+    _METHODS = ('reflink', 'copy_file_range', 'sendfile', 'read/write')
+
+    def copy_check(self, src, block_size=4096):
+        dst = '/tmp/' + utils.test_name()
+        with open(src, 'rb') as fin:
+            with open(dst, 'wb') as fout:
+                how = utils.copy_filedesc(fin.fileno(), fout.fileno(),
+                                          block_size)
+        self.assertIn(how, self._METHODS)
+        with open(src, 'rb') as fin:
+            with open(dst, 'rb') as fout:
+                self.assertEqual(fin.read(), fout.read())
+        os.remove(dst)
+        return how
+
+    def test_utils_copy_filedesc(self):
+        self.copy_check(get_local_path('..', 'data', 'random_1M.bin'))
+        self.copy_check(get_local_path('..', 'data', 'zero_length.bin'))
+
+    def test_utils_copy_filedesc_no_fast_path(self):
+        with mock.patch('utils._reflink', return_value=False):
+            with mock.patch('utils._kernel_copy', return_value=None):
+                how = self.copy_check(get_local_path('..', 'data',
+                                                     'random_1M.bin'), 1000)
+        self.assertEqual(how, 'read/write')
+
+    def test_utils_copy_filedesc_kernel_copy(self):
+        src = get_local_path('..', 'data', 'random_1M.bin')
+        with mock.patch('utils._reflink', return_value=False):
+            how = self.copy_check(src)
+        # python 2 has neither os.copy_file_range() nor os.sendfile()
+        self.assertIn(how, ('copy_file_range', 'sendfile'))
+
+    def test_utils_copy_filedesc_libc_sendfile(self):
+        src = get_local_path('..', 'data', 'random_1M.bin')
+        with mock.patch('utils._reflink', return_value=False):
+            with mock.patch('utils._libc_copy_file_range',
+                            side_effect=OSError(errno.EXDEV, 'EXDEV')):
+                with mock.patch.object(os, 'copy_file_range', None,
+                                       create=True):
+                    with mock.patch.object(os, 'sendfile', None, create=True):
+                        how = self.copy_check(src)
+        self.assertEqual(how, 'sendfile')
+
+    def test_utils_copy_filedesc_not_regular(self):
+        with open(os.devnull, 'rb') as fin:
+            with open(os.devnull, 'wb') as fout:
+                how = utils.copy_filedesc(fin.fileno(), fout.fileno())
+        self.assertEqual(how, 'read/write')
+
+    def test_utils_copy_filedesc_zero_size(self):
+        with self.assertRaises(IOError):
+            utils.copy_filedesc(0, 1, block_size=0)
+
+class UtilsWriteAtomicTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='glancing-atomic-')
+        self.fname = os.path.join(self.dir, 'sub', 'dir', 'file')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_utils_write_atomic(self):
+        utils.write_atomic(self.fname, b'one')
+        utils.write_atomic(self.fname, b'two')
+        with open(self.fname, 'rb') as fin:
+            self.assertEqual(fin.read(), b'two')
+        self.assertEqual(os.listdir(os.path.dirname(self.fname)), ['file'])
+
+    def test_utils_write_atomic_no_overwrite(self):
+        utils.write_atomic(self.fname, 'one', 'w', overwrite=False)
+        with self.assertRaises(OSError) as exc:
+            utils.write_atomic(self.fname, 'two', 'w', overwrite=False)
+        self.assertEqual(exc.exception.errno, errno.EEXIST)
+        with open(self.fname) as fin:
+            self.assertEqual(fin.read(), 'one')
+        self.assertEqual(os.listdir(os.path.dirname(self.fname)), ['file'])
+
+class UtilsSparseWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.dst = tempfile.mkstemp(prefix='glancing-sparse-')
+        os.close(fd)
+        with open(get_local_path('..', 'data', 'random_1M.bin'), 'rb') as fin:
+            rnd = fin.read(8192)
+        # Zero runs, aligned or not on blocks, and a zero tail
+        self.data = (b'\0' * 100000 + rnd[:5000] + b'\0' * 50000 +
+                     rnd[5000:] + b'\0' * 10000)
+
+    def tearDown(self):
+        os.remove(self.dst)
+
+    def write(self, chunk_size, **kwargs):
+        with open(self.dst, 'wb') as fout:
+            writer = utils.SparseWriter(fout, **kwargs)
+            for i in range(0, len(self.data), chunk_size):
+                writer.write(self.data[i:i + chunk_size])
+            self.assertEqual(writer.finish(), len(self.data))
+        with open(self.dst, 'rb') as fin:
+            self.assertEqual(fin.read(), self.data)
+        return writer
+
+    def test_utils_sparse_writer(self):
+        for chunk_size in (1000, 4096, 65536, len(self.data)):
+            writer = self.write(chunk_size)
+            # Only the blocks with non-zero data
+            self.assertLessEqual(writer.written, 5 * 4096)
+
+    def test_utils_sparse_writer_not_sparse(self):
+        writer = self.write(4096, sparse=False)
+        self.assertEqual(writer.written, len(self.data))
+
+    def test_utils_sparse_writer_size(self):
+        writer = self.write(65536, size=len(self.data), preallocate=True)
+        self.assertLess(writer.written, len(self.data))
+
+    def test_utils_sparse_writer_holes(self):
+        with open(self.dst, 'wb') as fout:
+            writer = utils.SparseWriter(fout)
+            writer.write(b'\0' * 16 * 1024 * 1024)
+            writer.write(b'end')
+            writer.finish()
+        self.assertEqual(os.path.getsize(self.dst), 16 * 1024 * 1024 + 3)
+        self.assertLess(os.stat(self.dst).st_blocks * 512, 1024 * 1024)
+
+    def test_utils_sparse_writer_bad_block_size(self):
+        with open(os.devnull, 'wb') as fout:
+            with self.assertRaises(IOError):
+                utils.SparseWriter(fout, block_size=0)
+
+    def test_utils_fallocate(self):
+        with open(self.dst, 'wb') as fout:
+            self.assertTrue(utils.fallocate(fout.fileno(), 0, 4096))
+        self.assertEqual(os.path.getsize(self.dst), 4096)
+
 class UtilsRunTest(unittest.TestCase):
 
     def test_utils_run_true(self):
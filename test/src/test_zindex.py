@@ -0,0 +1,115 @@
+#! /usr/bin/env python
+
+import os
+import bz2
+import zlib
+import shutil
+import tempfile
+import unittest
+
+from tutils import local_pythonpath, get_local_path
+
+# Setup project-local PYTHONPATH
+local_pythonpath('..', '..', 'src')
+
+import zindex
+
+def sync_gzip(data, block_size=100000):
+    '''gzip data, with a sync flush after each block, like pigz does'''
+    comp = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    ret = []
+    for i in range(0, len(data), block_size):
+        ret.append(comp.compress(data[i:i + block_size]))
+        ret.append(comp.flush(zlib.Z_SYNC_FLUSH))
+    ret.append(comp.flush())
+    return b''.join(ret)
+
+def decompress(dec, data, block_size=65536):
+    ret = [dec.decompress(data[i:i + block_size])
+           for i in range(0, len(data), block_size)]
+    ret.append(dec.flush())
+    return b''.join(ret)
+
+class ZIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(get_local_path('..', 'data', 'random_1M.bin'), 'rb') as fin:
+            rnd = fin.read()
+        # Compressible, with references across sync points
+        self.data = b''.join(rnd[i:i + 3000] + b'\0' * 5000 + rnd[:1000] * 3
+                             for i in range(0, 1024 * 1024, 4096))
+        self.testdir = tempfile.mkdtemp(prefix='glancing-zindex-')
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_zindex_gzip_sync_points(self):
+        gz = sync_gzip(self.data)
+        dec = zindex.IndexedDecompressor('.gz', 500000)
+        self.assertEqual(decompress(dec, gz), self.data)
+        self.assertGreater(len(dec.points), 1)
+        for point in dec.points:
+            self.assertIn('window', point)
+            resumed = zindex.IndexedDecompressor('.gz', 500000, point)
+            self.assertEqual(decompress(resumed, gz[point['in']:]),
+                             self.data[point['out']:])
+
+    def test_zindex_no_sync_points(self):
+        gz = sync_gzip(self.data, len(self.data))
+        dec = zindex.IndexedDecompressor('.gz', 1)
+        self.assertEqual(decompress(dec, gz), self.data)
+        self.assertEqual(dec.points, [])
+
+    def test_zindex_streams(self):
+        for ext, compress in (('.gz', sync_gzip), ('.bz2', bz2.compress)):
+            half = len(self.data) // 2
+            data = compress(self.data[:half]) + compress(self.data[half:])
+            dec = zindex.IndexedDecompressor(ext, half)
+            self.assertEqual(decompress(dec, data), self.data)
+            self.assertIn({'in': len(compress(self.data[:half])), 'out': half},
+                          dec.points)
+
+    def test_zindex_truncated(self):
+        gz = sync_gzip(self.data)
+        for data in (gz[:-4], gz[:len(gz) // 2], b''):
+            with self.assertRaises(zindex.ZIndexError):
+                decompress(zindex.IndexedDecompressor('.gz', 1), data)
+        point = zindex.IndexedDecompressor('.gz', 1)
+        decompress(point, gz)
+        point = point.points[-1]
+        # Resumed stream with a bad trailer
+        bad = gz[:-8] + b'\0' * 8
+        with self.assertRaises(zindex.ZIndexError):
+            decompress(zindex.IndexedDecompressor('.gz', 1, point),
+                       bad[point['in']:])
+        with self.assertRaises(zindex.ZIndexError):
+            zindex.IndexedDecompressor('.zip')
+
+    def test_zindex_file(self):
+        gz = sync_gzip(self.data)
+        fname = os.path.join(self.testdir, 'data.gz')
+        with open(fname, 'wb') as fout:
+            fout.write(gz)
+        dec = zindex.IndexedDecompressor('.gz', 200000)
+        decompress(dec, gz)
+        index_name = os.path.join(self.testdir, 'data.zindex')
+        with zindex.create_index(index_name, '.gz', {'size': 42}) as fidx:
+            zindex.append_points(fidx, dec.points)
+        # Last line cut short by a crash
+        with open(index_name, 'a') as fidx:
+            fidx.write('{"in": 12')
+        header, points, valid = zindex.load_index(index_name)
+        self.assertEqual(header, {'ext': '.gz', 'input': {'size': 42}})
+        self.assertEqual(points[1:], dec.points)
+        with zindex.reopen_index(index_name, valid) as fidx:
+            zindex.append_points(fidx, dec.points[-1:])
+        index = zindex.load_index(index_name)
+        self.assertEqual(len(index[1]), len(dec.points) + 2)
+        for offset in (0, 10, 300000, len(self.data) - 10, len(self.data)):
+            self.assertEqual(zindex.read_at(fname, index, offset, 70000),
+                             self.data[offset:offset + 70000])
+        self.assertIsNone(zindex.load_index(fname + '.nope'))
+
+if __name__ == '__main__': # pragma: no cover
+    import pytest
+    pytest.main(['-x', '--pdb', __file__])
@@ -2,6 +2,22 @@
 
 import os
 import sys
+import json
+import uuid
+import hashlib
+import threading
+
+try:
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from urllib import urlencode
+    from urlparse import parse_qsl
+except ImportError: # pragma: no cover
+    from http.server import (SimpleHTTPRequestHandler, HTTPServer,
+                             BaseHTTPRequestHandler)
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlencode, parse_qsl
 
 def mod_path():
     file_myself = __file__ or sys.argv[0]
@@ -17,3 +33,228 @@ def local_pythonpath(*args):
     local_path = get_local_path(*args)
     if local_path not in sys.path:
         sys.path.append(local_path)
+
+class StaticHandler(SimpleHTTPRequestHandler):
+    '''Serve files from the server's directory, ignoring query strings,
+       and count GET requests. A directory is served as its index.html
+    '''
+
+    def translate_path(self, path):
+        path = path.split('?', 1)[0].lstrip('/')
+        path = os.path.join(self.server.directory, path)
+        # Directory index without redirection to a trailing-slashed URL
+        if os.path.isdir(path):
+            path = os.path.join(path, 'index.html')
+        return path
+
+    def do_GET(self):
+        self.server.hits += 1
+        SimpleHTTPRequestHandler.do_GET(self)
+
+    def log_message(self, *args):
+        pass
+
+class StaticServer(ThreadingMixIn, HTTPServer):
+    '''Local stand-in for remote HTTP servers, use as a context manager:
+
+    with StaticServer('/path/to/files') as base_url:
+        urlopen(base_url + '/file.txt')
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, directory, handler=StaticHandler):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.directory = directory
+        self.hits = 0
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'http://127.0.0.1:%d' % self.server_port
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+class GlanceHandler(BaseHTTPRequestHandler):
+    '''Minimal keystone v3 & glance v2 API, on persistent connections'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            data = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunk = self.rfile.read(size + 2)[:size]
+                if not size:
+                    return b''.join(data)
+                data.append(chunk)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def reply(self, status, body=None, headers=None):
+        data = b''
+        if isinstance(body, bytes):
+            data = body
+        elif body is not None:
+            data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        for key, val in (headers or {}).items():
+            self.send_header(key, val)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self, method):
+        server = self.server
+        server.requests.append((method, self.path))
+        body = self.read_body()
+        path, _, query = self.path.partition('?')
+        if method == 'POST' and path == '/v3/auth/tokens':
+            return self.auth(json.loads(body.decode('utf-8')))
+        if self.headers.get('X-Auth-Token') not in server.tokens:
+            return self.reply(401, {'error': 'unauthorized'})
+        if not path.startswith('/v2/images'):
+            return self.reply(404)
+        parts = path.split('/')[3:]
+        image = server.images.get(parts[0]) if parts else None
+        if parts and image is None:
+            return self.reply(404)
+        if method == 'GET' and not parts:
+            return self.reply(200, server.list_images(query))
+        if method == 'POST' and not parts:
+            return self.reply(201, server.create(json.loads(body.decode('utf-8'))))
+        if method == 'GET' and parts[1:] == ['file']:
+            return self.reply(200, server.data[image['id']],
+                              {'Content-MD5': image['checksum']})
+        if method == 'PUT' and parts[1:] == ['file']:
+            if not image['disk_format']:
+                return self.reply(400, {'error': 'disk_format not set'})
+            server.upload(image, body)
+            return self.reply(204)
+        if method == 'GET':
+            return self.reply(200, image)
+        if method == 'POST' and parts[1:] == ['actions', 'deactivate']:
+            image['status'] = 'deactivated'
+            return self.reply(204)
+        if method == 'PUT' and parts[1:2] == ['tags']:
+            image['tags'].append(parts[2])
+            return self.reply(204)
+        if method == 'PATCH':
+            for change in json.loads(body.decode('utf-8')):
+                key = change['path'][1:]
+                if change['op'] == 'remove':
+                    del image[key]
+                else:
+                    image[key] = change['value']
+            return self.reply(200, image)
+        if method == 'DELETE':
+            del server.images[image['id']]
+            return self.reply(204)
+        return self.reply(405)
+
+    def auth(self, body):
+        server = self.server
+        password = body['auth']['identity']['password']['user']['password']
+        if password != server.password:
+            return self.reply(401, {'error': 'bad password'})
+        token = 'token-%d' % len(server.tokens)
+        server.tokens.append(token)
+        catalog = [{'type': 'image', 'endpoints': [
+            {'interface': 'public', 'region_id': 'region',
+             'url': server.base}]}]
+        return self.reply(201, {'token': {
+            'expires_at': server.expires_at, 'catalog': catalog,
+            'project': {'id': server.project}}}, {'X-Subject-Token': token})
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_PATCH(self):
+        self.handle_request('PATCH')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def log_message(self, *args):
+        pass
+
+class GlanceServer(StaticServer):
+    '''In-memory stand-in for keystone & glance, use as a context manager,
+    like StaticServer. env holds the OS_* variables to access it
+    '''
+
+    page_size = 25
+
+    def __init__(self):
+        StaticServer.__init__(self, None, GlanceHandler)
+        self.base = 'http://127.0.0.1:%d' % self.server_port
+        self.password = 'secret'
+        self.project = 'project-id'
+        self.expires_at = '2100-01-01T00:00:00.000000Z'
+        self.tokens = []
+        self.images = {}
+        self.data = {}
+        self.requests = []
+        self.connections = 0
+        self.env = {
+            'GLANCING_GLANCE_BACKEND': 'api',
+            'OS_AUTH_URL': self.base + '/v3',
+            'OS_USERNAME': 'user',
+            'OS_PASSWORD': self.password,
+            'OS_PROJECT_NAME': 'project',
+        }
+
+    def create(self, fields):
+        image = {
+            'id': str(uuid.uuid4()), 'name': None, 'status': 'queued',
+            'owner': self.project, 'disk_format': None,
+            'container_format': None, 'checksum': None, 'size': None,
+            'visibility': 'shared', 'tags': [],
+        }
+        image.update(fields)
+        self.images[image['id']] = image
+        return image
+
+    def upload(self, image, data):
+        self.data[image['id']] = data
+        image.update(status='active', size=len(data),
+                     checksum=hashlib.md5(data).hexdigest(),
+                     os_hash_algo='sha512',
+                     os_hash_value=hashlib.sha512(data).hexdigest())
+
+    def list_images(self, query):
+        params = dict(parse_qsl(query))
+        limit = int(params.pop('limit', self.page_size))
+        marker = params.pop('marker', None)
+        params.pop('sort', None)
+        images = sorted(self.images.values(), key=lambda img: img['id'])
+        images = [img for img in images
+                  if all(str(img.get(key)) == val
+                         for key, val in params.items())]
+        if marker:
+            images = [img for img in images if img['id'] > marker]
+        ret = {'images': images[:limit]}
+        if len(images) > limit:
+            ret['next'] = '/v2/images?' + urlencode(
+                sorted(dict(params, limit=limit,
+                            marker=images[limit - 1]['id']).items()))
+        return ret